@@ -1,53 +1,630 @@
 #!/bin/python3
 # This a simple python script for updating players in bulk using a .csv file containing MAC addresses.
 import argparse
-import csv
-import json
+import array
+import binascii
+import bisect
+import collections
+import functools
+import heapq
+import importlib
+import io
+import itertools
+import locale
 import os
+import random
 import re
+import stat
+import struct
 import sys
-from urllib import request
+import threading
+import time
+from contextlib import ExitStack, closing, redirect_stderr, redirect_stdout
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Stands in for a module that only some runs use, so that it is imported the first time one of its attributes is used
+# rather than when the script starts: -h and short runs do not wait for the networking, JSON, csv and database modules
+# to be imported unless they use them. The module then takes the place of the stand-in as the global `name`, which is
+# the package of a submodule unless given.
+class LazyModule(object):
+    def __init__(self, module_name, name=None):
+        self.lazy_module_name = module_name
+        self.lazy_name = name or module_name.partition(".")[0]
+
+    def __getattr__(self, attribute):
+        module = importlib.import_module(self.lazy_module_name)
+        if self.lazy_module_name.startswith(self.lazy_name + "."):
+            module = sys.modules[self.lazy_name]
+        globals()[self.lazy_name] = module
+        return getattr(module, attribute)
+
+
+asyncio = LazyModule("asyncio")
+concurrent = LazyModule("concurrent.futures")
+cProfile = LazyModule("cProfile")
+csv = LazyModule("csv")
+email = LazyModule("email.utils")
+hashlib = LazyModule("hashlib")
+http = LazyModule("http.client")
+json = LazyModule("json")
+pstats = LazyModule("pstats")
+shutil = LazyModule("shutil")
+socket = LazyModule("socket")
+sqlite3 = LazyModule("sqlite3")
+ssl = LazyModule("ssl")
+tempfile = LazyModule("tempfile")
+urllib = LazyModule("urllib.parse")
+error = LazyModule("urllib.error", "error")
+request = LazyModule("urllib.request", "request")
 
 API_SERVER_BASE_URL = os.getenv("BPU_API_SERVER", "http://localhost:8000")
 
+# Colon or dash separated (aa:bb:cc:dd:ee:ff), dotted Cisco (aabb.ccdd.eeff) or bare (aabbccddeeff) MAC addresses
+MAC_ADDRESS_PATTERN = re.compile(r"(?:[0-9A-F]{2}([:-])[0-9A-F]{2}(?:\1[0-9A-F]{2}){4}"
+                                 r"|[0-9A-F]{4}\.[0-9A-F]{4}\.[0-9A-F]{4}"
+                                 r"|[0-9A-F]{12})\Z", re.I)
+MAC_ADDRESS_SEPARATORS = str.maketrans("", "", ":-.")
+# The record length, separator spacing and separators of a MAC address written in each of the formats above followed by
+# a line break, for checking a whole block of them at once
+MAC_ADDRESS_BLOCK_FORMATS = ((18, 3, b":::::\n"), (18, 3, b"-----\n"), (15, 5, b"..\n"), (13, 13, b"\n"))
+
+# Seconds between two progress reports
+DEFAULT_PROGRESS_INTERVAL = 10.0
+
+# Responses after which no other update can succeed, and responses worth sending the same update again for
+FATAL_STATUSES = {401}
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Responses that count against the health of the API server, throttling is only a request to slow down
+UNHEALTHY_STATUSES = RETRYABLE_STATUSES - {429}
+# Responses to a bulk request meaning that the API server has no bulk endpoint
+BULK_UNAVAILABLE_STATUSES = {404, 405, 501}
+
+# The start of every message about a row of the csv file
+LINE_NUMBER_PATTERN = re.compile(r"Line (\d+):")
+
 
 def batch_player_upgrade():
+    if sys.argv[1:2] == ["campaign"]:
+        campaign(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["report"]:
+        report(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["serve"]:
+        serve(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ["submit"]:
+        submit(sys.argv[2:])
+        return
+
     client_id = get_client_id()
 
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(epilog="To update the players of many clients in one run, see: {0} campaign -h. "
+                                            "To summarize a result journal, see: {0} report -h. To "
+                                            "update many small csv files from a process kept running, see: {0} "
+                                            "serve -h".format(os.path.basename(sys.argv[0])))
     parser.add_argument("path_to_csv",
                         help="The path to the csv file containing the MAC address of players to upgrade in the first "
                              "column")
     parser.add_argument("-c", "--client_id",
                         default=client_id,
                         help="The id of the client whose players are to be updated [default: {}]".format(client_id))
-    parser.add_argument("-a",
-                        "--auth_token",
-                        help="The authentication token for the API server, if not provided the script will attempt to "
-                             "acquire one")
-    parser.add_argument("-m", "--music_app", default="v1.4.10", help="The new version number for the music app")
-    parser.add_argument("-d", "--diagnostic_app", default="v1.2.6", help="The new version number for the diagnostic app")
-    parser.add_argument("-s", "--settings_app", default="v1.1.5", help="The new version number for the settings app")
+    add_update_arguments(parser)
+    parser.add_argument("-k", "--checkpoint",
+                        help="The path of a file in which to record progress through the csv file, so that an "
+                             "interrupted run can be resumed")
+    parser.add_argument("--checkpoint_every",
+                        type=positive_int,
+                        default=1000,
+                        help="The number of players to update between two writes of the checkpoint file "
+                             "[default: 1000]")
+    parser.add_argument("-r", "--resume",
+                        action="store_true",
+                        help="Resume from the position recorded in the checkpoint file instead of from the start of "
+                             "the csv file")
+    parser.add_argument("-f", "--failure_report",
+                        help="The path of a csv file in which to list the players that could not be updated")
+    parser.add_argument("-j", "--journal",
+                        help="The path of a result journal to which to append the outcome of every player update, "
+                             "see the report command")
+    parser.add_argument("-p", "--progress_interval",
+                        type=non_negative_float,
+                        default=DEFAULT_PROGRESS_INTERVAL,
+                        help="The number of seconds between two progress reports, 0 to disable them [default: 10]")
+    parser.add_argument("--metrics",
+                        help="The path of a file to which to append progress metrics, as one JSON object per line")
+    parser.add_argument("-w", "--workers",
+                        type=positive_int,
+                        default=1,
+                        help="The number of processes between which to split the csv file, each updating the players "
+                             "of its part of the file [default: 1]")
+    parser.add_argument("--preflight",
+                        action="store_true",
+                        help="Check every row of the csv file and count duplicates before updating any player")
+    parser.add_argument("--max_invalid",
+                        type=non_negative_int,
+                        help="The number of rows without a valid MAC address above which no player is updated, the "
+                             "csv file is checked first as with --preflight [default: unlimited]")
+    parser.add_argument("--dry_run",
+                        action="store_true",
+                        help="Read, check and build the update of every player as usual, but answer the updates with a "
+                             "success instead of sending them to the API server")
+    parser.add_argument("--replay",
+                        help="The path of the result journal of an earlier run, whose statuses and latencies answer "
+                             "the player updates of a dry run instead")
+    parser.add_argument("--profile",
+                        action="store_true",
+                        help="Time every phase of the run, from parsing the csv file to handling the responses of the "
+                             "API server, and report the time taken by each of them on stderr at the end")
+    parser.add_argument("--profile_stats",
+                        help="The path of a file in which to save the statistics of cProfile over the run, to be read "
+                             "with pstats")
 
     args = parser.parse_args()
+    if args.resume and args.checkpoint is None:
+        parser.error("--resume requires a checkpoint file, set with --checkpoint")
+    if args.profile_cache is not None and not args.diff:
+        parser.error("--profile_cache is only used with --diff")
+    if args.connections is not None and args.engine != "async":
+        parser.error("--connections is only used with --engine async")
+    if args.journal is not None:
+        # A journal is appended to, so only one that is there already has to be a result journal
+        try:
+            with open(args.journal, "rb") as journal_file:
+                if journal_file.read(1):
+                    journal_file.seek(0)
+                    read_journal_header(journal_file)
+        except FileNotFoundError:
+            pass
+        except ValueError as journal_error:
+            parser.error("invalid result journal '{}': {}".format(args.journal, journal_error))
+    if args.replay is not None and not args.dry_run:
+        parser.error("--replay is only used with --dry_run")
+    if args.profile_stats is not None and not args.profile:
+        parser.error("--profile_stats is only used with --profile")
+    transport = None
+    if args.dry_run:
+        # A dry run neither contacts the API server nor writes anything that a later run would take as a record of
+        # upgraded players
+        for option, value in (("--checkpoint", args.checkpoint), ("--upgrade_index", args.upgrade_index),
+                              ("--diff", args.diff)):
+            if value:
+                parser.error("{} cannot be used with --dry_run".format(option))
+        transport = DryRunTransport()
+        if args.replay is not None:
+            try:
+                transport = ReplayTransport(args.replay)
+            except (OSError, ValueError) as journal_error:
+                parser.error("invalid result journal '{}': {}".format(args.replay,
+                                                                      getattr(journal_error, "strerror", None) or
+                                                                      journal_error))
     auth_token = args.auth_token
     client_id = args.client_id
 
     if os.path.isfile(args.path_to_csv):
-        if auth_token is None:
-            auth_token = get_authentication_token()
+        if auth_token is None and args.dry_run:
+            auth_token = "dry_run_authentication_token"
+        elif auth_token is None:
+            auth_token = TokenManager(get_authentication_token, args.token_cache, args.token_lifetime)
+            # A token that cannot be acquired stops the script before any player is read
+            auth_token.get()
 
         applications = [{"applicationId": "music_app", "version": args.music_app},
                         {"applicationId": "diagnostic_app", "version": args.diagnostic_app},
                         {"applicationId": "settings_app", "version": args.settings_app}]
 
-        process_csv(args.path_to_csv, client_id, applications, auth_token)
+        try:
+            process_csv(args.path_to_csv, client_id, applications, auth_token,
+                        concurrency=args.concurrency,
+                        checkpoint_path=args.checkpoint,
+                        checkpoint_every=args.checkpoint_every,
+                        resume=args.resume,
+                        upgrade_index_path=args.upgrade_index,
+                        max_rate=args.max_rate,
+                        max_retries=args.max_retries,
+                        failure_report_path=args.failure_report,
+                        batch_size=args.batch_size,
+                        flush_interval=args.flush_interval,
+                        bulk_endpoint=args.bulk_endpoint,
+                        progress_interval=args.progress_interval,
+                        metrics_path=args.metrics,
+                        workers=args.workers,
+                        preflight=args.preflight or args.max_invalid is not None,
+                        max_invalid=args.max_invalid,
+                        diff=args.diff,
+                        profile_cache_path=args.profile_cache,
+                        profile_cache_ttl=args.profile_cache_ttl,
+                        engine=args.engine,
+                        connections=args.connections,
+                        journal_path=args.journal,
+                        transport=transport,
+                        breaker_error_rate=args.breaker_error_rate,
+                        breaker_latency=args.breaker_latency,
+                        breaker_pause=args.breaker_pause,
+                        profile=args.profile,
+                        profile_stats_path=args.profile_stats)
+        finally:
+            # Stops the thread renewing the token
+            if isinstance(auth_token, TokenManager):
+                auth_token.close()
 
     else:
         print("File not found: '{}'".format(args.path_to_csv), file=sys.stderr)
         sys.exit(1)
 
 
+# The options shared by updates of a single csv file and campaigns
+def add_update_arguments(parser):
+    parser.add_argument("-a",
+                        "--auth_token",
+                        help="The authentication token for the API server, if not provided the script will attempt to "
+                             "acquire one")
+    parser.add_argument("-m", "--music_app", default="v1.4.10", help="The new version number for the music app")
+    parser.add_argument("-d", "--diagnostic_app", default="v1.2.6", help="The new version number for the diagnostic app")
+    parser.add_argument("-s", "--settings_app", default="v1.1.5", help="The new version number for the settings app")
+    parser.add_argument("-n", "--concurrency",
+                        type=positive_int,
+                        default=1,
+                        help="The maximum number of player updates to send to the API server at the same time "
+                             "[default: 1]")
+    parser.add_argument("-u", "--upgrade_index",
+                        help="The path of a file in which to record the players that were upgraded, players already "
+                             "upgraded to the same versions are skipped")
+    parser.add_argument("--max_rate",
+                        type=positive_float,
+                        help="The maximum number of player updates to send to the API server per second, the rate is "
+                             "lowered automatically when the API server asks for fewer requests [default: unlimited]")
+    parser.add_argument("--max_retries",
+                        type=non_negative_int,
+                        default=5,
+                        help="The number of times to retry a player update that failed for a transient reason "
+                             "[default: 5]")
+    parser.add_argument("-b", "--batch_size",
+                        type=positive_int,
+                        default=1,
+                        help="The number of players to update with each request to the bulk endpoint of the API "
+                             "server, 1 to update players one at a time [default: 1]")
+    parser.add_argument("--flush_interval",
+                        type=positive_float,
+                        default=1.0,
+                        help="The number of seconds to wait for a batch of players to fill up before sending it "
+                             "anyway [default: 1.0]")
+    parser.add_argument("--bulk_endpoint",
+                        default="/profiles",
+                        help="The path of the bulk endpoint on the API server [default: /profiles]")
+    parser.add_argument("--token_cache",
+                        help="The path of a file in which to keep the authentication token acquired by the script, "
+                             "so that later runs can use it for as long as it is valid")
+    parser.add_argument("--token_lifetime",
+                        type=positive_float,
+                        default=3600.0,
+                        help="The number of seconds for which an authentication token acquired by the script is "
+                             "valid, it is renewed before then [default: 3600]")
+    parser.add_argument("--diff",
+                        action="store_true",
+                        help="Fetch the profiles of players from the API server first, and only update the players "
+                             "with at least one application on another version")
+    parser.add_argument("--profile_cache",
+                        help="The path of a file in which to keep the profiles fetched with --diff, so that a run "
+                             "started again soon after does not fetch them again")
+    parser.add_argument("--profile_cache_ttl",
+                        type=positive_float,
+                        default=3600.0,
+                        help="The number of seconds for which profiles kept in the profile cache are used "
+                             "[default: 3600]")
+    parser.add_argument("--engine",
+                        choices=["sync", "async"],
+                        default="sync",
+                        help="How player updates are sent: sync sends each update in flight from a thread of its "
+                             "own, async sends them all from a single thread over pipelined keep-alive connections "
+                             "[default: sync]")
+    parser.add_argument("--connections",
+                        type=positive_int,
+                        help="The maximum number of connections to the API server opened by the async engine, "
+                             "further updates in flight are pipelined over them [default: same as --concurrency]")
+    parser.add_argument("--breaker_error_rate",
+                        type=fraction,
+                        default=0.5,
+                        help="The fraction of the updates of the last 30 seconds that failed for a transient reason "
+                             "or were too slow above which no update is sent for --breaker_pause seconds, after "
+                             "which updates are sent one at a time until the API server answers them, 1 to never "
+                             "stop sending [default: 0.5]")
+    parser.add_argument("--breaker_latency",
+                        type=positive_float,
+                        help="The number of seconds above which an update counts as too slow towards "
+                             "--breaker_error_rate [default: unlimited]")
+    parser.add_argument("--breaker_pause",
+                        type=positive_float,
+                        default=10.0,
+                        help="The number of seconds for which no update is sent once --breaker_error_rate is reached "
+                             "[default: 10]")
+
+
+def campaign(argv):
+    parser = argparse.ArgumentParser(prog="{} campaign".format(os.path.basename(sys.argv[0])),
+                                     description="Updates the players of many clients in one run, as listed in a "
+                                                 "campaign manifest")
+    parser.add_argument("manifest",
+                        help="The path to a JSON or csv file listing, for each client, its client id, the csv file of "
+                             "its players and optionally its own application versions")
+    add_update_arguments(parser)
+    parser.add_argument("--parallel_clients",
+                        type=positive_int,
+                        default=4,
+                        help="The maximum number of clients whose players are updated at the same time, which share "
+                             "the player updates in flight equally [default: 4]")
+
+    args = parser.parse_args(argv)
+    if args.profile_cache is not None and not args.diff:
+        parser.error("--profile_cache is only used with --diff")
+    if args.connections is not None and args.engine != "async":
+        parser.error("--connections is only used with --engine async")
+    if not os.path.isfile(args.manifest):
+        print("File not found: '{}'".format(args.manifest), file=sys.stderr)
+        sys.exit(1)
+    default_versions = collections.OrderedDict([("music_app", args.music_app),
+                                                ("diagnostic_app", args.diagnostic_app),
+                                                ("settings_app", args.settings_app)])
+    try:
+        entries = read_campaign(args.manifest, default_versions)
+    except (ValueError, KeyError, TypeError) as manifest_error:
+        parser.error("invalid campaign manifest '{}': {}".format(args.manifest, manifest_error))
+    for client_id, csv_file_path, applications in entries:
+        if not os.path.isfile(csv_file_path):
+            print("File not found: '{}'".format(csv_file_path), file=sys.stderr)
+            sys.exit(1)
+
+    auth_token = args.auth_token
+    if auth_token is None:
+        auth_token = TokenManager(get_authentication_token, args.token_cache, args.token_lifetime)
+        auth_token.get()
+
+    try:
+        process_campaign(entries, auth_token,
+                         concurrency=args.concurrency,
+                         parallel_clients=args.parallel_clients,
+                         upgrade_index_path=args.upgrade_index,
+                         max_rate=args.max_rate,
+                         max_retries=args.max_retries,
+                         batch_size=args.batch_size,
+                         flush_interval=args.flush_interval,
+                         bulk_endpoint=args.bulk_endpoint,
+                         diff=args.diff,
+                         profile_cache_path=args.profile_cache,
+                         profile_cache_ttl=args.profile_cache_ttl,
+                         engine=args.engine,
+                         connections=args.connections,
+                         breaker_error_rate=args.breaker_error_rate,
+                         breaker_latency=args.breaker_latency,
+                         breaker_pause=args.breaker_pause)
+    finally:
+        if isinstance(auth_token, TokenManager):
+            auth_token.close()
+
+
+# Reads the (client id, csv file path, applications) of every client of a campaign manifest, either a JSON list of
+# {"client_id": ..., "csv": ..., "applications": {"music_app": "v1.4.11", ...}} objects, or a csv file with client_id
+# and csv columns and a column per application. Versions left out are the default ones, and csv file paths are
+# relative to the manifest.
+def read_campaign(manifest_path, default_versions):
+    if manifest_path.lower().endswith(".json"):
+        with open(manifest_path) as manifest_file:
+            clients = json.load(manifest_file)
+        clients = [(client["client_id"], client["csv"], client.get("applications", {})) for client in clients]
+    else:
+        with open(manifest_path, newline="") as manifest_file:
+            rows = csv.DictReader(manifest_file)
+            clients = [(row.pop("client_id"), row.pop("csv"), {name: version for name, version in row.items()
+                                                               if version})
+                       for row in rows]
+
+    directory = os.path.dirname(manifest_path)
+    entries = []
+    for client_id, csv_file_path, versions in clients:
+        if not client_id or not csv_file_path:
+            raise ValueError("every client needs a client_id and a csv file")
+        application_versions = collections.OrderedDict(default_versions)
+        application_versions.update(versions)
+        applications = [{"applicationId": name, "version": version}
+                        for name, version in application_versions.items()]
+        entries.append((client_id, os.path.join(directory, csv_file_path), applications))
+    return entries
+
+
+def report(argv):
+    parser = argparse.ArgumentParser(prog="{} report".format(os.path.basename(sys.argv[0])),
+                                     description="Summarizes the outcome of the player updates recorded in a result "
+                                                 "journal")
+    parser.add_argument("journal",
+                        help="The path of a result journal written by runs with --journal")
+    parser.add_argument("-f", "--retry_csv",
+                        help="The path of a csv file in which to list the players whose last update failed, so that "
+                             "it can be used as the input of a later run")
+
+    args = parser.parse_args(argv)
+    if not os.path.isfile(args.journal):
+        print("File not found: '{}'".format(args.journal), file=sys.stderr)
+        sys.exit(1)
+    try:
+        summary = summarize_journal(args.journal)
+    except ValueError as journal_error:
+        parser.error("invalid result journal '{}': {}".format(args.journal, journal_error))
+
+    for line in format_journal_summary(summary):
+        print(line)
+    if args.retry_csv is not None:
+        with open(args.retry_csv, "w", newline="") as retry_file:
+            writer = csv.writer(retry_file)
+            writer.writerow(FailureReport.COLUMNS[:3])
+            writer.writerows([format_journal_mac_address(mac_address), line_num, status or "-"]
+                             for mac_address, (line_num, status) in sorted(summary["failed"].items(),
+                                                                           key=lambda failed: failed[1]))
+        print("Listed {} players to retry in '{}'".format(len(summary["failed"]), args.retry_csv))
+
+
+# Counts the records of a result journal by status and number of attempts, and finds the latency percentiles, the
+# time span of the runs and the players whose last update failed, keyed on their MAC address
+def summarize_journal(journal_path):
+    statuses = collections.Counter()
+    attempts = collections.Counter()
+    latencies = array.array("f")
+    failed = {}
+    first_settled = last_settled = None
+    for line_nums, mac_addresses, block_statuses, block_attempts, block_latencies, settled in \
+            read_journal_columns(journal_path):
+        statuses.update(block_statuses)
+        attempts.update(block_attempts)
+        latencies.extend(block_latencies)
+        first_settled = min(settled) if first_settled is None else min(first_settled, min(settled))
+        last_settled = max(settled) if last_settled is None else max(last_settled, max(settled))
+        for line_num, mac_address, status in zip(line_nums, mac_addresses, block_statuses):
+            if 0 < status <= 399:
+                if failed:
+                    failed.pop(mac_address, None)
+            else:
+                failed[mac_address] = (line_num, status)
+    records = sum(statuses.values())
+    return {"records": records,
+            "succeeded": sum(count for status, count in statuses.items() if 0 < status <= 399),
+            "statuses": statuses,
+            "attempts": attempts,
+            "latencies": sorted(latencies),
+            "first_settled": first_settled,
+            "last_settled": last_settled,
+            "failed": failed}
+
+
+def format_journal_summary(summary):
+    lines = ["{} player updates, {} succeeded, {} failed".format(summary["records"], summary["succeeded"],
+                                                                 summary["records"] - summary["succeeded"])]
+    if not summary["records"]:
+        return lines
+    lines.append("Statuses: " + ", ".join("{}: {}".format(status or "-", count)
+                                          for status, count in sorted(summary["statuses"].items())))
+    lines.append("Attempts: " + ", ".join("{}: {}".format(attempts, count)
+                                          for attempts, count in sorted(summary["attempts"].items())))
+    latencies = summary["latencies"]
+    lines.append("Latency: " + ", ".join("{} {:.1f} ms".format(name, latencies[min(len(latencies) - 1,
+                                                                                  int(fraction * len(latencies)))]
+                                                              * 1000)
+                                         for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99),
+                                                                ("max", 1.0))))
+    lines.append("From {} to {} ({})".format(
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["first_settled"])),
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(summary["last_settled"])),
+        format_duration(summary["last_settled"] - summary["first_settled"])))
+    lines.append("{} players whose last update failed".format(len(summary["failed"])))
+    return lines
+
+
+def serve(argv):
+    client_id = get_client_id()
+    parser = argparse.ArgumentParser(prog="{} serve".format(os.path.basename(sys.argv[0])),
+                                     description="Keeps a process running that updates the players of the csv files "
+                                                 "submitted to it over a UNIX socket, one file at a time, with the "
+                                                 "same authentication token and connections to the API server for "
+                                                 "all of them")
+    parser.add_argument("socket",
+                        help="The path of the UNIX socket on which to accept csv files, see the submit command")
+    parser.add_argument("-c", "--client_id",
+                        default=client_id,
+                        help="The id of the client whose players are to be updated, unless the csv file is submitted "
+                             "with another one [default: {}]".format(client_id))
+    add_update_arguments(parser)
+
+    args = parser.parse_args(argv)
+    if args.profile_cache is not None and not args.diff:
+        parser.error("--profile_cache is only used with --diff")
+    if args.connections is not None and args.engine != "async":
+        parser.error("--connections is only used with --engine async")
+    if not hasattr(socket, "AF_UNIX"):
+        parser.error("UNIX sockets are not available on this platform")
+
+    auth_token = args.auth_token
+    if auth_token is None:
+        auth_token = TokenManager(get_authentication_token, args.token_cache, args.token_lifetime)
+        auth_token.get()
+    applications = [{"applicationId": "music_app", "version": args.music_app},
+                    {"applicationId": "diagnostic_app", "version": args.diagnostic_app},
+                    {"applicationId": "settings_app", "version": args.settings_app}]
+
+    server = UpgradeServer(args.socket, args.client_id, applications, auth_token,
+                           concurrency=args.concurrency,
+                           upgrade_index_path=args.upgrade_index,
+                           max_rate=args.max_rate,
+                           max_retries=args.max_retries,
+                           batch_size=args.batch_size,
+                           flush_interval=args.flush_interval,
+                           bulk_endpoint=args.bulk_endpoint,
+                           diff=args.diff,
+                           profile_cache_path=args.profile_cache,
+                           profile_cache_ttl=args.profile_cache_ttl,
+                           engine=args.engine,
+                           connections=args.connections,
+                           breaker_error_rate=args.breaker_error_rate,
+                           breaker_latency=args.breaker_latency,
+                           breaker_pause=args.breaker_pause)
+    try:
+        server.listen()
+    except OSError as socket_error:
+        parser.error("cannot listen on '{}': {}".format(args.socket, socket_error.strerror or socket_error))
+    print("Accepting csv files on '{}'".format(args.socket), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        if isinstance(auth_token, TokenManager):
+            auth_token.close()
+
+
+def submit(argv):
+    parser = argparse.ArgumentParser(prog="{} submit".format(os.path.basename(sys.argv[0])),
+                                     description="Has the players of a csv file updated by a process started with the "
+                                                 "serve command, printing what it reports and exiting as a run of "
+                                                 "the script would")
+    parser.add_argument("socket",
+                        help="The path of the UNIX socket of the serve command")
+    parser.add_argument("path_to_csv",
+                        help="The path to the csv file containing the MAC address of players to upgrade in the first "
+                             "column")
+    parser.add_argument("-c", "--client_id",
+                        help="The id of the client whose players are to be updated [default: the client id of the "
+                             "serve command]")
+
+    args = parser.parse_args(argv)
+    if "\n" in args.path_to_csv or "\0" in args.path_to_csv:
+        parser.error("the path of the csv file cannot contain line breaks")
+    try:
+        code = submit_csv(args.socket, os.path.abspath(args.path_to_csv), args.client_id)
+    except OSError as socket_error:
+        print("Cannot submit to '{}': {}".format(args.socket, socket_error.strerror or socket_error), file=sys.stderr)
+        sys.exit(1)
+    sys.exit(code)
+
+
+# Sends the path of a csv file, and the client id if one is given, to a serve process on a line of their own, and
+# copies the lines of output of the run that it answers with to `output` and `error_output` until the exit code
+def submit_csv(socket_path, csv_file_path, client_id=None, output=None, error_output=None):
+    output = output if output is not None else sys.stdout
+    error_output = error_output if error_output is not None else sys.stderr
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as connection:
+        connection.connect(socket_path)
+        connection.sendall("{}\0{}\n".format(csv_file_path, client_id or "").encode("utf-8"))
+        for line in connection.makefile("r", encoding="utf-8", newline="\n"):
+            kind, _, text = line.rstrip("\n").partition(" ")
+            if kind == "exit":
+                return int(text)
+            print(text, file=output if kind == "out" else error_output)
+    raise ConnectionResetError("the serve process closed the connection before the end of the run")
+
+
 def get_authentication_token():
     return "dummy_authentication_token"
 
@@ -56,37 +633,3105 @@ def get_client_id():
     return "dummy_client_id"
 
 
-def process_csv(csv_file_path, client_id, applications, token):
-    with open(csv_file_path) as csv_file:
-        csv_data = csv.reader(csv_file)
-        for row in csv_data:
-            if validate_row(row):
-                line_update_response = update_player_profile(client_id, row[0], applications, token)
-                response_status = getattr(line_update_response, "status", "")
-                if response_status > 399:
-                    response_data = json.loads(line_update_response.body)
-                    sys.exit("Error: {error} [{statusCode}]: {message}".format(**response_data))
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("'{}' is not a positive integer".format(value))
+    return number
+
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("'{}' is not a non-negative integer".format(value))
+    return number
+
+
+def non_negative_float(value):
+    number = float(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError("'{}' is not a non-negative number".format(value))
+    return number
+
+
+def positive_float(value):
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError("'{}' is not a positive number".format(value))
+    return number
+
+
+def fraction(value):
+    number = float(value)
+    if not 0 < number <= 1:
+        raise argparse.ArgumentTypeError("'{}' is not a fraction above 0 and up to 1".format(value))
+    return number
+
+
+# Keeps an authentication token from get_authentication_token valid for the whole of a run. The token is renewed
+# by a background thread once refresh_margin of its lifetime is left, and straight away if the API server rejects it.
+# Threads that need a token while it is being renewed wait for that single renewal. With a cache file, the token
+# outlives the run for the next one, and the processes of a run sharing the file take turns to renew it, so that a
+# process renewing a token the others already renewed picks up theirs instead of asking for another.
+class TokenManager(object):
+    def __init__(self, acquire_token=None, cache_path=None, lifetime=3600.0, refresh_margin=0.1, retry_interval=5.0):
+        self.acquire_token = acquire_token if acquire_token is not None else get_authentication_token
+        self.cache_path = cache_path
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.token = None
+        self.expires_at = 0.0
+        self.renewed_after_rejection = False
+        self.init_threads()
+
+    def init_threads(self):
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __getstate__(self):
+        # Worker processes get the current token and start their own refresh thread
+        state = self.__dict__.copy()
+        for name in ("lock", "refresh_lock", "stopped", "thread"):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_threads()
+
+    def get(self):
+        with self.lock:
+            token, expires_at = self.token, self.expires_at
+        if token is None or time.time() >= expires_at:
+            token = self.refresh(token)
+        if self.thread is None:
+            self.start()
+        return token
+
+    def rejected(self, token):
+        # Whether there is another token to try after the API server rejected this one. A token renewed because
+        # its predecessor was rejected and rejected in turn means that the credentials are wrong.
+        with self.refresh_lock:
+            if token != self.token:
+                return True
+            if self.renewed_after_rejection:
+                return False
+        self.refresh(token, forced=True)
+        with self.lock:
+            self.renewed_after_rejection = True
+            return self.token != token
+
+    def refresh(self, stale_token, forced=False):
+        with self.refresh_lock:
+            with self.lock:
+                if self.token != stale_token and self.is_fresh(self.expires_at):
+                    return self.token
+            with self.locked_cache():
+                token, expires_at = self.load()
+                if token is None or token == stale_token or not (forced or self.is_fresh(expires_at)):
+                    token, expires_at = self.acquire()
+                    self.save(token, expires_at)
+            with self.lock:
+                self.token, self.expires_at = token, expires_at
+                self.renewed_after_rejection = False
+            return token
+
+    def is_fresh(self, expires_at):
+        return time.time() < expires_at - self.lifetime * self.refresh_margin
+
+    def acquire(self):
+        # get_authentication_token can give the lifetime of the token along with it
+        token = self.acquire_token()
+        lifetime = self.lifetime
+        if isinstance(token, tuple):
+            token, lifetime = token
+        return token, time.time() + lifetime
+
+    def load(self):
+        if self.cache_path is None:
+            return None, 0.0
+        try:
+            with open(self.cache_path) as cache_file:
+                cached = json.load(cache_file)
+            if cached["api_server"] == API_SERVER_BASE_URL and time.time() < cached["expires_at"]:
+                return cached["token"], cached["expires_at"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return None, 0.0
+
+    def save(self, token, expires_at):
+        if self.cache_path is None:
+            return
+        temporary_path = self.cache_path + ".tmp"
+        # The token is a credential, so the file is only readable by its owner
+        file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(file_descriptor, "w") as cache_file:
+            json.dump({"api_server": API_SERVER_BASE_URL, "token": token, "expires_at": expires_at}, cache_file)
+        os.replace(temporary_path, self.cache_path)
+
+    def locked_cache(self):
+        # Only one process renews the token of a cache file at a time, where the platform can lock files
+        resources = ExitStack()
+        if self.cache_path is not None and fcntl is not None:
+            lock_file = resources.enter_context(open(self.cache_path + ".lock", "a"))
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return resources
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="token refresh", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                token = self.token
+                refresh_in = self.expires_at - self.lifetime * self.refresh_margin - time.time()
+            if self.stopped.wait(max(0.0, refresh_in)):
+                return
+            try:
+                self.refresh(token)
+            except Exception:
+                # The current token may still be valid for a while, so renewing it is tried again until then
+                if self.stopped.wait(self.retry_interval):
+                    return
+
+    def close(self):
+        self.stopped.set()
+
+
+# A token is either a fixed string, or kept valid by a TokenManager
+def current_token(token):
+    return token.get() if isinstance(token, TokenManager) else token
+
+
+def process_csv(csv_file_path, client_id, applications, token, concurrency=1, checkpoint_path=None,
+                checkpoint_every=1000, resume=False, upgrade_index_path=None, max_rate=None, max_retries=5,
+                retry_backoff=0.5, failure_report_path=None, batch_size=1, flush_interval=1.0,
+                bulk_endpoint="/profiles", progress_interval=None, metrics_path=None, workers=1, preflight=False,
+                max_invalid=None, diff=False, profile_cache_path=None, profile_cache_ttl=3600.0, engine="sync",
+                connections=None, journal_path=None, transport=None, breaker_error_rate=0.5, breaker_latency=None,
+                breaker_pause=10.0, profile=False, profile_stats_path=None):
+    options = {"concurrency": concurrency, "checkpoint_every": checkpoint_every, "resume": resume,
+               "upgrade_index_path": upgrade_index_path, "max_rate": max_rate, "max_retries": max_retries,
+               "retry_backoff": retry_backoff, "batch_size": batch_size, "flush_interval": flush_interval,
+               "bulk_endpoint": bulk_endpoint, "preflight": preflight, "max_invalid": max_invalid, "diff": diff,
+               "profile_cache_path": profile_cache_path, "profile_cache_ttl": profile_cache_ttl, "engine": engine,
+               "connections": connections, "transport": transport, "breaker_error_rate": breaker_error_rate,
+               "breaker_latency": breaker_latency, "breaker_pause": breaker_pause}
+    run_profile = PhaseProfile(profile_stats_path).start() if profile else None
+    try:
+        if workers > 1:
+            metrics = process_csv_shards(csv_file_path, client_id, applications, token, workers, checkpoint_path,
+                                         failure_report_path, progress_interval, metrics_path, options, journal_path)
+        else:
+            metrics = update_csv_players(csv_file_path, client_id, applications, token,
+                                         checkpoint_path=checkpoint_path, failure_report_path=failure_report_path,
+                                         progress_interval=progress_interval, metrics_path=metrics_path,
+                                         journal_path=journal_path, **options)
+    finally:
+        # A run that was stopped is reported too, as that may be why it is profiled
+        if run_profile is not None:
+            run_profile.stop()
+            for line in run_profile.summary():
+                print(line, file=sys.stderr)
+
+    print_skipped(metrics.skipped)
+    if metrics.failed:
+        sys.exit("Error: {} players could not be updated".format(metrics.failed))
+
+
+def report_preflight(preflight, max_invalid=None):
+    print(preflight.summary())
+    if max_invalid is not None and preflight.invalid > max_invalid:
+        sys.exit("Error: {} rows do not contain a valid Mac Address, more than the {} allowed by --max_invalid, no "
+                 "player was updated".format(preflight.invalid, max_invalid))
+
+
+def print_skipped(skipped):
+    if skipped["duplicate"]:
+        print("Skipped {} duplicate MAC addresses".format(skipped["duplicate"]))
+    if skipped["upgraded"]:
+        print("Skipped {} players already upgraded to these versions".format(skipped["upgraded"]))
+    if skipped["current"]:
+        print("Skipped {} players already on these versions".format(skipped["current"]))
+
+
+# Updates the players of a csv file, or only of the rows that start within the byte range of a shard of it, and
+# returns the metrics of the run
+def update_csv_players(csv_file_path, client_id, applications, token, concurrency=1, checkpoint_path=None,
+                       checkpoint_every=1000, resume=False, upgrade_index_path=None, max_rate=None, max_retries=5,
+                       retry_backoff=0.5, failure_report_path=None, batch_size=1, flush_interval=1.0,
+                       bulk_endpoint="/profiles", progress_interval=None, metrics_path=None, shard=None,
+                       metrics=None, show_progress=True, rate_limiter=None, fair_share=None, preflight=False,
+                       max_invalid=None, diff=False, profile_cache_path=None, profile_cache_ttl=3600.0, engine="sync",
+                       connections=None, journal_path=None, transport=None, breaker=None, breaker_error_rate=0.5,
+                       breaker_latency=None, breaker_pause=10.0, checked=None):
+    metrics = metrics if metrics is not None else RunMetrics()
+    skipped = metrics.skipped
+    acknowledgers = []
+    retries = RetryScheduler(max_retries, retry_backoff)
+    failures = FailureReport(failure_report_path)
+    with ExitStack() as resources:
+        resources.callback(failures.close)
+        journal = None
+        if journal_path is not None:
+            journal = resources.enter_context(closing(Journal(journal_path)))
+        if checkpoint_path is None and shard is None and not preflight:
+            checkpoint = None
+            csv_file = resources.enter_context(open(csv_file_path))
+            csv_data = csv.reader(csv_file)
+            metrics.track_file(csv_data, file_position(csv_file), total_bytes=file_size(csv_file_path))
+            players = read_players(csv_data)
+        else:
+            start, end = shard if shard is not None else (0, None)
+            offset, line_num = start, 0
+            checkpoint = None
+            if checkpoint_path is not None:
+                checkpoint = Checkpoint(checkpoint_path, checkpoint_every, offset)
+                if resume:
+                    checkpoint.load()
+                offset, line_num = checkpoint.offset, checkpoint.line_num
+            # Only the first shard of a file starts with its header row
+            header_line = 1 if start == 0 else None
+            if checked is not None:
+                # The whole file was checked and its duplicates skipped before it was split into shards
+                csv_lines = PreflightShard(checked, start, end, offset, line_num)
+                metrics.track_file(csv_lines, lambda: csv_lines.offset, offset, file_size(csv_file_path))
+                players = metrics.count_valid(csv_lines)
+            elif preflight:
+                work_directory = tempfile.mkdtemp(prefix="batch_player_upgrade-")
+                resources.callback(shutil.rmtree, work_directory, True)
+                started = time.perf_counter()
+                csv_lines = Preflight(csv_file_path, os.path.join(work_directory, "players"), offset, end, line_num,
+                                      header_line).run()
+                if PROFILE is not None:
+                    PROFILE.add("preflight", started)
+                report_preflight(csv_lines, max_invalid)
+                skipped["duplicate"] += csv_lines.duplicates
+                metrics.rows_valid += csv_lines.duplicates
+                metrics.track_file(csv_lines, lambda: csv_lines.offset, offset, file_size(csv_file_path))
+                players = metrics.count_valid(csv_lines)
+            else:
+                # The file is read in binary so that the byte offset of every row is known, which lets a resumed run
+                # seek straight past the rows that were already acknowledged instead of parsing them again
+                csv_file = resources.enter_context(open(csv_file_path, "rb"))
+                csv_file.seek(offset)
+                csv_lines = OffsetLines(csv_file, offset, line_num, end=end)
+                csv_data = csv.reader(csv_lines)
+                metrics.track_file(csv_data, lambda: csv_lines.offset, offset, file_size(csv_file_path),
+                                   first_line=line_num + 1)
+                players = read_players(csv_data, first_line=line_num + 1, header_line=header_line)
+
+        if not preflight and checked is None:
+            players = skip_duplicates(metrics.count_valid(players), skipped)
+        if upgrade_index_path is not None:
+            upgrade_index = resources.enter_context(closing(UpgradeIndex(upgrade_index_path, client_id,
+                                                                         applications)))
+            players = upgrade_index.skip_upgraded(players, skipped)
+            acknowledgers.append(upgrade_index.acknowledge)
+        # Rows are only tracked by the checkpoint once nothing can skip them, skipped rows would never be acknowledged
+        if checkpoint is not None:
+            players = checkpoint.track(players, csv_lines)
+            acknowledgers.append(checkpoint.acknowledge)
+            resources.callback(checkpoint.save)
+        if diff:
+            profile_cache = None
+            if profile_cache_path is not None:
+                profile_cache = resources.enter_context(closing(ProfileCache(profile_cache_path, client_id,
+                                                                             profile_cache_ttl)))
+            profile_diff = ProfileDiff(client_id, applications, token, profile_cache, concurrency, bulk_endpoint)
+            # Players found to be on the target versions already are acknowledged as soon as they are skipped, so
+            # the checkpoint moves past them
+            players = profile_diff.skip_current(players, skipped, list(acknowledgers))
+            acknowledgers.append(profile_diff.acknowledge)
+
+        if progress_interval or metrics_path is not None:
+            reporter = ProgressReporter(metrics, progress_interval or DEFAULT_PROGRESS_INTERVAL, metrics_path,
+                                        show_progress=show_progress and bool(progress_interval))
+            resources.callback(reporter.start().stop)
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(max_rate)
+        if breaker is None:
+            breaker = CircuitBreaker(breaker_error_rate, breaker_latency, breaker_pause)
+        update_players(players, client_id, applications, token, concurrency, acknowledgers, retries, rate_limiter,
+                       failures, batch_size, flush_interval, bulk_endpoint, metrics, fair_share, engine, connections,
+                       journal, transport, breaker)
+        if checkpoint is not None:
+            checkpoint.complete(csv_lines.offset, csv_lines.line_num)
+    return metrics
+
+
+# Runs each shard of a csv file in its own process, then merges what the shards printed, their failure reports and
+# their metrics, with the line numbers of every shard moved on by the number of lines in the shards before it
+def process_csv_shards(csv_file_path, client_id, applications, token, workers, checkpoint_path=None,
+                       failure_report_path=None, progress_interval=None, metrics_path=None, options=None,
+                       journal_path=None):
+    shards = shard_ranges(csv_file_path, workers)
+    options = dict(options or {})
+    if options.get("max_rate") is not None:
+        # The maximum rate applies to the run as a whole
+        options["max_rate"] /= len(shards)
+    metrics = ShardedRunMetrics(shards, file_size(csv_file_path))
+    run_profile = PROFILE
+
+    with ExitStack() as resources:
+        directory = tempfile.mkdtemp(prefix="batch_player_upgrade-")
+        resources.callback(shutil.rmtree, directory, True)
+        checked = None
+        if options.get("preflight"):
+            # The whole file is checked once, by this process before it is split, and each shard reads its players
+            # from the work file of the check: a player listed in more than one shard is only updated by the first of
+            # them. Otherwise every shard reads its own part of the file, and only skips the duplicates within it.
+            started = time.perf_counter()
+            checked = Preflight(csv_file_path, os.path.join(directory, "players"),
+                                boundaries=[offset for shard in shards for offset in shard]).run()
+            if run_profile is not None:
+                run_profile.add("preflight", started)
+            report_preflight(checked, options.get("max_invalid"))
+            metrics.duplicates = checked.duplicates
+        if isinstance(token, TokenManager) and token.cache_path is None:
+            # The shards take turns to renew the token through a cache file of their own
+            token.cache_path = os.path.join(directory, "token.json")
+            resources.callback(setattr, token, "cache_path", None)
+        shard_paths = [os.path.join(directory, "shard{}".format(index)) for index in range(len(shards))]
+        shard_metrics_paths = [None] * len(shards)
+        if progress_interval or metrics_path is not None:
+            shard_metrics_paths = [path + ".metrics" for path in shard_paths]
+            metrics.metrics_paths = shard_metrics_paths
+            reporter = ProgressReporter(metrics, progress_interval or DEFAULT_PROGRESS_INTERVAL, metrics_path,
+                                        show_progress=bool(progress_interval))
+            resources.callback(reporter.start().stop)
+
+        with concurrent.futures.ProcessPoolExecutor(len(shards)) as executor:
+            futures = []
+            for index, shard in enumerate(shards):
+                shard_checkpoint_path = None
+                if checkpoint_path is not None:
+                    # The shards of a file only match those of an earlier run with as many shards
+                    shard_checkpoint_path = "{}.{}-of-{}".format(checkpoint_path, index + 1, len(shards))
+                futures.append(executor.submit(
+                    process_csv_shard, csv_file_path, client_id, applications, token, shard,
+                    shard_paths[index] + ".out", shard_checkpoint_path,
+                    shard_paths[index] + ".csv" if failure_report_path is not None else None,
+                    progress_interval, shard_metrics_paths[index], options,
+                    shard_paths[index] + ".journal" if journal_path is not None else None,
+                    run_profile is not None,
+                    shard_paths[index] + ".pstats" if run_profile is not None and run_profile.stats_path else None,
+                    checked))
+            results = [future.result() for future in futures]
+
+        line_offsets = [0]
+        for result in results[:-1]:
+            line_offsets.append(line_offsets[-1] + result["lines"])
+        merge_shard_output([path + ".out" for path in shard_paths], line_offsets)
+        if failure_report_path is not None:
+            merge_failure_reports([path + ".csv" for path in shard_paths], line_offsets, failure_report_path)
+        if journal_path is not None:
+            merge_journals([path + ".journal" for path in shard_paths], line_offsets, journal_path)
+        metrics.complete([result["metrics"] for result in results])
+        if run_profile is not None:
+            for path, result in zip(shard_paths, results):
+                run_profile.merge(result["profile"], path + ".pstats" if run_profile.stats_path else None)
+
+        fatal = [result["fatal"] for result in results if result["fatal"] is not None]
+        if fatal:
+            sys.exit(fatal[0])
+    return metrics
+
+
+def process_csv_shard(csv_file_path, client_id, applications, token, shard, output_path, checkpoint_path=None,
+                      failure_report_path=None, progress_interval=None, metrics_path=None, options=None,
+                      journal_path=None, profile=False, profile_stats_path=None, checked=None):
+    # A forked process starts with copies of the idle connections of its parent, which it must not share
+    CONNECTION_POOL.close()
+    metrics = RunMetrics()
+    fatal = None
+    shard_profile = PhaseProfile(profile_stats_path).start() if profile else None
+    with open(output_path, "w") as output, redirect_stdout(output):
+        try:
+            update_csv_players(csv_file_path, client_id, applications, token, checkpoint_path=checkpoint_path,
+                               failure_report_path=failure_report_path, progress_interval=progress_interval,
+                               metrics_path=metrics_path, shard=shard, metrics=metrics, show_progress=False,
+                               journal_path=journal_path, checked=checked, **(options or {}))
+        except SystemExit as exit:
+            fatal = exit.code
+        finally:
+            if shard_profile is not None:
+                shard_profile.stop()
+    snapshot = metrics.snapshot()
+    lines = snapshot["rows_read"]
+    if fatal is not None:
+        # The rows of an aborted shard that were never read still count towards the line numbers of later shards
+        lines += count_lines(csv_file_path, snapshot["offset"], shard[1])
+    return {"lines": lines, "metrics": snapshot, "fatal": fatal,
+            "profile": shard_profile.snapshot() if shard_profile is not None else None}
+
+
+# Splits a csv file into byte ranges of about the same size, each starting at the beginning of a line. Every split is
+# found by reading on from its approximate position to the next line break, so finding them does not read the whole
+# file; only a run checked with --preflight reads it as a whole before the shards start. Rows with quoted line breaks
+# are not supported, as a split could land inside them.
+def shard_ranges(csv_file_path, shards):
+    size = os.path.getsize(csv_file_path)
+    starts = [0]
+    with open(csv_file_path, "rb") as csv_file:
+        for shard in range(1, shards):
+            csv_file.seek(max(size * shard // shards - 1, starts[-1]))
+            csv_file.readline()
+            start = csv_file.tell()
+            if starts[-1] < start < size:
+                starts.append(start)
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def count_lines(csv_file_path, start, end):
+    lines = 0
+    last_byte = b"\n"
+    with open(csv_file_path, "rb") as csv_file:
+        csv_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = csv_file.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+            remaining -= len(chunk)
+    return lines + (last_byte != b"\n")
+
+
+# Prints what each shard printed, shard by shard and in line order within a shard, with the line numbers moved on by
+# the offset of the shard. Messages about the run as a whole, such as the fall back from bulk updates, are printed once.
+def merge_shard_output(output_paths, line_offsets):
+    printed = set()
+    for output_path, line_offset in zip(output_paths, line_offsets):
+        messages = []
+        with open(output_path) as output:
+            for message in output:
+                match = LINE_NUMBER_PATTERN.match(message)
+                if match is not None:
+                    line_num = int(match.group(1)) + line_offset
+                    messages.append((line_num, len(messages), "Line {}:{}".format(line_num, message[match.end():])))
+                elif message not in printed:
+                    printed.add(message)
+                    sys.stdout.write(message)
+        for line_num, order, message in sorted(messages):
+            sys.stdout.write(message)
+
+
+def merge_failure_reports(report_paths, line_offsets, failure_report_path):
+    with open(failure_report_path, "w", newline="") as report_file:
+        writer = csv.writer(report_file)
+        writer.writerow(FailureReport.COLUMNS)
+        for report_path, line_offset in zip(report_paths, line_offsets):
+            with open(report_path, newline="") as shard_report:
+                rows = csv.reader(shard_report)
+                next(rows, None)
+                failures = [[mac_address, int(line_num) + line_offset] + details
+                            for mac_address, line_num, *details in rows]
+            writer.writerows(sorted(failures, key=lambda failure: failure[1]))
+
+
+# Updates the players of every client of a campaign, up to parallel_clients clients at a time. The clients share a
+# single token, connection pool, rate limit and circuit breaker, and share out the `concurrency` updates in flight
+# between them, so that a client with many players does not hold up the others. With the async engine, every client
+# runs an event loop of its own, whose connections cannot be shared with the others, so `connections` are split
+# between the clients updated at the same time instead.
+def process_campaign(entries, token, concurrency=1, parallel_clients=4, upgrade_index_path=None, max_rate=None,
+                     max_retries=5, retry_backoff=0.5, batch_size=1, flush_interval=1.0, bulk_endpoint="/profiles",
+                     diff=False, profile_cache_path=None, profile_cache_ttl=3600.0, engine="sync", connections=None,
+                     breaker_error_rate=0.5, breaker_latency=None, breaker_pause=10.0):
+    if engine == "async":
+        connections = max(1, (connections or concurrency) // max(1, min(parallel_clients, len(entries))))
+    options = {"concurrency": concurrency, "upgrade_index_path": upgrade_index_path, "max_retries": max_retries,
+               "retry_backoff": retry_backoff, "batch_size": batch_size, "flush_interval": flush_interval,
+               "bulk_endpoint": bulk_endpoint, "rate_limiter": RateLimiter(max_rate),
+               "fair_share": FairShare(concurrency), "diff": diff, "profile_cache_path": profile_cache_path,
+               "profile_cache_ttl": profile_cache_ttl, "engine": engine, "connections": connections,
+               "breaker": CircuitBreaker(breaker_error_rate, breaker_latency, breaker_pause)}
+    output = PrefixedOutput(sys.stdout)
+    failed = 0
+    with redirect_stdout(output), concurrent.futures.ThreadPoolExecutor(max_workers=parallel_clients) as executor:
+        futures = [executor.submit(process_campaign_client, output, client_id, csv_file_path, applications, token,
+                                   options)
+                   for client_id, csv_file_path, applications in entries]
+        try:
+            for future in futures:
+                failed += future.result().failed
+        finally:
+            for future in futures:
+                future.cancel()
+    if failed:
+        sys.exit("Error: {} players could not be updated".format(failed))
+
+
+def process_campaign_client(output, client_id, csv_file_path, applications, token, options):
+    output.set_prefix("{}, {}: ".format(client_id, csv_file_path))
+    metrics = update_csv_players(csv_file_path, client_id, applications, token, **options)
+    print_skipped(metrics.skipped)
+    print("Updated {} players, {} could not be updated".format(metrics.succeeded, metrics.failed))
+    return metrics
+
+
+def read_players(csv_data, first_line=1, header_line=1):
+    if PROFILE is not None:
+        yield from read_players_profiled(csv_data, first_line, header_line, PROFILE)
+        return
+    for row in csv_data:
+        line_num = csv_data.line_num + first_line - 1
+        if validate_row(row):
+            yield line_num, normalize_mac_address(row[0])
+
+        elif line_num != header_line:
+            print("Line {}: Warning: Column 1 does not contain a valid Mac Address".format(line_num))
+
+
+# The same as read_players, timing the parsing of every row and its validation for --profile
+def read_players_profiled(csv_data, first_line, header_line, profile):
+    rows = iter(csv_data)
+    while True:
+        started = time.perf_counter()
+        row = next(rows, None)
+        if row is None:
+            return
+        started = profile.add("csv parsing", started)
+        line_num = csv_data.line_num + first_line - 1
+        mac_address = normalize_mac_address(row[0]) if validate_row(row) else None
+        profile.add("validate_row", started)
+        if mac_address is not None:
+            yield line_num, mac_address
+
+        elif line_num != header_line:
+            print("Line {}: Warning: Column 1 does not contain a valid Mac Address".format(line_num))
+
+
+def skip_duplicates(players, skipped):
+    # Players are keyed on their normalized MAC address, so the same player listed in different formats is only
+    # updated once
+    seen = set()
+    for line_num, mac_address in players:
+        if mac_address in seen:
+            skipped["duplicate"] += 1
+            continue
+        seen.add(mac_address)
+        yield line_num, mac_address
+
+
+def update_players(players, client_id, applications, token, concurrency=1, acknowledgers=(), retries=None,
+                   rate_limiter=None, failures=None, batch_size=1, flush_interval=1.0, bulk_endpoint="/profiles",
+                   metrics=None, fair_share=None, engine="sync", connections=None, journal=None, transport=None,
+                   breaker=None):
+    if engine == "async":
+        dispatcher = AsyncUpdateDispatcher(client_id, applications, token, concurrency, acknowledgers, retries,
+                                           rate_limiter, failures, batch_size, flush_interval, bulk_endpoint, metrics,
+                                           fair_share, journal, connections, transport, breaker)
+    else:
+        dispatcher = UpdateDispatcher(client_id, applications, token, concurrency, acknowledgers, retries,
+                                      rate_limiter, failures, batch_size, flush_interval, bulk_endpoint, metrics,
+                                      fair_share, journal, transport, breaker)
+    dispatcher.run(players)
+
+
+# Sends player updates to the API server and settles their outcome. At most `concurrency` requests are in flight at
+# once, so the csv file is only read as fast as the API server answers. Updates that failed for a transient reason
+# are sent again once their backoff has elapsed, in between new players, so that waiting to retry one player never
+# holds up the others.
+#
+# With a batch_size above 1, players are grouped into bulk requests to the bulk endpoint. A batch is sent once it is
+# full, or once there are no new players left and it has waited flush_interval seconds for retries to join it. If the
+# API server has no bulk endpoint, the dispatcher falls back to one request per player.
+#
+# The dispatchers of a campaign also take a slot of a FairShare for every request they send, which they give back as
+# soon as it completes. The final outcome of every player is written to the journal, if there is one. Updates are
+# sent through the transport, which is the API server itself unless the run is a dry run.
+#
+# The outcome of every request is reported to the circuit breaker, which limits the number of requests in flight, to
+# none at all while the API server is failing.
+class UpdateDispatcher(object):
+    def __init__(self, client_id, applications, token, concurrency=1, acknowledgers=(), retries=None,
+                 rate_limiter=None, failures=None, batch_size=1, flush_interval=1.0, bulk_endpoint="/profiles",
+                 metrics=None, fair_share=None, journal=None, transport=None, breaker=None):
+        self.client_id = client_id
+        self.applications = applications
+        self.token = token
+        self.concurrency = concurrency
+        self.acknowledgers = acknowledgers
+        self.retries = retries if retries is not None else RetryScheduler()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.failures = failures if failures is not None else FailureReport()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.bulk_endpoint = bulk_endpoint
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.fair_share = fair_share
+        self.journal = journal
+        self.transport = transport if transport is not None else NetworkTransport()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.bulk_available = batch_size > 1
+        self.players = None
+        self.requeued = collections.deque()
+        self.batch = []
+        self.batch_started = None
+
+    def run(self, players):
+        self.players = iter(players)
+        in_flight = {}
+        settle = self.settle if PROFILE is None else PROFILE.timed("response handling", self.settle)
+        if self.concurrency > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        else:
+            executor = InlineExecutor()
+        with executor:
+            try:
+                while True:
+                    while len(in_flight) < self.breaker.limit(self.concurrency):
+                        batch = self.next_batch()
+                        if batch is None:
+                            break
+                        token = current_token(self.token)
+                        if self.fair_share is not None:
+                            self.fair_share.acquire()
+                        # The latency of the request is added to it once it completes
+                        latency = []
+                        future = executor.submit(self.send, batch, token, latency)
+                        if self.fair_share is not None:
+                            future.add_done_callback(self.fair_share.release)
+                        in_flight[future] = batch, token, latency
+                    self.metrics.in_flight = len(in_flight)
+
+                    timeout = self.wait_time(len(in_flight))
+                    if not in_flight:
+                        if timeout is None:
+                            break
+                        time.sleep(timeout)
+                        continue
+
+                    done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        batch, token, latency = in_flight.pop(future)
+                        settle(batch, future, token, latency[0] if latency else None)
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def next_player(self):
+        if self.requeued:
+            return self.requeued.popleft()
+        player = self.retries.pop_due()
+        if player is None and self.players is not None:
+            player = next(self.players, None)
+            if player is None:
+                self.players = None
+            else:
+                player = player + (1,)
+        return player
+
+    def next_batch(self):
+        batch_size = self.batch_size if self.bulk_available else 1
+        while len(self.batch) < batch_size:
+            player = self.next_player()
+            if player is None:
+                break
+            if not self.batch:
+                self.batch_started = time.monotonic()
+            self.batch.append(player)
+
+        if not self.batch:
+            return None
+        if len(self.batch) < batch_size and not self.flush_due():
+            return None
+        batch, self.batch = self.batch, []
+        return batch
+
+    def flush_due(self):
+        if self.players is not None:
+            return False
+        return not self.retries or time.monotonic() - self.batch_started >= self.flush_interval
+
+    def wait_time(self, in_flight=0):
+        # How long to wait for an update to complete before there may be something new to send, None for as long
+        # as it takes. While the `in_flight` updates take up every slot, a retry or a batch that falls due cannot be
+        # sent before one of them completes, so only the breaker letting updates through again ends the wait early.
+        timeout = None
+        if in_flight < self.breaker.limit(self.concurrency):
+            timeout = self.retries.wait_time()
+            if self.batch:
+                flush_time = max(0.0, self.batch_started + self.flush_interval - time.monotonic())
+                timeout = flush_time if timeout is None else min(timeout, flush_time)
+        resume_time = self.breaker.wait_time()
+        if resume_time is not None:
+            timeout = resume_time if timeout is None else min(timeout, resume_time)
+        return timeout
+
+    def send(self, batch, token, latency=None):
+        self.rate_limiter.acquire()
+        started = time.monotonic()
+        try:
+            if len(batch) == 1:
+                return self.transport.update_player_profile(self.client_id, batch[0][1], self.applications, token)
+            return self.transport.update_player_profiles(self.client_id, [player[1] for player in batch],
+                                                         self.applications, token, self.bulk_endpoint)
+        finally:
+            elapsed = time.monotonic() - started
+            self.metrics.record_latency(elapsed)
+            if latency is not None:
+                latency.append(elapsed)
+
+    def settle(self, batch, future, token=None, latency=None):
+        try:
+            line_update_response = future.result()
+        except error.HTTPError as http_error:
+            line_update_response = http_error
+        except (error.URLError, http.client.HTTPException, OSError) as connection_error:
+            self.breaker.record(True, latency)
+            response_data = {"statusCode": "-", "error": "Connection Error",
+                             "message": str(getattr(connection_error, "reason", connection_error))}
+            for player in batch:
+                self.settle_player(player, None, response_data, latency=latency)
+            return
+
+        response_status = getattr(line_update_response, "status", None) or line_update_response.code
+        self.breaker.record(response_status in UNHEALTHY_STATUSES, latency)
+        if len(batch) > 1 and response_status in BULK_UNAVAILABLE_STATUSES:
+            self.fall_back_to_single_updates(batch)
+            return
+
+        if response_status <= 399:
+            self.rate_limiter.succeeded()
+            if len(batch) == 1:
+                self.settle_player(batch[0], response_status, latency=latency)
+            else:
+                self.settle_bulk_results(batch, line_update_response, response_status, token, latency)
+            return
+
+        response_data = read_error_response(line_update_response, response_status)
+        if response_status in FATAL_STATUSES:
+            if self.token_rejected(token):
+                self.requeued.extend(batch)
+                return
+            sys.exit("Error: {error} [{statusCode}]: {message}".format(**response_data))
+
+        retry_after = parse_retry_after(line_update_response)
+        if response_status == 429:
+            self.rate_limiter.throttled(retry_after)
+        elif retry_after is not None:
+            self.rate_limiter.pause(retry_after)
+        for player in batch:
+            self.settle_player(player, response_status, response_data, retry_after, latency)
+
+    def settle_bulk_results(self, batch, bulk_response, bulk_status, token=None, latency=None):
+        results = read_bulk_results(bulk_response)
+        for player in batch:
+            result = results.get("clientId:{}".format(player[1]), {})
+            try:
+                result_status = int(result["statusCode"])
+            except (KeyError, TypeError, ValueError):
+                # Nothing says the update of a player without a result of its own went through, whatever the status
+                # of the bulk response, so it is sent again like that of a connection error
+                self.settle_player(player, None, {"statusCode": "-", "error": "Invalid Response",
+                                                  "message": "No result for this player in the bulk response "
+                                                             "[{}]".format(bulk_status)}, latency=latency)
+                continue
+            if result_status <= 399:
+                self.settle_player(player, result_status, latency=latency)
+                continue
+            response_data = {"statusCode": result_status,
+                             "error": result.get("error", "Error"),
+                             "message": result.get("message", "")}
+            if result_status in FATAL_STATUSES:
+                if self.token_rejected(token):
+                    self.requeued.append(player)
+                    continue
+                sys.exit("Error: {error} [{statusCode}]: {message}".format(**response_data))
+            self.settle_player(player, result_status, response_data, latency=latency)
+
+    def token_rejected(self, token):
+        # Players are sent again when the API server rejected a token that can be renewed
+        return isinstance(self.token, TokenManager) and self.token.rejected(token)
+
+    def settle_player(self, player, response_status, response_data=None, retry_after=None, latency=None):
+        line_num, mac_address, attempt = player
+        self.metrics.statuses[response_status or "-"] += 1
+        if response_status is not None and response_status <= 399:
+            self.metrics.succeeded += 1
+            if self.journal is not None:
+                self.journal.add(line_num, mac_address, response_status, attempt, latency)
+            for acknowledge in self.acknowledgers:
+                acknowledge(line_num, True)
+            return
+
+        if response_status is None or response_status in RETRYABLE_STATUSES:
+            if self.retries.schedule(line_num, mac_address, attempt, retry_after):
+                self.metrics.retried += 1
+                return
+
+        self.metrics.failed += 1
+        self.failures.add(line_num, mac_address, response_data)
+        if self.journal is not None:
+            self.journal.add(line_num, mac_address, response_status, attempt, latency)
+        for acknowledge in self.acknowledgers:
+            acknowledge(line_num, False)
+
+    def fall_back_to_single_updates(self, batch):
+        if self.bulk_available:
+            self.bulk_available = False
+            print("Warning: The API server has no bulk endpoint at '{}', players will be updated one at a "
+                  "time".format(self.bulk_endpoint))
+        self.requeued.extend(batch)
+        self.requeued.extend(self.batch)
+        self.batch = []
+
+
+# Sends player updates like UpdateDispatcher, but from a single asyncio event loop rather than from a thread for each
+# update in flight, so that a process can keep thousands of updates in flight. Requests go out over the keep-alive
+# connections of an AsyncHTTPClient, at most `connections` of them, and once they are all busy further requests are
+# pipelined over them. Outcomes are settled exactly as by the threaded dispatcher, so the output of a run is the same
+# with either engine.
+class AsyncUpdateDispatcher(UpdateDispatcher):
+    def __init__(self, client_id, applications, token, concurrency=1, acknowledgers=(), retries=None,
+                 rate_limiter=None, failures=None, batch_size=1, flush_interval=1.0, bulk_endpoint="/profiles",
+                 metrics=None, fair_share=None, journal=None, connections=None, transport=None, breaker=None):
+        super().__init__(client_id, applications, token, concurrency, acknowledgers, retries, rate_limiter, failures,
+                         batch_size, flush_interval, bulk_endpoint, metrics, fair_share, journal, transport, breaker)
+        self.connections = connections or concurrency
+
+    def run(self, players):
+        self.players = iter(players)
+        # A loop of its own, as the clients of a campaign each run in their own thread
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        http_client = AsyncHTTPClient(self.connections)
+        try:
+            loop.run_until_complete(self.dispatch(loop, http_client))
+        finally:
+            loop.run_until_complete(http_client.close())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    async def dispatch(self, loop, http_client):
+        in_flight = {}
+        settle = self.settle if PROFILE is None else PROFILE.timed("response handling", self.settle)
+        # Tasks are collected as they complete, waiting on all of them at once would cost a callback per update in
+        # flight every time one completes
+        completed = collections.deque()
+        wakeup = loop.create_future()
+
+        def complete(task):
+            completed.append(task)
+            if not wakeup.done():
+                wakeup.set_result(None)
+
+        try:
+            while True:
+                while len(in_flight) < self.breaker.limit(self.concurrency):
+                    batch = self.next_batch()
+                    if batch is None:
+                        break
+                    token = current_token(self.token)
+                    if self.fair_share is not None:
+                        await self.fair_share.acquire_async(loop)
+                    latency = []
+                    task = loop.create_task(self.send_async(http_client, batch, token, latency))
+                    if self.fair_share is not None:
+                        task.add_done_callback(self.fair_share.release)
+                    task.add_done_callback(complete)
+                    in_flight[task] = batch, token, latency
+                self.metrics.in_flight = len(in_flight)
+
+                timeout = self.wait_time(len(in_flight))
+                if not in_flight:
+                    if timeout is None:
+                        break
+                    await asyncio.sleep(timeout)
+                    continue
+
+                if not completed:
+                    wakeup = loop.create_future()
+                    await asyncio.wait([wakeup], timeout=timeout)
+                while completed:
+                    task = completed.popleft()
+                    batch, token, latency = in_flight.pop(task)
+                    settle(batch, task, token, latency[0] if latency else None)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if in_flight:
+                await asyncio.wait(list(in_flight))
+
+    async def send_async(self, http_client, batch, token, latency=None):
+        delay = self.rate_limiter.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        started = time.monotonic()
+        try:
+            if len(batch) == 1:
+                return await self.transport.update_player_profile_async(http_client, self.client_id, batch[0][1],
+                                                                        self.applications, token)
+            return await self.transport.update_player_profiles_async(http_client, self.client_id,
+                                                                     [player[1] for player in batch],
+                                                                     self.applications, token, self.bulk_endpoint)
+        finally:
+            elapsed = time.monotonic() - started
+            self.metrics.record_latency(elapsed)
+            if latency is not None:
+                latency.append(elapsed)
+
+
+def read_error_response(line_update_response, response_status):
+    body = read_response_body(line_update_response)
+    try:
+        response_data = json.loads(body)
+        "{error}{statusCode}{message}".format(**response_data)
+    except (TypeError, ValueError, KeyError):
+        response_data = {"statusCode": response_status,
+                         "error": getattr(line_update_response, "reason", "Error"),
+                         "message": body}
+    return response_data
+
+
+def read_bulk_results(bulk_response):
+    # The bulk endpoint answers with one result per profile, {"results": [{"id": ..., "statusCode": ...}, ...]};
+    # a body that is not such an answer, such as the page of a proxy, has no results
+    try:
+        results = json.loads(read_response_body(bulk_response))["results"]
+        return {result["id"]: result for result in results}
+    except (TypeError, ValueError, KeyError):
+        return {}
+
+
+def parse_retry_after(line_update_response):
+    headers = getattr(line_update_response, "headers", None)
+    retry_after = headers.get("Retry-After") if headers is not None else None
+    if not isinstance(retry_after, str):
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        retry_date = email.utils.parsedate_tz(retry_after)
+        if retry_date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(retry_date) - time.time())
+
+
+def read_response_body(line_update_response):
+    body = getattr(line_update_response, "body", None)
+    if body is None:
+        body = line_update_response.read()
+    if isinstance(body, bytes):
+        body = body.decode("utf8", "replace")
+    return body
+
+
+# Counters describing the progress of a run. They are updated from the dispatch loop without any locking, apart
+# from request latencies which are recorded by the threads sending the requests, and are only read by the
+# ProgressReporter, so keeping them costs a few additions per row.
+class RunMetrics(object):
+    LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.csv_data = None
+        self.first_line = 1
+        self.position = None
+        self.start_offset = 0
+        self.total_bytes = None
+        self.skipped = collections.Counter()
+        self.rows_read = 0
+        self.rows_valid = 0
+        self.in_flight = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.statuses = collections.Counter()
+        self.latency_counts = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+        self.latency_total = 0.0
+        self.lock = threading.Lock()
+
+    def track_file(self, csv_data, position, start_offset=0, total_bytes=None, first_line=1):
+        self.csv_data = csv_data
+        self.position = position
+        self.start_offset = start_offset
+        self.total_bytes = total_bytes
+        self.first_line = first_line
+
+    def count_valid(self, players):
+        for player in players:
+            self.rows_valid += 1
+            yield player
+
+    def record_latency(self, latency):
+        bucket = bisect.bisect_left(self.LATENCY_BUCKETS_MS, latency * 1000)
+        with self.lock:
+            self.latency_counts[bucket] += 1
+            self.latency_total += latency
+
+    def latency_percentile(self, fraction):
+        # The upper bound of the histogram bucket holding the percentile, in milliseconds
+        with self.lock:
+            counts = list(self.latency_counts)
+        target = fraction * sum(counts)
+        if not target:
+            return None
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= target:
+                break
+        return self.LATENCY_BUCKETS_MS[bucket] if bucket < len(self.LATENCY_BUCKETS_MS) else float("inf")
+
+    def merge(self, snapshot):
+        # Adds the counts of a snapshot of another run, such as another shard of the same file
+        self.rows_read += snapshot["rows_read"]
+        self.rows_valid += snapshot["rows_valid"]
+        self.skipped.update(snapshot["skipped"])
+        self.in_flight += snapshot["in_flight"]
+        self.succeeded += snapshot["succeeded"]
+        self.failed += snapshot["failed"]
+        self.retried += snapshot["retried"]
+        self.statuses.update(snapshot["statuses"])
+        histogram = snapshot["latency_histogram_ms"]
+        with self.lock:
+            for bucket, bound in enumerate([str(bound) for bound in self.LATENCY_BUCKETS_MS] + ["inf"]):
+                self.latency_counts[bucket] += histogram[bound]
+            if snapshot["requests"]:
+                self.latency_total += snapshot["latency_mean_ms"] * snapshot["requests"] / 1000
+
+    def snapshot(self):
+        offset = None
+        if self.position is not None:
+            try:
+                offset = self.position()
+            except (OSError, ValueError):
+                pass
+        with self.lock:
+            latency_counts = list(self.latency_counts)
+            latency_total = self.latency_total
+        requests = sum(latency_counts)
+        return {
+            "elapsed": round(time.monotonic() - self.started, 3),
+            "rows_read": self.csv_data.line_num + self.first_line - 1 if self.csv_data is not None else self.rows_read,
+            "rows_valid": self.rows_valid,
+            "skipped": dict(self.skipped),
+            "in_flight": self.in_flight,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retried": self.retried,
+            "statuses": {str(status): count for status, count in self.statuses.items()},
+            "requests": requests,
+            "latency_mean_ms": round(latency_total * 1000 / requests, 3) if requests else None,
+            "latency_histogram_ms": dict(zip([str(bound) for bound in self.LATENCY_BUCKETS_MS] + ["inf"],
+                                             latency_counts)),
+            "offset": offset,
+            "total_bytes": self.total_bytes,
+        }
+
+
+# The metrics of a run split into shards, merged from the latest metrics each shard appended to its metrics file, or
+# from their final metrics once every shard is done
+class ShardedRunMetrics(RunMetrics):
+    def __init__(self, shards, total_bytes=None, metrics_paths=()):
+        super().__init__()
+        self.shards = shards
+        self.total_bytes = total_bytes
+        self.metrics_paths = metrics_paths
+        self.final_snapshots = None
+        # The duplicates are skipped by the check of the whole file, before it is split into shards
+        self.duplicates = 0
+        self.bytes_read = 0
+        self.position = lambda: self.bytes_read
+
+    def complete(self, snapshots):
+        self.final_snapshots = snapshots
+        self.merge_shards(snapshots)
+
+    def merge_shards(self, snapshots):
+        with self.lock:
+            self.latency_counts = [0] * (len(self.LATENCY_BUCKETS_MS) + 1)
+            self.latency_total = 0.0
+        self.skipped.clear()
+        self.statuses.clear()
+        self.rows_read = self.rows_valid = self.in_flight = self.succeeded = self.failed = self.retried = 0
+        bytes_read = 0
+        for (start, end), snapshot in zip(self.shards, snapshots):
+            if snapshot is not None:
+                self.merge(snapshot)
+                bytes_read += (snapshot["offset"] or start) - start
+        self.bytes_read = bytes_read
+        if self.duplicates:
+            self.skipped["duplicate"] += self.duplicates
+            self.rows_valid += self.duplicates
+
+    def snapshot(self):
+        if self.final_snapshots is None:
+            self.merge_shards([read_last_snapshot(path) for path in self.metrics_paths])
+        return super().snapshot()
+
+
+def read_last_snapshot(metrics_path):
+    try:
+        with open(metrics_path, "rb") as metrics_file:
+            metrics_file.seek(0, os.SEEK_END)
+            metrics_file.seek(max(0, metrics_file.tell() - 65536))
+            lines = metrics_file.read().splitlines()
+    except OSError:
+        return None
+    for line in reversed(lines):
+        try:
+            return json.loads(line.decode("utf8"))
+        except ValueError:
+            # The last line can be partly written
+            continue
+    return None
+
+
+# Reports the progress of a run every `interval` seconds from a background thread, as one line on stderr unless
+# show_progress is off, and as one JSON object per line in the metrics file if there is one
+class ProgressReporter(object):
+    def __init__(self, metrics, interval=10.0, metrics_path=None, show_progress=True, output=None, window=6):
+        self.metrics = metrics
+        self.interval = interval
+        self.show_progress = show_progress
+        self.output = output if output is not None else sys.stderr
+        self.metrics_file = open(metrics_path, "a") if metrics_path is not None else None
+        self.recent = collections.deque(maxlen=window)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.report(final=True)
+        if self.metrics_file is not None:
+            self.metrics_file.close()
+
+    def report(self, final=False):
+        snapshot = self.metrics.snapshot()
+        self.recent.append((snapshot["elapsed"], snapshot["rows_read"]))
+        snapshot["rows_per_second"] = self.rolling_rate()
+        snapshot["eta_seconds"] = None if final else self.eta(snapshot)
+        snapshot["latency_p50_ms"] = self.metrics.latency_percentile(0.5)
+        snapshot["latency_p95_ms"] = self.metrics.latency_percentile(0.95)
+        snapshot["final"] = final
+
+        if self.show_progress:
+            print(format_progress(snapshot), file=self.output)
+            self.output.flush()
+        if self.metrics_file is not None:
+            snapshot["time"] = round(time.time(), 3)
+            self.metrics_file.write(json.dumps(snapshot, sort_keys=True) + "\n")
+            self.metrics_file.flush()
+
+    def rolling_rate(self):
+        if len(self.recent) < 2:
+            elapsed, rows_read = self.recent[-1]
+            return round(rows_read / elapsed, 1) if elapsed else None
+        (first_elapsed, first_rows), (last_elapsed, last_rows) = self.recent[0], self.recent[-1]
+        # Elapsed times are rounded to the millisecond, reports closer together than that have the same one
+        if last_elapsed == first_elapsed:
+            return None
+        return round((last_rows - first_rows) / (last_elapsed - first_elapsed), 1)
+
+    def eta(self, snapshot):
+        offset, total_bytes = snapshot["offset"], snapshot["total_bytes"]
+        start_offset = self.metrics.start_offset
+        if offset is None or not total_bytes or offset <= start_offset:
+            return None
+        bytes_per_second = (offset - start_offset) / snapshot["elapsed"]
+        return round(max(0, total_bytes - offset) / bytes_per_second, 1)
+
+
+def format_progress(snapshot):
+    parts = []
+    if snapshot["offset"] is not None and snapshot["total_bytes"]:
+        parts.append("{:5.1f}%".format(min(100.0, 100.0 * snapshot["offset"] / snapshot["total_bytes"])))
+    parts.append("{rows_read} rows read, {rows_valid} valid, {succeeded} updated, {failed} failed, "
+                 "{retried} retried, {in_flight} in flight".format(**snapshot))
+    if snapshot["rows_per_second"] is not None:
+        parts.append("{:.1f} rows/s".format(snapshot["rows_per_second"]))
+    if snapshot["latency_p50_ms"] is not None:
+        parts.append("latency p50 <{latency_p50_ms} ms p95 <{latency_p95_ms} ms".format(**snapshot))
+    errors = sorted((status, count) for status, count in snapshot["statuses"].items() if not status.startswith("2"))
+    if errors:
+        parts.append("errors " + " ".join("{}:{}".format(status, count) for status, count in errors))
+    if snapshot["eta_seconds"] is not None:
+        parts.append("ETA {}".format(format_duration(snapshot["eta_seconds"])))
+    return "Progress: " + " | ".join(parts)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+
+
+# Times the phases of a run profiled with --profile, from the time.perf_counter() reading taken at the start of each
+# phase. Durations are appended to arrays of the thread that timed them, so that timing a phase takes no lock, and
+# every 65536 of them they are sorted and folded into the count, total, maximum and histogram of the phase, with 10
+# buckets to a power of ten from 100 nanoseconds to 100 seconds; the percentiles reported are the upper bounds of
+# their buckets. With a stats path, cProfile also runs over the thread that started the profile, and its statistics
+# are saved there when it stops.
+#
+# The profile of the run in progress is the global PROFILE, which the phases of the updates time themselves against,
+# and which is None the rest of the time.
+class PhaseProfile(object):
+    PHASES = ("csv parsing", "validate_row", "preflight", "request building", "connection setup", "request sending",
+              "server time", "response reading", "response handling")
+    BUCKET_BOUNDS = tuple(1e-7 * 10 ** (bucket / 10) for bucket in range(91))
+    FOLD_DURATIONS = 1 << 16
+
+    def __init__(self, stats_path=None):
+        self.stats_path = stats_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.thread_durations = []
+        self.timings = {}
+        self.merged_stats = []
+        self.profiler = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        global PROFILE
+        self.started = time.perf_counter()
+        PROFILE = self
+        if self.stats_path is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def stop(self):
+        global PROFILE
+        if self.profiler is not None:
+            self.profiler.disable()
+            stats = pstats.Stats(self.profiler)
+            for merged_stats in self.merged_stats:
+                stats.add(merged_stats)
+            stats.dump_stats(self.stats_path)
+        if PROFILE is self:
+            PROFILE = None
+        self.elapsed = time.perf_counter() - self.started
+
+    def add(self, phase, started):
+        # Returns the end of the phase, which is the start of the next one when phases follow each other
+        now = time.perf_counter()
+        try:
+            durations = self.local.durations[phase]
+        except (AttributeError, KeyError):
+            durations = self.phase_durations(phase)
+        durations.append(now - started)
+        if len(durations) >= self.FOLD_DURATIONS:
+            self.merge({phase: self.timing(durations)})
+            del durations[:]
+        return now
+
+    def phase_durations(self, phase):
+        try:
+            thread_durations = self.local.durations
+        except AttributeError:
+            thread_durations = self.local.durations = {}
+            with self.lock:
+                self.thread_durations.append(thread_durations)
+        return thread_durations.setdefault(phase, array.array("d"))
+
+    def timed(self, phase, function):
+        def timed_function(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, started)
+        return timed_function
+
+    def timing(self, durations):
+        # The count, total, maximum and histogram of durations
+        durations = sorted(durations)
+        bucket_ends = [bisect.bisect_left(durations, bound) for bound in self.BUCKET_BOUNDS] + [len(durations)]
+        return [len(durations), sum(durations), durations[-1] if durations else 0.0,
+                [end - start for start, end in zip([0] + bucket_ends, bucket_ends)]]
+
+    def merge(self, timings, stats_path=None):
+        # Adds up timings by phase, such as those folded by a thread or those of another process running a shard of
+        # the same file, along with its cProfile statistics
+        with self.lock:
+            for phase, (count, total, longest, histogram) in (timings or {}).items():
+                timing = self.timings.setdefault(phase, [0, 0.0, 0.0, [0] * (len(self.BUCKET_BOUNDS) + 1)])
+                timing[0] += count
+                timing[1] += total
+                timing[2] = max(timing[2], longest)
+                timing[3] = [merged + counted for merged, counted in zip(timing[3], histogram)]
+        if stats_path is not None and self.profiler is not None and os.path.exists(stats_path):
+            self.merged_stats.append(pstats.Stats(stats_path))
+
+    def snapshot(self):
+        # The timings of every phase, with the durations that were not folded yet
+        with self.lock:
+            thread_durations = [dict(durations) for durations in self.thread_durations]
+        snapshot = PhaseProfile()
+        snapshot.merge(self.timings)
+        for durations in thread_durations:
+            snapshot.merge({phase: self.timing(phase_durations) for phase, phase_durations in durations.items()
+                            if phase_durations})
+        return snapshot.timings
+
+    def percentile(self, histogram, fraction):
+        target = fraction * sum(histogram)
+        seen = 0
+        for bucket, count in enumerate(histogram):
+            seen += count
+            if seen >= target:
+                break
+        return self.BUCKET_BOUNDS[bucket] if bucket < len(self.BUCKET_BOUNDS) else float("inf")
+
+    def summary(self):
+        timings = self.snapshot()
+        lines = ["Profile of the run, {:.3f}s in all, the phases of updates in flight at once overlap:".format(
+            self.elapsed if self.elapsed is not None else time.perf_counter() - self.started)]
+        lines.append("  {:18} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+            "phase", "count", "total", "mean", "p50", "p95", "p99", "max"))
+        for phase in sorted(timings, key=lambda phase: (self.PHASES + (phase,)).index(phase)):
+            count, total, longest, histogram = timings[phase]
+            lines.append("  {:18} {:9} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+                phase, count, format_phase_time(total), format_phase_time(total / count),
+                *[format_phase_time(min(longest, self.percentile(histogram, fraction)))
+                  for fraction in (0.50, 0.95, 0.99)] + [format_phase_time(longest)]))
+        if self.stats_path is not None:
+            lines.append("Saved the cProfile statistics of the run in '{}'".format(self.stats_path))
+        return lines
+
+
+PROFILE = None
+
+
+def format_phase_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * scale >= 1:
+            return "{:.{}f}{}".format(seconds * scale, 3 if unit == "s" else 1, unit)
+    return "{:.0f}ns".format(seconds * 1e9)
+
+
+def file_position(csv_file):
+    # The position of the operating system file, which runs at most a read-ahead buffer or two ahead of the rows
+    # parsed so far; plenty for an ETA, and safe to read from the reporting thread
+    try:
+        file_descriptor = csv_file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return lambda: os.lseek(file_descriptor, 0, os.SEEK_CUR)
+
+
+def file_size(csv_file_path):
+    try:
+        return os.path.getsize(csv_file_path)
+    except OSError:
+        return None
+
+
+# Runs each update as soon as it is submitted, so that sequential runs do not pay for a thread pool
+class InlineExecutor(object):
+    def submit(self, function, *args):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as exception:
+            future.set_exception(exception)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# Players waiting to be sent again after a transient failure, ordered by when they are due. The delay doubles with
+# every attempt, and is jittered so that players that failed together are not all retried together.
+class RetryScheduler(object):
+    def __init__(self, max_retries=5, backoff=0.5, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = []
+        self.scheduled = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def schedule(self, line_num, mac_address, attempt, retry_after=None):
+        if attempt > self.max_retries:
+            return False
+        if retry_after is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+            retry_after = delay / 2 + random.uniform(0, delay / 2)
+        self.scheduled += 1
+        heapq.heappush(self.queue, (time.monotonic() + retry_after, self.scheduled, line_num, mac_address,
+                                    attempt + 1))
+        return True
+
+    def pop_due(self):
+        if self.queue and self.queue[0][0] <= time.monotonic():
+            return heapq.heappop(self.queue)[2:]
+        return None
 
-            elif csv_data.line_num != 1:
-                print("Line {}: Warning: Column 1 does not contain a valid Mac Address".format(csv_data.line_num))
+    def wait_time(self):
+        if not self.queue:
+            return None
+        return max(0.0, self.queue[0][0] - time.monotonic())
+
+
+# A token bucket shared by every thread sending updates. It starts at max_rate requests per second (or unlimited).
+# When the API server answers 429 Too Many Requests, at most once a second, the rate drops to that of the updates the
+# server accepted over the last `window` seconds, and never below half the rate observed over them. It then climbs
+# back by `increase` times the rate it dropped to for every second without a 429, so the send rate settles around the
+# rate at which the server starts throttling, while a server throttling a steady share of the updates only slows the
+# run by that share. Retry-After pauses all sending.
+class RateLimiter(object):
+    def __init__(self, max_rate=None, burst=1, min_rate=0.1, increase=0.25, window=2.0):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.increase = increase
+        self.window = window
+        self.next_send = 0.0
+        self.paused_until = 0.0
+        self.last_throttled = None
+        # The requests per second added for every second without a 429, from when they were last added
+        self.step = 0.0
+        self.last_increase = None
+        self.recent_sends = collections.deque()
+        self.recent_throttles = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self):
+        # Takes the next send slot and returns how long to wait for it, for callers that cannot block while waiting
+        with self.lock:
+            now = time.monotonic()
+            send_at = max(now, self.paused_until)
+            if self.rate is not None:
+                send_at = max(send_at, self.next_send - (self.burst - 1) / self.rate)
+                self.next_send = max(self.next_send, send_at) + 1 / self.rate
+            self.recent_sends.append(send_at)
+            self.forget(now)
+        return send_at - now
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate is None or self.last_increase is None:
+                return
+            now = time.monotonic()
+            self.rate += self.step * (now - self.last_increase)
+            self.last_increase = now
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic()
+            self.recent_throttles.append(now)
+            self.forget(now)
+            # Updates that were in flight together are throttled together, only slow down once for all of them
+            if self.last_throttled is None or now - self.last_throttled >= 1.0:
+                self.last_throttled = now
+                observed = self.observed_rate(now)
+                accepted = observed * max(0.0, 1 - len(self.recent_throttles) / max(1, len(self.recent_sends)))
+                self.rate = max(self.min_rate, observed / 2, accepted)
+                self.step = self.increase * self.rate
+                self.last_increase = now
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def pause(self, retry_after):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def forget(self, now):
+        # Only the sends and 429s of the last `window` seconds are kept
+        for recent in (self.recent_sends, self.recent_throttles):
+            while recent and recent[0] < now - self.window:
+                recent.popleft()
+
+    def observed_rate(self, now):
+        # The requests per second sent over the last `window` seconds, or since the first request of a younger run
+        if len(self.recent_sends) < 2:
+            return self.rate if self.rate is not None else self.min_rate
+        span = max(now, self.recent_sends[-1]) - self.recent_sends[0]
+        return len(self.recent_sends) / (span if span > 0 else self.window)
+
+
+# Stops sending player updates while the API server is failing. Updates that failed for a reason worth a retry, other
+# than throttling which the RateLimiter deals with, and updates slower than max_latency count against the API server.
+# Once they make up more than error_rate of the at least min_requests updates completed in the last `window` seconds,
+# the breaker opens and nothing is sent for `pause` seconds. It is then half-open: updates are sent one at a time as
+# probes, and the first to fail opens it again. After `probes` healthy updates in a row it closes, with a quarter of
+# the concurrency at first, doubled every `window` seconds until it is back to the whole of it.
+class CircuitBreaker(object):
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+    def __init__(self, error_rate=0.5, max_latency=None, pause=10.0, window=30.0, min_requests=20, probes=3):
+        self.error_rate = error_rate
+        self.max_latency = max_latency
+        self.pause = pause
+        self.window = window
+        self.min_requests = min_requests
+        self.probes = probes
+        self.state = self.CLOSED
+        # The (completed at, unhealthy) outcome of the updates of the window
+        self.outcomes = collections.deque()
+        self.unhealthy = 0
+        self.opened_at = None
+        self.closed_at = None
+        self.healthy_probes = 0
+        self.lock = threading.Lock()
+
+    def record(self, failed, latency=None):
+        unhealthy = failed or (self.max_latency is not None and latency is not None and latency > self.max_latency)
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                # Updates sent before the breaker opened
+                return
+            if self.state == self.HALF_OPEN:
+                if unhealthy:
+                    self.open(now, "A probe update failed")
+                else:
+                    self.healthy_probes += 1
+                    if self.healthy_probes >= self.probes:
+                        self.state = self.CLOSED
+                        self.closed_at = now
+                        print("Resuming updates after {} healthy probe updates".format(self.healthy_probes),
+                              file=sys.stderr)
+                return
+
+            self.outcomes.append((now, unhealthy))
+            self.unhealthy += unhealthy
+            while self.outcomes[0][0] < now - self.window:
+                self.unhealthy -= self.outcomes.popleft()[1]
+            if len(self.outcomes) >= self.min_requests and self.unhealthy > self.error_rate * len(self.outcomes):
+                self.open(now, "{} of the last {} updates failed or were too slow".format(self.unhealthy,
+                                                                                          len(self.outcomes)))
+
+    def open(self, now, reason):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.outcomes.clear()
+        self.unhealthy = 0
+        print("Warning: {}, pausing updates for {:g} seconds".format(reason, self.pause), file=sys.stderr)
+
+    def limit(self, concurrency):
+        # How many updates may be in flight at the moment
+        with self.lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now < self.opened_at + self.pause:
+                    return 0
+                self.state = self.HALF_OPEN
+                self.healthy_probes = 0
+            if self.state == self.HALF_OPEN:
+                return 1
+            if self.closed_at is None:
+                return concurrency
+            steps = int((now - self.closed_at) / self.window)
+            if steps >= 2:
+                self.closed_at = None
+                return concurrency
+            return max(1, concurrency * 2 ** steps // 4)
+
+    def wait_time(self):
+        # How long until updates may be sent again while the breaker is open, None when it is not
+        with self.lock:
+            if self.state != self.OPEN:
+                return None
+            return max(0.0, self.opened_at + self.pause - time.monotonic())
+
+
+# Shares a number of request slots between the dispatchers of a campaign. A dispatcher waits for a slot before each
+# request and has at most one request waiting at a time, so handing freed slots out in the order they were asked for
+# serves the clients in turn. Dispatchers of the async engine wait for their turn without blocking their event loop.
+class FairShare(object):
+    def __init__(self, slots):
+        self.free = slots
+        self.waiting = collections.deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.free and not self.waiting:
+                self.free -= 1
+                return
+            turn = threading.Event()
+            self.waiting.append(turn.set)
+        turn.wait()
+
+    async def acquire_async(self, loop):
+        with self.lock:
+            if self.free and not self.waiting:
+                self.free -= 1
+                return
+            turn = loop.create_future()
+            self.waiting.append(functools.partial(loop.call_soon_threadsafe, turn.set_result, None))
+        await turn
+
+    def release(self, *future):
+        with self.lock:
+            if self.waiting:
+                # The slot goes straight to the next in line, so that a new request cannot take it first
+                self.waiting.popleft()()
+            else:
+                self.free += 1
+
+
+# Players that could not be updated, reported as they fail and optionally written to a csv file so that they can be
+# retried later
+class FailureReport(object):
+    COLUMNS = ["mac_address", "line", "status", "error", "message"]
+
+    def __init__(self, path=None):
+        self.count = 0
+        self.report_file = None
+        if path is not None:
+            self.report_file = open(path, "w", newline="")
+            self.writer = csv.writer(self.report_file)
+            self.writer.writerow(self.COLUMNS)
+
+    def add(self, line_num, mac_address, response_data):
+        self.count += 1
+        print("Line {}: Error: {error} [{statusCode}]: {message}".format(line_num, **response_data))
+        if self.report_file is not None:
+            self.writer.writerow([mac_address, line_num, response_data["statusCode"], response_data["error"],
+                                  response_data["message"]])
+
+    def close(self):
+        if self.report_file is not None:
+            self.report_file.close()
+
+
+# An append-only record of the final outcome of every player update: its line, MAC address, status (0 when the API
+# server could not be reached), number of attempts, the latency of its last attempt and when it was settled. Records
+# are of a fixed size, so that a journal of millions of players is read back in seconds, and go through a file buffer
+# flushed every flush_interval seconds rather than being written one by one.
+class Journal(object):
+    MAGIC = b"BPUJ"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHH")
+    RECORD = struct.Struct("<IQHHfd")
+
+    def __init__(self, path, flush_interval=1.0):
+        self.flush_interval = flush_interval
+        self.journal_file = open(path, "ab")
+        if self.journal_file.tell() == 0:
+            self.journal_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.RECORD.size))
+        else:
+            with open(path, "rb") as journal_file:
+                try:
+                    read_journal_header(journal_file)
+                except ValueError:
+                    self.journal_file.close()
+                    raise
+        self.flushed_at = time.monotonic()
+
+    def add(self, line_num, mac_address, status, attempts, latency=None, settled_at=None):
+        self.journal_file.write(self.RECORD.pack(line_num, int(mac_address.replace(":", ""), 16), status or 0,
+                                                 attempts, latency or 0.0,
+                                                 settled_at if settled_at is not None else time.time()))
+        now = time.monotonic()
+        if now - self.flushed_at >= self.flush_interval:
+            self.journal_file.flush()
+            self.flushed_at = now
+
+    def close(self):
+        self.journal_file.close()
+
+
+def read_journal_header(journal_file):
+    header = journal_file.read(Journal.HEADER.size)
+    if len(header) < Journal.HEADER.size:
+        raise ValueError("not a result journal")
+    magic, version, record_size = Journal.HEADER.unpack(header)
+    if magic != Journal.MAGIC:
+        raise ValueError("not a result journal")
+    if version != Journal.VERSION or record_size != Journal.RECORD.size:
+        raise ValueError("result journal of an unsupported version {}".format(version))
+
+
+# Reads the records of a result journal as blocks of (line, MAC address, status, attempts, latency, settled at)
+# columns. The MAC addresses are left as integers.
+def read_journal_columns(journal_path, block_records=1 << 16):
+    with open(journal_path, "rb") as journal_file:
+        read_journal_header(journal_file)
+        while True:
+            block = journal_file.read(Journal.RECORD.size * block_records)
+            # A run that was killed may have left a record half written
+            block = block[:len(block) - len(block) % Journal.RECORD.size]
+            if not block:
+                break
+            yield tuple(zip(*Journal.RECORD.iter_unpack(block)))
+
+
+def format_journal_mac_address(packed):
+    digits = "{:012x}".format(packed)
+    return ":".join((digits[0:2], digits[2:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12]))
+
+
+# Appends the journals of the shards of a run to its journal, with the line numbers of every shard moved on by the
+# number of lines in the shards before it
+def merge_journals(shard_journal_paths, line_offsets, journal_path):
+    journal = Journal(journal_path)
+    with closing(journal):
+        for shard_journal_path, line_offset in zip(shard_journal_paths, line_offsets):
+            if not os.path.isfile(shard_journal_path):
+                continue
+            for columns in read_journal_columns(shard_journal_path):
+                for record in zip(*columns):
+                    journal.journal_file.write(Journal.RECORD.pack(record[0] + line_offset, *record[1:]))
+
+
+# Writes every line printed by a thread after the prefix that thread set, so that the messages of the clients of a
+# campaign can be told apart
+class PrefixedOutput(object):
+    def __init__(self, output):
+        self.output = output
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+
+    def write(self, text):
+        lines = (getattr(self.local, "pending", "") + text).split("\n")
+        self.local.pending = lines.pop()
+        if lines:
+            prefix = getattr(self.local, "prefix", "")
+            with self.lock:
+                self.output.write("".join(prefix + line + "\n" for line in lines))
+        return len(text)
+
+    def flush(self):
+        self.output.flush()
+
+
+# Updates the players of the csv files submitted over a UNIX socket, one at a time, from a process that stays up
+# between them. Each connection sends the path of a csv file and optionally a client id, separated by a NUL, on one
+# line. The run is then answered with what it prints, as "out <line>" and "err <line>" lines, and finally with
+# "exit <code>", the code that a run of the script would have exited with. The token and connections to the API server
+# are those of the process, so they are kept from one file to the next.
+class UpgradeServer(object):
+    def __init__(self, socket_path, client_id, applications, token, **options):
+        self.socket_path = socket_path
+        self.client_id = client_id
+        self.applications = applications
+        self.token = token
+        self.options = options
+        self.listener = None
+
+    def listen(self, backlog=64):
+        if os.path.exists(self.socket_path):
+            if not stat.S_ISSOCK(os.stat(self.socket_path).st_mode):
+                raise FileExistsError(17, "a file that is not a socket is in the way")
+            # A socket left behind by a process that is no longer running refuses connections, and is replaced
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as probe:
+                try:
+                    probe.connect(self.socket_path)
+                except ConnectionRefusedError:
+                    os.unlink(self.socket_path)
+                else:
+                    raise FileExistsError(17, "another process is accepting csv files on it")
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(self.socket_path)
+            listener.listen(backlog)
+        except BaseException:
+            listener.close()
+            raise
+        self.listener = listener
+
+    def serve_forever(self):
+        while True:
+            self.handle_next()
+
+    def handle_next(self):
+        connection = self.listener.accept()[0]
+        with closing(connection):
+            request = connection.makefile("rb").readline().decode("utf-8").rstrip("\n")
+            if not request:
+                return
+            csv_file_path, _, client_id = request.partition("\0")
+            answer = ServedOutput(connection)
+            code = self.run(csv_file_path, client_id or self.client_id, answer)
+            answer.finish(code)
+
+    def run(self, csv_file_path, client_id, answer):
+        with redirect_stdout(answer.stream("out")), redirect_stderr(answer.stream("err")):
+            try:
+                if not os.path.isfile(csv_file_path):
+                    print("File not found: '{}'".format(csv_file_path), file=sys.stderr)
+                    return 1
+                process_csv(csv_file_path, client_id, self.applications, self.token, **self.options)
+            except SystemExit as exit:
+                if exit.code is None or isinstance(exit.code, int):
+                    return exit.code or 0
+                print(exit.code, file=sys.stderr)
+                return 1
+            except Exception as run_error:
+                # The process keeps on serving the files submitted after this one
+                print("Error: {!r}".format(run_error), file=sys.stderr)
+                return 1
+        return 0
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.socket_path)
+            except FileNotFoundError:
+                pass
+
+
+# Sends the lines printed by a served run to the process that submitted its csv file, prefixed with the stream they
+# were printed on. A process that went away does not stop the run, what is printed afterwards is dropped.
+class ServedOutput(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.connected = True
+
+    def stream(self, kind):
+        self.pending[kind] = ""
+        return ServedStream(self, kind)
+
+    def write(self, kind, text):
+        with self.lock:
+            lines = (self.pending[kind] + text).split("\n")
+            self.pending[kind] = lines.pop()
+            if lines:
+                self.send("".join("{} {}\n".format(kind, line) for line in lines))
+
+    def finish(self, code):
+        with self.lock:
+            self.send("".join("{} {}\n".format(kind, line) for kind, line in sorted(self.pending.items()) if line) +
+                      "exit {}\n".format(code))
+            self.pending = dict.fromkeys(self.pending, "")
+
+    def send(self, text):
+        if self.connected:
+            try:
+                self.connection.sendall(text.encode("utf-8"))
+            except OSError:
+                self.connected = False
+
+
+class ServedStream(object):
+    def __init__(self, output, kind):
+        self.output = output
+        self.kind = kind
+
+    def write(self, text):
+        self.output.write(self.kind, text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+# Validates every row of a csv file, or of the byte range of it from `offset` to `end`, before any player is updated.
+# The file is read in large chunks, and the first columns of a block of rows are checked and packed into integers
+# with a few calls over the whole block; only blocks with an invalid row in them are checked row by row. Invalid rows
+# are reported and duplicates counted as the file is scanned, and the players to update are written to a work file,
+# which is then read back by iterating over the Preflight. While it is read back, `offset` and `line_num` are those of
+# the last player read, as with OffsetLines. The line numbers at the byte offsets given as `boundaries`, which must be
+# the starts of lines, are recorded in `boundary_lines` as the file is scanned.
+#
+# The work file is made of one block per chunk of the csv file: the number of players in the block, then arrays of
+# their MAC addresses, of their line numbers and of the byte offsets of the ends of their lines.
+class Preflight(object):
+    CHUNK_SIZE = 1 << 22
+    BLOCK_SIZE = 4096
+
+    def __init__(self, csv_file_path, work_path=None, offset=0, end=None, line_num=0, header_line=1,
+                 encoding=None, show_invalid=True, boundaries=()):
+        self.csv_file_path = csv_file_path
+        self.work_path = work_path
+        self.offset = offset
+        self.end = end
+        self.line_num = line_num
+        self.header_line = header_line
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.show_invalid = show_invalid
+        self.rows = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.players = 0
+        self.end_offset = offset
+        self.end_line_num = line_num
+        self.boundaries = sorted(set(boundaries))
+        self.boundary_lines = {boundary: line_num for boundary in self.boundaries if boundary == offset}
+        self.seen = None
+
+    def run(self):
+        self.seen = set()
+        with ExitStack() as files:
+            csv_file = files.enter_context(open(self.csv_file_path, "rb"))
+            work_file = files.enter_context(open(self.work_path, "wb")) if self.work_path is not None else None
+            csv_file.seek(self.offset)
+            remaining = self.end - self.offset if self.end is not None else None
+            partial = b""
+            while remaining is None or remaining > 0:
+                chunk = csv_file.read(self.CHUNK_SIZE if remaining is None else min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                lines = (partial + chunk).split(b"\n")
+                partial = lines.pop()
+                if lines:
+                    self.scan(lines, work_file, terminated=True)
+            if partial:
+                self.scan([partial], work_file, terminated=False)
+        # The MAC addresses seen are only needed to find duplicates
+        self.seen = None
+        return self
+
+    def scan(self, lines, work_file, terminated=True):
+        line_ends = list(itertools.accumulate(itertools.chain([self.end_offset], [len(line) + 1 for line in lines])))
+        del line_ends[0]
+        if not terminated:
+            line_ends[-1] -= 1
+        first_line = self.end_line_num + 1
+        first_columns = [line.partition(b",")[0] for line in lines]
+        packed = array.array("Q")
+        line_nums = array.array("I")
+        offsets = array.array("Q")
+        for start in range(0, len(lines), self.BLOCK_SIZE):
+            stop = min(start + self.BLOCK_SIZE, len(lines))
+            mac_addresses = pack_mac_addresses(first_columns[start:stop])
+            if mac_addresses is not None:
+                indexes = range(start, stop)
+            else:
+                indexes, mac_addresses = self.pack_rows(lines, first_columns, start, stop, first_line)
+            indexes, mac_addresses = self.skip_duplicates(indexes, mac_addresses)
+            packed.extend(mac_addresses)
+            if isinstance(indexes, range):
+                line_nums.extend(range(first_line + indexes.start, first_line + indexes.stop))
+                offsets.extend(line_ends[indexes.start:indexes.stop])
+            else:
+                line_nums.extend([first_line + index for index in indexes])
+                offsets.extend([line_ends[index] for index in indexes])
+
+        for boundary in self.boundaries:
+            if self.end_offset <= boundary <= line_ends[-1]:
+                self.boundary_lines[boundary] = self.end_line_num + bisect.bisect_right(line_ends, boundary)
+        self.rows += len(lines)
+        self.players += len(line_nums)
+        self.end_offset = line_ends[-1]
+        self.end_line_num += len(lines)
+        if work_file is not None and line_nums:
+            work_file.write(struct.pack("<I", len(line_nums)))
+            packed.tofile(work_file)
+            line_nums.tofile(work_file)
+            offsets.tofile(work_file)
+
+    def pack_rows(self, lines, first_columns, start, stop, first_line):
+        # Checks a block with an invalid row in it, returning the indexes and packed MAC addresses of its valid rows.
+        # The rows that look like colon separated MAC addresses are still checked all at once, and the others one by
+        # one.
+        shaped = [index for index in range(start, stop)
+                  if len(first_columns[index]) == 17 and first_columns[index][2::3] == b":::::"]
+        mac_addresses = pack_mac_addresses([first_columns[index] for index in shaped])
+        if mac_addresses is None:
+            shaped, mac_addresses = [], []
+        others = []
+        for index in sorted(set(range(start, stop)).difference(shaped)):
+            mac_address = self.pack_row(lines[index])
+            if mac_address is not None:
+                others.append((index, mac_address))
+            elif first_line + index != self.header_line:
+                self.invalid += 1
+                if self.show_invalid:
+                    print("Line {}: Warning: Column 1 does not contain a valid Mac Address".format(first_line + index))
+        if not others:
+            return shaped, mac_addresses
+        rows = sorted(list(zip(shaped, mac_addresses)) + others)
+        return [index for index, mac_address in rows], [mac_address for index, mac_address in rows]
+
+    def pack_row(self, line):
+        # Rows whose first column is not a MAC address in the usual format, such as quoted ones, are parsed as csv
+        row = next(csv.reader([line.decode(self.encoding, "replace")]), [])
+        if not validate_row(row):
+            return None
+        return int.from_bytes(pack_mac_address(normalize_mac_address(row[0])), "big")
+
+    def skip_duplicates(self, indexes, mac_addresses):
+        unique = set(mac_addresses)
+        if len(unique) == len(mac_addresses) and self.seen.isdisjoint(unique):
+            self.seen |= unique
+            return indexes, mac_addresses
+        kept_indexes = []
+        kept = []
+        for index, mac_address in zip(indexes, mac_addresses):
+            if mac_address in self.seen:
+                self.duplicates += 1
+                continue
+            self.seen.add(mac_address)
+            kept_indexes.append(index)
+            kept.append(mac_address)
+        return kept_indexes, kept
+
+    def summary(self):
+        return ("Pre-flight check: {} rows read, {} valid, {} without a valid Mac Address, {} duplicates, {} players "
+                "to update".format(self.rows, self.players + self.duplicates, self.invalid, self.duplicates,
+                                   self.players))
+
+    def __iter__(self):
+        for line_num, mac_address, offset in self.read_players():
+            self.line_num, self.offset = line_num, offset
+            yield line_num, mac_address
+        self.offset, self.line_num = self.end_offset, self.end_line_num
+
+    def read_players(self, start=None, end=None):
+        # The line number, MAC address and line end offset of the players in the work file, or of those whose lines
+        # end after `start` and at or before `end`; the Mac Addresses of the blocks outside of that range are never
+        # decoded
+        with open(self.work_path, "rb") as work_file:
+            while True:
+                header = work_file.read(4)
+                if not header:
+                    break
+                count, = struct.unpack("<I", header)
+                mac_addresses, line_nums, offsets = array.array("Q"), array.array("I"), array.array("Q")
+                for column in (mac_addresses, line_nums, offsets):
+                    column.frombytes(work_file.read(column.itemsize * count))
+                if start is not None and offsets[-1] <= start:
+                    continue
+                if end is not None and offsets[0] > end:
+                    break
+                # The hex digits of the whole block at once, 16 per Mac Address of which the first 4 are padding
+                if sys.byteorder == "little":
+                    mac_addresses.byteswap()
+                digits = binascii.hexlify(mac_addresses.tobytes()).decode("ascii")
+                for index, line_num, offset in zip(range(4, 16 * count, 16), line_nums, offsets):
+                    if start is not None and offset <= start:
+                        continue
+                    if end is not None and offset > end:
+                        return
+                    yield line_num, ":".join((digits[index:index + 2], digits[index + 2:index + 4],
+                                              digits[index + 4:index + 6], digits[index + 6:index + 8],
+                                              digits[index + 8:index + 10], digits[index + 10:index + 12])), offset
+
+
+# The players of the shard of a file from `start` to `end`, read from the work file of a Preflight of the whole file
+# rather than from the file itself, so that a player listed in more than one shard is only updated once. Like the
+# rows read by the shard itself, they are numbered from the start of the shard, and reading starts after `offset` and
+# `line_num`, those of a checkpoint. While they are read, `offset` and `line_num` are those of the last player read,
+# as with OffsetLines.
+class PreflightShard(object):
+    def __init__(self, preflight, start, end, offset=None, line_num=0):
+        self.preflight = preflight
+        self.end = end
+        self.offset = start if offset is None else offset
+        self.line_num = line_num
+        self.first_line = preflight.boundary_lines[start]
+        self.end_line_num = preflight.boundary_lines.get(end, preflight.end_line_num) - self.first_line
+
+    def __iter__(self):
+        for line_num, mac_address, offset in self.preflight.read_players(self.offset, self.end):
+            self.line_num, self.offset = line_num - self.first_line, offset
+            yield self.line_num, mac_address
+        self.offset = self.end if self.end is not None else self.preflight.end_offset
+        self.line_num = self.end_line_num
+
+
+# Decodes the lines of a csv file opened in binary, keeping count of the bytes and lines read so far
+class OffsetLines(object):
+    def __init__(self, binary_file, offset=0, line_num=0, encoding=None, end=None):
+        self.binary_file = binary_file
+        self.offset = offset
+        self.line_num = line_num
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self.end = end
+
+    def __iter__(self):
+        for line in self.binary_file:
+            # Lines starting at or after the end offset belong to the next shard of the file
+            if self.end is not None and self.offset >= self.end:
+                return
+            self.offset += len(line)
+            self.line_num += 1
+            yield line.decode(self.encoding)
+
+
+# Records the byte offset and line number of the last acknowledged row of a csv file. Updates can complete out of
+# order, so the recorded row is the last one before which every row has been acknowledged.
+class Checkpoint(object):
+    def __init__(self, path, every=1000, offset=0):
+        self.path = path
+        self.every = every
+        self.offset = offset
+        self.line_num = 0
+        self.pending = collections.OrderedDict()
+        self.acknowledged = set()
+        self.unsaved = 0
+
+    def load(self):
+        if os.path.isfile(self.path):
+            with open(self.path) as checkpoint_file:
+                offset, line_num = checkpoint_file.read().split()
+            self.offset, self.line_num = int(offset), int(line_num)
+
+    def track(self, players, csv_lines):
+        for line_num, mac_address in players:
+            self.pending[line_num] = csv_lines.offset
+            yield line_num, mac_address
+
+    def acknowledge(self, line_num, succeeded=True):
+        # Players that could not be updated are in the failure report, so a resumed run moves past them as well
+        self.acknowledged.add(line_num)
+        while self.pending and next(iter(self.pending)) in self.acknowledged:
+            self.line_num, self.offset = self.pending.popitem(last=False)
+            self.acknowledged.remove(self.line_num)
+            self.unsaved += 1
+        if self.unsaved >= self.every:
+            self.save()
+
+    def complete(self, offset, line_num):
+        self.offset, self.line_num = offset, line_num
+        self.save()
+
+    def save(self):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as checkpoint_file:
+            checkpoint_file.write("{} {}\n".format(self.offset, self.line_num))
+        os.replace(temporary_path, self.path)
+        self.unsaved = 0
+
+
+# Records, in a sqlite database, which players were successfully upgraded to which application versions, so that
+# running the same upgrade again skips them. Entries are keyed on (MAC address, client id, hash of the application
+# versions), so look-ups are a single primary key search.
+class UpgradeIndex(object):
+    def __init__(self, path, client_id, applications, commit_every=1000):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS upgrades ("
+                                "mac_address BLOB NOT NULL, "
+                                "client_id TEXT NOT NULL, "
+                                "applications_hash BLOB NOT NULL, "
+                                "upgraded_at REAL NOT NULL, "
+                                "PRIMARY KEY (mac_address, client_id, applications_hash)) WITHOUT ROWID")
+        self.client_id = client_id
+        self.applications_hash = hash_applications(applications)
+        self.commit_every = commit_every
+        self.pending = {}
+        self.upgraded = []
+
+    def is_upgraded(self, mac_address):
+        cursor = self.connection.execute("SELECT 1 FROM upgrades "
+                                         "WHERE mac_address = ? AND client_id = ? AND applications_hash = ?",
+                                         (pack_mac_address(mac_address), self.client_id, self.applications_hash))
+        return cursor.fetchone() is not None
+
+    def skip_upgraded(self, players, skipped):
+        for line_num, mac_address in players:
+            if self.is_upgraded(mac_address):
+                skipped["upgraded"] += 1
+                continue
+            self.pending[line_num] = mac_address
+            yield line_num, mac_address
+
+    def acknowledge(self, line_num, succeeded=True):
+        mac_address = self.pending.pop(line_num)
+        if not succeeded:
+            return
+        self.upgraded.append((pack_mac_address(mac_address), self.client_id, self.applications_hash, time.time()))
+        if len(self.upgraded) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        # Upgrades are written in one go, so that the shards of a run sharing the index only hold its write lock
+        # for as long as a single insert of many rows takes
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO upgrades VALUES (?, ?, ?, ?)", self.upgraded)
+        self.upgraded = []
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+# Looks up the versions of the applications that players are on, so that only the players with at least one
+# application on another version than the target one are updated. Profiles are fetched from the bulk endpoint of the
+# API server a chunk of players at a time, the next chunk being fetched while the players of the current one are
+# updated. Players whose profile could not be fetched are updated anyway.
+class ProfileDiff(object):
+    def __init__(self, client_id, applications, token, cache=None, concurrency=1, bulk_endpoint="/profiles",
+                 fetch_size=100):
+        self.client_id = client_id
+        self.versions = {application["applicationId"]: application["version"] for application in applications}
+        self.token = token
+        self.cache = cache
+        self.concurrency = concurrency
+        self.bulk_endpoint = bulk_endpoint
+        self.fetch_size = fetch_size
+        self.bulk_available = True
+        self.pending = {}
+
+    def skip_current(self, players, skipped, acknowledgers=()):
+        players = iter(players)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as fetcher:
+            chunk, fetching = self.fetch_chunk(players, fetcher)
+            while chunk:
+                versions = self.fetched_versions(fetcher, *fetching)
+                # The profiles of the next chunk are fetched while the players of this one are updated
+                next_chunk, fetching = self.fetch_chunk(players, fetcher)
+                for line_num, mac_address in chunk:
+                    if self.is_current(versions.get(mac_address)):
+                        skipped["current"] += 1
+                        for acknowledge in acknowledgers:
+                            acknowledge(line_num, True)
+                        continue
+                    self.pending[line_num] = mac_address, versions.get(mac_address)
+                    yield line_num, mac_address
+                chunk = next_chunk
+
+    def fetch_chunk(self, players, fetcher):
+        chunk = list(itertools.islice(players, self.fetch_size))
+        mac_addresses = [mac_address for line_num, mac_address in chunk]
+        versions = self.cache.get(mac_addresses) if self.cache is not None else {}
+        missing = [mac_address for mac_address in mac_addresses if mac_address not in versions]
+        if not missing:
+            futures = []
+        elif self.bulk_available:
+            futures = [fetcher.submit(self.fetch_profiles, missing)]
+        else:
+            futures = [fetcher.submit(self.fetch_profile, mac_address) for mac_address in missing]
+        return chunk, (versions, missing, futures)
+
+    def fetched_versions(self, fetcher, versions, missing, futures):
+        for future in futures:
+            fetched = future.result()
+            if fetched is None:
+                self.fall_back_to_single_fetches()
+                fetched = {}
+                for single_future in [fetcher.submit(self.fetch_profile, mac_address) for mac_address in missing]:
+                    fetched.update(single_future.result())
+            if self.cache is not None:
+                for mac_address, fetched_versions in fetched.items():
+                    self.cache.add(mac_address, fetched_versions)
+            versions.update(fetched)
+        return versions
+
+    def fetch_profiles(self, mac_addresses):
+        # Returns the versions of the players whose profile was fetched, or None if there is no bulk endpoint
+        try:
+            response = fetch_player_profiles(self.client_id, mac_addresses, current_token(self.token),
+                                             self.bulk_endpoint)
+        except error.HTTPError as http_error:
+            return None if http_error.code in BULK_UNAVAILABLE_STATUSES else {}
+        except (error.URLError, http.client.HTTPException, OSError):
+            return {}
+        response_status = getattr(response, "status", None) or response.code
+        if response_status in BULK_UNAVAILABLE_STATUSES:
+            return None
+        if response_status > 399:
+            return {}
+        try:
+            profiles = json.loads(read_response_body(response))["profiles"]
+            return {profile["id"].split(":", 1)[1]: read_profile_versions(profile["profile"])
+                    for profile in profiles}
+        except (TypeError, ValueError, KeyError, AttributeError, IndexError):
+            return {}
+
+    def fetch_profile(self, mac_address):
+        try:
+            response = fetch_player_profile(self.client_id, mac_address, current_token(self.token))
+            if (getattr(response, "status", None) or response.code) > 399:
+                return {}
+            return {mac_address: read_profile_versions(json.loads(read_response_body(response))["profile"])}
+        except (error.URLError, http.client.HTTPException, OSError, TypeError, ValueError, KeyError,
+                AttributeError):
+            return {}
+
+    def fall_back_to_single_fetches(self):
+        if self.bulk_available:
+            self.bulk_available = False
+            print("Warning: The API server has no bulk endpoint at '{}' to fetch profiles from, profiles will be "
+                  "fetched one at a time".format(self.bulk_endpoint))
+
+    def is_current(self, versions):
+        if versions is None:
+            return False
+        return all(versions.get(application_id) == version for application_id, version in self.versions.items())
+
+    def acknowledge(self, line_num, succeeded=True):
+        mac_address, versions = self.pending.pop(line_num)
+        if succeeded and self.cache is not None:
+            upgraded_versions = dict(versions or {})
+            upgraded_versions.update(self.versions)
+            self.cache.add(mac_address, upgraded_versions)
+
+
+def read_profile_versions(profile):
+    return {application["applicationId"]: application.get("version")
+            for application in profile.get("applications", [])}
+
+
+# Keeps the application versions of the player profiles fetched by a run in a sqlite database, along with the new
+# versions of the players it updated, so that a run started again within `ttl` seconds does not fetch them again
+class ProfileCache(object):
+    def __init__(self, path, client_id, ttl=3600.0, commit_every=1000):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS profiles ("
+                                "mac_address BLOB NOT NULL, "
+                                "client_id TEXT NOT NULL, "
+                                "versions TEXT NOT NULL, "
+                                "fetched_at REAL NOT NULL, "
+                                "PRIMARY KEY (mac_address, client_id)) WITHOUT ROWID")
+        self.client_id = client_id
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.added = []
+
+    def get(self, mac_addresses):
+        packed_mac_addresses = {pack_mac_address(mac_address): mac_address for mac_address in mac_addresses}
+        if not packed_mac_addresses:
+            return {}
+        cursor = self.connection.execute("SELECT mac_address, versions FROM profiles "
+                                         "WHERE client_id = ? AND fetched_at >= ? AND mac_address IN ({})"
+                                         .format(", ".join("?" * len(packed_mac_addresses))),
+                                         [self.client_id, time.time() - self.ttl] + list(packed_mac_addresses))
+        return {packed_mac_addresses[bytes(mac_address)]: json.loads(versions) for mac_address, versions in cursor}
+
+    def add(self, mac_address, versions):
+        self.added.append((pack_mac_address(mac_address), self.client_id, json.dumps(versions, sort_keys=True),
+                           time.time()))
+        if len(self.added) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?)", self.added)
+        self.added = []
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def hash_applications(applications):
+    encoded_applications = json.dumps(applications, sort_keys=True).encode("utf8")
+    return hashlib.sha1(encoded_applications).digest()[:8]
+
+
+def pack_mac_address(mac_address):
+    return bytes.fromhex(mac_address.replace(":", ""))
 
 
 def validate_row(row):
     if len(row) == 0:
         return False
-    return hasattr(re.match("^([0-9|A-F]{2}:){5}[0-9|A-F]{2}$", row[0], re.I), "groups")
+    return MAC_ADDRESS_PATTERN.match(row[0]) is not None
+
+
+def validate_rows(rows):
+    # Validates a whole chunk of rows in one call, returning the normalized MAC address of each valid row and None
+    # for each invalid one
+    match = MAC_ADDRESS_PATTERN.match
+    return [normalize_mac_address(row[0]) if row and match(row[0]) else None for row in rows]
+
+
+def pack_mac_addresses(first_columns):
+    # Packs the first columns of a block of rows into an array of MAC addresses as 48 bit integers, if every one of
+    # them is a MAC address written in the same way so that the block can be checked as a whole, and returns None
+    # otherwise
+    block = b"\n".join(first_columns) + b"\n"
+    if b"\r" in block:
+        block = block.replace(b"\r\n", b"\n")
+    rows = len(first_columns)
+    for length, spacing, separators in MAC_ADDRESS_BLOCK_FORMATS:
+        if len(block) == length * rows and block[spacing - 1::spacing] == separators * rows:
+            # Every MAC address is padded to the 16 hex digits of an unsigned 64 bit integer
+            digits = (b"0000" + block[:-1].replace(b"\n", b"\n0000")).translate(None, b":-.\n")
+            if len(digits) != 16 * rows:
+                return None
+            mac_addresses = array.array("Q")
+            try:
+                mac_addresses.frombytes(binascii.unhexlify(digits))
+            except binascii.Error:
+                return None
+            if sys.byteorder == "little":
+                mac_addresses.byteswap()
+            return mac_addresses
+    return None
+
+
+def normalize_mac_address(mac_address):
+    # Valid MAC addresses are all sent to the API server as lower case, colon separated pairs of hex digits
+    if len(mac_address) == 17 and mac_address[2] == ":":
+        return mac_address.lower()
+    digits = mac_address.translate(MAC_ADDRESS_SEPARATORS).lower()
+    return ":".join((digits[0:2], digits[2:4], digits[4:6], digits[6:8], digits[8:10], digits[10:12]))
 
 
 def update_player_profile(client_id, mac_address, applications, token):
-    request_url = "{}/profiles/clientId:{}".format(API_SERVER_BASE_URL, mac_address)
-    request_data = bytes(json.dumps({"profile": {"applications": applications}}), encoding='utf8')
-    request_headers = {"Content-Type": "application/json", "x-client-id": client_id, "x-authentication-token": token}
+    update_request = profile_request_template(client_id, applications, token).build(mac_address)
+    response = connection_pool_opener().open(update_request)
+
+    return response
+
+
+def update_player_profiles(client_id, mac_addresses, applications, token, bulk_endpoint="/profiles"):
+    update_request = profile_request_template(client_id, applications, token).build_bulk(mac_addresses,
+                                                                                         bulk_endpoint)
+    response = connection_pool_opener().open(update_request)
+
+    return response
+
+
+async def update_player_profile_async(http_client, client_id, mac_address, applications, token):
+    update_request = profile_request_template(client_id, applications, token).build(mac_address)
+    response = await http_client.urlopen(update_request)
+
+    return response
+
+
+async def update_player_profiles_async(http_client, client_id, mac_addresses, applications, token,
+                                       bulk_endpoint="/profiles"):
+    update_request = profile_request_template(client_id, applications, token).build_bulk(mac_addresses,
+                                                                                         bulk_endpoint)
+    response = await http_client.urlopen(update_request)
+
+    return response
+
+
+# Sends player updates to the API server with the functions above
+class NetworkTransport(object):
+    def update_player_profile(self, client_id, mac_address, applications, token):
+        return update_player_profile(client_id, mac_address, applications, token)
+
+    def update_player_profiles(self, client_id, mac_addresses, applications, token, bulk_endpoint="/profiles"):
+        return update_player_profiles(client_id, mac_addresses, applications, token, bulk_endpoint)
+
+    async def update_player_profile_async(self, http_client, client_id, mac_address, applications, token):
+        return await update_player_profile_async(http_client, client_id, mac_address, applications, token)
+
+    async def update_player_profiles_async(self, http_client, client_id, mac_addresses, applications, token,
+                                           bulk_endpoint="/profiles"):
+        return await update_player_profiles_async(http_client, client_id, mac_addresses, applications, token,
+                                                  bulk_endpoint)
+
+
+# Builds every player update as a run would, but answers it itself instead of sending it to the API server: with a
+# success straight away, or after a fixed latency. A status of 0 stands for a connection error, as in the journal.
+class DryRunTransport(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def update_player_profile(self, client_id, mac_address, applications, token):
+        update_request = profile_request_template(client_id, applications, token).build(mac_address)
+        delay, statuses = self.answer([mac_address])
+        if delay:
+            time.sleep(delay)
+        return self.respond(update_request, [mac_address], statuses)
+
+    def update_player_profiles(self, client_id, mac_addresses, applications, token, bulk_endpoint="/profiles"):
+        update_request = profile_request_template(client_id, applications, token).build_bulk(mac_addresses,
+                                                                                             bulk_endpoint)
+        delay, statuses = self.answer(mac_addresses)
+        if delay:
+            time.sleep(delay)
+        return self.respond(update_request, mac_addresses, statuses, bulk=True)
 
-    update_request = request.Request(request_url, data=request_data, method="PUT", headers=request_headers)
-    response = request.urlopen(update_request)
+    async def update_player_profile_async(self, http_client, client_id, mac_address, applications, token):
+        update_request = profile_request_template(client_id, applications, token).build(mac_address)
+        delay, statuses = self.answer([mac_address])
+        if delay:
+            await asyncio.sleep(delay)
+        return self.respond(update_request, [mac_address], statuses)
+
+    async def update_player_profiles_async(self, http_client, client_id, mac_addresses, applications, token,
+                                           bulk_endpoint="/profiles"):
+        update_request = profile_request_template(client_id, applications, token).build_bulk(mac_addresses,
+                                                                                             bulk_endpoint)
+        delay, statuses = self.answer(mac_addresses)
+        if delay:
+            await asyncio.sleep(delay)
+        return self.respond(update_request, mac_addresses, statuses, bulk=True)
+
+    def answer(self, mac_addresses):
+        # The latency of the request and the status of the update of each player
+        return self.latency, [200] * len(mac_addresses)
+
+    @staticmethod
+    def respond(update_request, mac_addresses, statuses, bulk=False):
+        # Connection errors fail a whole request, other statuses of a bulk request are given player by player
+        if 0 in statuses:
+            raise error.URLError("dry run connection error")
+        headers = http.client.HTTPMessage()
+        headers["Content-Type"] = "application/json"
+        if bulk:
+            status = 200
+            body = {"results": [dict(dry_run_error(result_status), id="clientId:{}".format(mac_address))
+                                for mac_address, result_status in zip(mac_addresses, statuses)]}
+        else:
+            status = statuses[0]
+            body = dry_run_error(status) if status > 399 else {"profile": {}}
+        reason = http.client.responses.get(status, "Error")
+        response = PooledResponse(json.dumps(body).encode("utf8"), headers, update_request.full_url, status, reason)
+        if status > 399:
+            raise error.HTTPError(update_request.full_url, status, reason, headers, response)
+        return response
+
+
+def dry_run_error(status):
+    return {"statusCode": status, "error": http.client.responses.get(status, "Error"), "message": "dry run"}
+
+
+# A dry run answering every player update with the status and after the latency recorded for that player in a result
+# journal, so that the timing of an earlier run can be played again without the API server. An update that took
+# several attempts fails as many times first, with its final status when that is worth a retry and with 503 otherwise,
+# and one that failed in the end keeps failing. Players missing from the journal succeed after the median latency of
+# the journal.
+class ReplayTransport(DryRunTransport):
+    def __init__(self, journal_path):
+        self.recorded = {}
+        latencies = array.array("f")
+        for line_nums, mac_addresses, statuses, attempts, block_latencies, settled in \
+                read_journal_columns(journal_path):
+            # A player recorded by several runs is replayed as in the last of them
+            self.recorded.update(zip(mac_addresses, zip(statuses, attempts, block_latencies)))
+            latencies.extend(block_latencies)
+        super().__init__(sorted(latencies)[len(latencies) // 2] if latencies else 0.0)
+        self.sent = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Worker processes count the attempts of their own players
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def answer(self, mac_addresses):
+        delay = 0.0
+        statuses = []
+        for mac_address in mac_addresses:
+            packed = int(mac_address.replace(":", ""), 16)
+            status, attempts, latency = self.recorded.get(packed, (200, 1, self.latency))
+            with self.lock:
+                self.sent[packed] += 1
+                attempt = self.sent[packed]
+            if attempt < attempts and status != 0 and status not in RETRYABLE_STATUSES:
+                status = 503
+            statuses.append(status)
+            delay = max(delay, latency)
+        return delay, statuses
+
+
+def fetch_player_profile(client_id, mac_address, token):
+    fetch_request = request.Request("{}/profiles/clientId:{}".format(API_SERVER_BASE_URL, mac_address),
+                                    headers={"X-client-id": client_id, "X-authentication-token": token})
+    response = connection_pool_opener().open(fetch_request)
 
     return response
 
 
+def fetch_player_profiles(client_id, mac_addresses, token, bulk_endpoint="/profiles"):
+    profile_ids = ",".join("clientId:{}".format(mac_address) for mac_address in mac_addresses)
+    fetch_request = request.Request("{}{}?ids={}".format(API_SERVER_BASE_URL, bulk_endpoint, profile_ids),
+                                    headers={"X-client-id": client_id, "X-authentication-token": token})
+    response = connection_pool_opener().open(fetch_request)
+
+    return response
+
+
+# The body and headers of a profile update are the same for every player of a run, only the MAC address in the url
+# changes, so they are serialized once when the template is created instead of for every row
+class ProfileRequestTemplate(object):
+    def __init__(self, client_id, applications, token):
+        self.client_id = client_id
+        self.token = token
+        self.applications = json.loads(json.dumps(applications))
+        profile = json.dumps({"applications": applications})
+        self.data = bytes('{{"profile": {}}}'.format(profile), encoding='utf8')
+        self.bulk_item_suffix = bytes('", "profile": {}}}'.format(profile), encoding='utf8')
+        # Header names are stored in the capitalized form that Request.add_header would give them
+        self.headers = {"Content-type": "application/json", "X-client-id": client_id,
+                        "X-authentication-token": token}
+        self.base_url = None
+        self.origin_req_host = None
+
+    def matches(self, client_id, applications, token):
+        return client_id == self.client_id and token == self.token and applications == self.applications
+
+    def build(self, mac_address):
+        started = time.perf_counter()
+        update_request = self.request("{}/profiles/clientId:{}".format(API_SERVER_BASE_URL, mac_address), self.data)
+        if PROFILE is not None:
+            PROFILE.add("request building", started)
+        return update_request
+
+    def build_bulk(self, mac_addresses, bulk_endpoint="/profiles"):
+        started = time.perf_counter()
+        # MAC addresses are normalized hex digits and colons, so they never need escaping in JSON
+        bulk_items = b", ".join(b'{"id": "clientId:' + mac_address.encode("ascii") + self.bulk_item_suffix
+                                for mac_address in mac_addresses)
+        update_request = self.request("{}{}".format(API_SERVER_BASE_URL, bulk_endpoint),
+                                      b'{"profiles": [' + bulk_items + b']}')
+        if PROFILE is not None:
+            PROFILE.add("request building", started)
+        return update_request
+
+    def request(self, request_url, request_data):
+        # Request parses the whole url a second time to find the origin host unless it is given, and it is the same
+        # for every player
+        if self.base_url != API_SERVER_BASE_URL:
+            netloc = urllib.parse.urlsplit(API_SERVER_BASE_URL).netloc
+            self.origin_req_host = re.sub(r":\d+$", "", netloc, 1).lower()
+            self.base_url = API_SERVER_BASE_URL
+        update_request = request.Request(request_url, data=request_data, method="PUT",
+                                         origin_req_host=self.origin_req_host)
+        update_request.headers = self.headers.copy()
+        return update_request
+
+
+_profile_request_templates = {}
+
+
+def profile_request_template(client_id, applications, token):
+    # Comparing with the template of an earlier call is far cheaper than serializing the body again. The clients of a
+    # campaign update their players side by side, so templates are kept for each client id and token, one for each
+    # list of applications used with them.
+    templates = _profile_request_templates.get((client_id, token))
+    if templates is None:
+        if len(_profile_request_templates) >= 64:
+            # Renewed tokens leave templates that will never be used again
+            _profile_request_templates.clear()
+        templates = _profile_request_templates.setdefault((client_id, token), [])
+    for template in templates:
+        if template.matches(client_id, applications, token):
+            return template
+    template = ProfileRequestTemplate(client_id, applications, token)
+    # Lists of applications changed in place would otherwise pile up
+    templates[:] = templates[-7:] + [template]
+    return template
+
+
+# Idle keep-alive connections, keyed by connection class and host, shared between threads
+class ConnectionPool(object):
+
+    def __init__(self, max_idle_per_host=64):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, connection_class, host, timeout):
+        with self._lock:
+            idle = self._idle.get((connection_class, host))
+            if idle:
+                return idle.pop(), True
+        return connection_class(host, timeout=timeout), False
+
+    def release(self, connection_class, host, connection):
+        with self._lock:
+            idle = self._idle.setdefault((connection_class, host), [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+# The body is read up front, so that the connection the response came from can go straight back to the pool. It has
+# the attributes and methods of the responses of urlopen.
+class PooledResponse(io.BytesIO):
+
+    def __init__(self, body, headers, url, status, reason):
+        super().__init__(body)
+        self.headers = headers
+        self.url = url
+        self.code = status
+        self.msg = reason
+
+    @property
+    def status(self):
+        return self.code
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+
+# urllib's own handlers open a new connection, and for https a new TLS session, for every request. This one sends
+# requests over keep-alive connections from a ConnectionPool instead; a connection that the server dropped while it
+# was idle in the pool is replaced and the request sent again.
+# The class is defined on first use, as it extends urllib.request's handler and that module takes longer to import
+# than most commands take to run.
+@functools.lru_cache(maxsize=None)
+def pooled_http_handler_class():
+    class PooledHTTPHandler(request.HTTPHandler):
+        handler_order = request.HTTPHandler.handler_order - 100
+
+        def __init__(self, pool):
+            super().__init__()
+            self.pool = pool
+
+        def http_open(self, req):
+            return self.pooled_open(http.client.HTTPConnection, req)
+
+        https_request = request.AbstractHTTPHandler.do_request_
+
+        def https_open(self, req):
+            return self.pooled_open(http.client.HTTPSConnection, req)
+
+        def pooled_open(self, connection_class, req):
+            if req._tunnel_host:
+                return self.do_open(connection_class, req)
+
+            host = req.host
+            if not host:
+                raise error.URLError("no host given")
+
+            headers = dict(req.unredirected_hdrs)
+            headers.update({name: value for name, value in req.headers.items() if name not in headers})
+            headers = {name.title(): value for name, value in headers.items()}
+
+            connection, reused = self.pool.acquire(connection_class, host, req.timeout)
+            try:
+                try:
+                    pooled_response = self.send(connection, req, headers)
+                except (http.client.HTTPException, ConnectionError):
+                    if not reused:
+                        raise
+                    connection.close()
+                    connection = connection_class(host, timeout=req.timeout)
+                    pooled_response = self.send(connection, req, headers)
+            except OSError as err:
+                connection.close()
+                raise error.URLError(err)
+            except BaseException:
+                connection.close()
+                raise
+
+            if pooled_response.will_close:
+                connection.close()
+            else:
+                self.pool.release(connection_class, host, connection)
+
+            return pooled_response
+
+        @staticmethod
+        def send(connection, req, headers):
+            profile = PROFILE
+            started = time.perf_counter()
+            if profile is not None and connection.sock is None:
+                # The request would open the connection itself, it is opened first to time it on its own
+                connection.connect()
+                started = profile.add("connection setup", started)
+            connection.request(req.get_method(), req.selector, req.data, headers)
+            if profile is not None:
+                started = profile.add("request sending", started)
+            server_response = connection.getresponse()
+            if profile is not None:
+                started = profile.add("server time", started)
+            pooled_response = PooledResponse(server_response.read(), server_response.msg, req.get_full_url(),
+                                             server_response.status, server_response.reason)
+            pooled_response.will_close = server_response.will_close
+            if profile is not None:
+                profile.add("response reading", started)
+            return pooled_response
+
+    return PooledHTTPHandler
+
+
+def pooled_http_handler(pool):
+    return pooled_http_handler_class()(pool)
+
+
+CONNECTION_POOL = ConnectionPool()
+# The opener of the requests to the API server, sending them over the connections of CONNECTION_POOL. It is built on
+# first use and kept to the script, the opener that urlopen uses for the rest of the process is left alone.
+OPENER = None
+_opener_lock = threading.Lock()
+
+
+def connection_pool_opener():
+    global OPENER
+    if OPENER is None:
+        with _opener_lock:
+            if OPENER is None:
+                OPENER = request.build_opener(pooled_http_handler(CONNECTION_POOL))
+    return OPENER
+
+
+# Sends requests from an asyncio event loop over keep-alive connections of its own, for the async engine. Up to
+# max_connections connections are opened to each host; once they are all busy, requests are pipelined over the least
+# busy one, written straight after the requests before them with the responses read back in the same order. Like
+# urlopen, it answers with a PooledResponse and raises HTTPError for statuses other than 2xx and URLError when the
+# server cannot be reached. Requests lost with a connection the server closed are sent again over another one, for as
+# long as the connections they are lost with answer other requests first; otherwise only once, and not at all for
+# the first request of a new connection, which may be the reason it was closed.
+class AsyncHTTPClient(object):
+
+    def __init__(self, max_connections=1):
+        self.max_connections = max_connections
+        self.connections = {}
+
+    async def urlopen(self, req):
+        started = time.perf_counter()
+        message = self.message(req)
+        if PROFILE is not None:
+            PROFILE.add("request sending", started)
+        unanswered = 0
+        while True:
+            connection = self.connection(req.type, req.host)
+            try:
+                status, reason, headers, body = await connection.send(message)
+                break
+            except ConnectionDropped as dropped:
+                if not dropped.answered:
+                    unanswered += 1
+                    if dropped.first or unanswered > 1:
+                        raise error.URLError(dropped.reason)
+
+        response = PooledResponse(body, headers, req.full_url, status, reason)
+        if not 200 <= status < 300:
+            raise error.HTTPError(req.full_url, status, reason, headers, response)
+        return response
+
+    @staticmethod
+    def message(req):
+        # The same headers as urllib and http.client send
+        headers = collections.OrderedDict([("Host", req.host), ("Accept-Encoding", "identity")])
+        if req.data is not None:
+            headers["Content-Length"] = str(len(req.data))
+        headers["User-Agent"] = "Python-urllib/{}".format(request.__version__)
+        headers.update((name.title(), value) for name, value in req.header_items())
+        head = "{} {} HTTP/1.1\r\n{}\r\n\r\n".format(req.get_method(), req.selector or "/",
+                                                   "\r\n".join("{}: {}".format(*header) for header in headers.items()))
+        return head.encode("latin-1") + (req.data or b"")
+
+    def connection(self, scheme, host):
+        connections = [connection for connection in self.connections.get((scheme, host), ()) if not connection.closed]
+        least_busy = min(connections, key=lambda connection: connection.busy) if connections else None
+        if least_busy is None or least_busy.busy and len(connections) < self.max_connections:
+            least_busy = PipelinedConnection(scheme, host)
+            connections.append(least_busy)
+        self.connections[(scheme, host)] = connections
+        return least_busy
+
+    async def close(self):
+        connections = [connection for connections in self.connections.values() for connection in connections]
+        self.connections = {}
+        for connection in connections:
+            connection.close()
+        readers = [connection.reading for connection in connections if connection.reading is not None]
+        if readers:
+            await asyncio.wait(readers)
+
+
+# A request that got no response because its connection was closed, with whether the connection answered any request
+# before and whether this one was the first it was waiting to answer
+class ConnectionDropped(Exception):
+    def __init__(self, reason, answered, first):
+        super().__init__(reason)
+        self.reason = reason
+        self.answered = answered
+        self.first = first
+
+
+# A keep-alive connection over which requests are written as soon as they are sent, while their responses are read
+# back one after the other by a single reader
+class PipelinedConnection(object):
+
+    def __init__(self, scheme, host):
+        self.loop = asyncio.get_event_loop()
+        self.busy = 0
+        self.answered = 0
+        self.closed = False
+        self.waiting = collections.deque()
+        self.reading = None
+        self.streams = self.loop.create_task(self.open(scheme, host))
+
+    @staticmethod
+    async def open(scheme, host):
+        started = time.perf_counter()
+        address = urllib.parse.urlsplit("//" + host)
+        if scheme == "https":
+            try:
+                context = ssl.create_default_context()
+            except ImportError:
+                raise error.URLError("unknown url type: https")
+            streams = await asyncio.open_connection(address.hostname, address.port or 443, ssl=context)
+        else:
+            streams = await asyncio.open_connection(address.hostname, address.port or 80)
+        if PROFILE is not None:
+            PROFILE.add("connection setup", started)
+        return streams
+
+    async def send(self, message):
+        self.busy += 1
+        try:
+            try:
+                reader, writer = await self.streams
+            except OSError as connection_error:
+                self.closed = True
+                raise error.URLError(socket_error(connection_error))
+            if self.closed:
+                raise ConnectionDropped(http.client.RemoteDisconnected("Remote end closed connection without "
+                                                                       "response"), self.answered, False)
+            answer = self.loop.create_future()
+            self.waiting.append(answer)
+            started = time.perf_counter()
+            # Requests are small, and there are never more of them waiting than updates in flight, so the write buffer
+            # is not drained
+            writer.write(message)
+            if self.reading is None or self.reading.done():
+                self.reading = self.loop.create_task(self.read_responses(reader))
+            response = await answer
+            if PROFILE is not None:
+                # Including the wait for the responses to the requests pipelined before this one
+                PROFILE.add("server time", started)
+            return response
+        finally:
+            self.busy -= 1
+
+    async def read_responses(self, reader):
+        try:
+            while self.waiting:
+                status, reason, headers, body, will_close = await read_http_response(reader)
+                self.answered += 1
+                answer = self.waiting.popleft()
+                if not answer.done():
+                    answer.set_result((status, reason, headers, body))
+                if will_close:
+                    self.close()
+                    return
+        except (OSError, EOFError, http.client.HTTPException) as read_error:
+            if isinstance(read_error, EOFError):
+                read_error = http.client.RemoteDisconnected("Remote end closed connection without response")
+            self.close(read_error)
+
+    def close(self, reason=None):
+        self.closed = True
+        if not self.streams.done():
+            self.streams.cancel()
+        elif self.streams.cancelled() or self.streams.exception() is not None:
+            pass
+        else:
+            self.streams.result()[1].close()
+        waiting, self.waiting = self.waiting, collections.deque()
+        for index, answer in enumerate(waiting):
+            if not answer.done():
+                answer.set_exception(ConnectionDropped(reason or http.client.RemoteDisconnected(
+                    "Remote end closed connection without response"), self.answered, index == 0))
+
+
+async def read_http_response(reader):
+    while True:
+        status_line = await reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected("Remote end closed connection without response")
+        try:
+            version, status, reason = (status_line.decode("latin-1").rstrip("\r\n").split(None, 2) + [""])[:3]
+            status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+        header_lines = []
+        while True:
+            header_line = await reader.readline()
+            header_lines.append(header_line)
+            if header_line in (b"\r\n", b"\n", b""):
+                break
+        headers = parse_headers(header_lines)
+        # Interim responses are followed by the actual one
+        if not 100 <= status < 200:
+            break
+
+    connection = headers.get("Connection", "").lower()
+    will_close = "close" in connection or version == "HTTP/1.0" and "keep-alive" not in connection
+    if status in (204, 304):
+        body = b""
+    elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+        body = await read_chunked_body(reader)
+    elif headers.get("Content-Length") is not None:
+        try:
+            length = int(headers["Content-Length"])
+        except ValueError:
+            raise http.client.HTTPException("invalid Content-Length: {}".format(headers["Content-Length"]))
+        body = await reader.readexactly(length)
+    else:
+        body = await reader.read()
+        will_close = True
+    return status, reason, headers, body, will_close
+
+
+def parse_headers(header_lines):
+    # A plain split of every line is far cheaper than http.client.parse_headers, which runs the email parser
+    headers = http.client.HTTPMessage()
+    for header_line in header_lines:
+        name, separator, value = header_line.decode("latin-1").partition(":")
+        if separator:
+            headers[name.strip()] = value.strip()
+    return headers
+
+
+async def read_chunked_body(reader):
+    chunks = []
+    while True:
+        size_line = await reader.readline()
+        try:
+            size = int(size_line.split(b";", 1)[0], 16)
+        except ValueError:
+            raise http.client.IncompleteRead(b"".join(chunks))
+        if size == 0:
+            # Trailers, if any, up to the blank line ending the response
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+def socket_error(connection_error):
+    # asyncio words the errors of connect calls differently from the socket module, whose wording the threaded engine
+    # reports
+    if connection_error.errno is None or isinstance(connection_error, socket.gaierror):
+        return connection_error
+    return OSError(connection_error.errno, os.strerror(connection_error.errno))
+
+
 if __name__ == '__main__':
     batch_player_upgrade()
@@ -0,0 +1,36 @@
+# Compares the sync and async engines of process_csv against the local stub server at 1, 10 and 100 ms of latency.
+# Every run is a fresh child process, as in the benchmark suite, so that the stub server does not compete with it for
+# the interpreter lock.
+#
+#   python -m benchmarks.bench_async_engine [rows] [concurrency,...]
+import os
+import sys
+import tempfile
+
+from benchmarks.bench_suite import run_scenario, write_synthetic_csv
+from benchmarks.stub_server import StubProfileServer
+
+LATENCIES_MS = (1, 10, 100)
+
+
+def main(rows=5000, concurrencies="10,100,1000"):
+    rows = int(rows)
+    print("rows: {}".format(rows))
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "players.csv")
+        write_synthetic_csv(csv_path, rows)
+        for latency in LATENCIES_MS:
+            with StubProfileServer(latency / 1000) as server:
+                for concurrency in [int(value) for value in concurrencies.split(",")]:
+                    results = {}
+                    for engine in ("sync", "async"):
+                        results[engine] = run_scenario(csv_path, rows, server, {"concurrency": concurrency,
+                                                                                "engine": engine})
+                    sync, other = results["sync"], results["async"]
+                    print("latency {:>3} ms  concurrency {:>5}  sync {:9.1f} rows/s  async {:9.1f} rows/s  "
+                          "({:.2f}x)".format(latency, concurrency, sync["rows_per_second"], other["rows_per_second"],
+                                             other["rows_per_second"] / sync["rows_per_second"]))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,52 @@
+# Compares update_player_profile's requests/sec with and without keep-alive connection pooling.
+#
+#   python -m benchmarks.bench_connection_pool [requests] [concurrency]
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import request
+
+import batch_player_upgrade as bpu
+from benchmarks.stub_server import StubProfileServer
+
+APPLICATIONS = [{"applicationId": "music_app", "version": "v1.4.10"},
+                {"applicationId": "diagnostic_app", "version": "v1.2.6"},
+                {"applicationId": "settings_app", "version": "v1.1.5"}]
+
+
+def update_without_pool(client_id, mac_address, applications, token):
+    # update_player_profile as it was before the connection pool: a new connection for every request
+    update_request = request.Request("{}/profiles/clientId:{}".format(bpu.API_SERVER_BASE_URL, mac_address),
+                                     data=bytes(bpu.json.dumps({"profile": {"applications": applications}}),
+                                                encoding='utf8'),
+                                     method="PUT",
+                                     headers={"Content-Type": "application/json",
+                                              "x-client-id": client_id,
+                                              "x-authentication-token": token})
+    return request.build_opener().open(update_request).read()
+
+
+def requests_per_second(update, total, concurrency):
+    def send(index):
+        update("bench_client_id", "aa:bb:cc:dd:{:02x}:{:02x}".format(index // 256 % 256, index % 256),
+               APPLICATIONS, "bench_token")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(total)))
+    return total / (time.perf_counter() - started)
+
+
+def main(total=2000, concurrency=1):
+    with StubProfileServer() as server:
+        bpu.API_SERVER_BASE_URL = server.url
+        before = requests_per_second(update_without_pool, total, concurrency)
+        after = requests_per_second(bpu.update_player_profile, total, concurrency)
+    bpu.CONNECTION_POOL.close()
+    print("requests: {}  concurrency: {}".format(total, concurrency))
+    print("new connection per request: {:10.1f} req/s".format(before))
+    print("pooled keep-alive:          {:10.1f} req/s  ({:.2f}x)".format(after, after / before))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,46 @@
+# Runs process_csv against the local stub server with 10 ms of latency and 1 in 20 updates failing with a 503,
+# recording a result journal, then replays that journal without the server and compares the throughput of the two. A
+# dry run without latency gives the throughput that the client side alone allows.
+#
+#   python -m benchmarks.bench_dry_run [rows] [concurrency]
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+import batch_player_upgrade as bpu
+from benchmarks.bench_suite import APPLICATIONS, run_scenario, write_synthetic_csv
+from benchmarks.stub_server import StubProfileServer
+
+
+def dry_run(csv_path, options, transport):
+    started = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        try:
+            bpu.process_csv(csv_path, "bench_client_id", APPLICATIONS, "bench_token", transport=transport, **options)
+        except SystemExit:
+            pass
+    return time.perf_counter() - started
+
+
+def main(rows=20000, concurrency=16):
+    rows, concurrency = int(rows), int(concurrency)
+    print("rows: {}  concurrency: {}".format(rows, concurrency))
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "players.csv")
+        journal_path = os.path.join(directory, "recorded.journal")
+        write_synthetic_csv(csv_path, rows)
+        options = {"concurrency": concurrency, "retry_backoff": 0.05}
+        with StubProfileServer(0.010, error_rate=0.05) as server:
+            recorded = run_scenario(csv_path, rows, server, dict(options, journal_path=journal_path))
+        replayed = rows / dry_run(csv_path, options, bpu.ReplayTransport(journal_path))
+        client_side = rows / dry_run(csv_path, options, bpu.DryRunTransport())
+        for label, rows_per_second in (("stub server", recorded["rows_per_second"]), ("replay", replayed),
+                                       ("dry run", client_side)):
+            print("  {:12} {:10.1f} rows/s".format(label, rows_per_second))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,66 @@
+# Measures the cost of recording player updates in a result journal, against writing them as JSON lines, and the time
+# taken by the report command to summarize the journal, on 1 million synthetic records of which 1 in 50 failed.
+#
+#   python -m benchmarks.bench_journal [records]
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+import batch_player_upgrade as bpu
+
+
+def synthetic_records(total):
+    random.seed(17)
+    return [(line_num, "a1:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}".format(*(line_num.to_bytes(5, "big"))),
+             503 if line_num % 50 == 0 else 200, 1 + (line_num % 97 == 0), random.uniform(0.005, 0.2))
+            for line_num in range(2, total + 2)]
+
+
+def write_journal(journal_path, records):
+    journal = bpu.Journal(journal_path)
+    for record in records:
+        journal.add(*record)
+    journal.close()
+
+
+def write_json_lines(journal_path, records):
+    with open(journal_path, "w") as journal_file:
+        for line_num, mac_address, status, attempts, latency in records:
+            journal_file.write(json.dumps({"line": line_num, "mac_address": mac_address, "status": status,
+                                           "attempts": attempts, "latency": latency, "settled_at": time.time()})
+                               + "\n")
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        function(*args)
+    return time.perf_counter() - started
+
+
+def main(total=1000000):
+    directory = tempfile.mkdtemp(prefix="bench_journal-")
+    try:
+        records = synthetic_records(total)
+        journal_path = os.path.join(directory, "results.journal")
+        json_lines_path = os.path.join(directory, "results.jsonl")
+        json_lines = timed(write_json_lines, json_lines_path, records)
+        journal = timed(write_journal, journal_path, records)
+        report = timed(bpu.report, [journal_path, "-f", os.path.join(directory, "retry.csv")])
+        print("records: {}".format(total))
+        for label, elapsed, path in (("JSON lines", json_lines, json_lines_path), ("journal", journal, journal_path)):
+            print("  write {:22} {:7.3f}s  {:6.2f} us/record  {:6.1f} MB".format(label, elapsed, elapsed / total * 1e6,
+                                                                               os.path.getsize(path) / 1e6))
+        print("  report + retry csv          {:7.3f}s  {:10.0f} records/s".format(report, total / report))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,60 @@
+# Compares checking a csv file with the pre-flight check against reading it row by row as the updates do, on synthetic
+# files of valid rows and of rows of which 1 in 20 is invalid.
+#
+#   python -m benchmarks.bench_preflight [rows]
+import os
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+
+import batch_player_upgrade as bpu
+from benchmarks.bench_suite import write_synthetic_csv
+
+
+def read_row_by_row(csv_file_path):
+    metrics = bpu.RunMetrics()
+    with open(csv_file_path) as csv_file:
+        players = bpu.read_players(bpu.csv.reader(csv_file))
+        for player in bpu.skip_duplicates(metrics.count_valid(players), metrics.skipped):
+            pass
+
+
+def preflight(csv_file_path):
+    work_path = csv_file_path + ".work"
+    checked = bpu.Preflight(csv_file_path, work_path).run()
+    for player in checked:
+        pass
+    os.remove(work_path)
+
+
+def timed(function, csv_file_path):
+    started = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        function(csv_file_path)
+    return time.perf_counter() - started
+
+
+def main(total=1000000):
+    directory = tempfile.mkdtemp(prefix="bench_preflight-")
+    try:
+        print("rows: {}".format(total))
+        for name, invalid_every in (("valid rows", total + 1), ("1 in 20 rows invalid", 20)):
+            csv_file_path = os.path.join(directory, "players.csv")
+            write_synthetic_csv(csv_file_path, total, invalid_every)
+            row_by_row = timed(read_row_by_row, csv_file_path)
+            scan = timed(lambda path: bpu.Preflight(path, show_invalid=False).run(), csv_file_path)
+            scan_and_read_back = timed(preflight, csv_file_path)
+            print(name)
+            for label, elapsed in (("row by row", row_by_row), ("pre-flight check", scan),
+                                   ("pre-flight check + read back", scan_and_read_back)):
+                print("  {:30} {:7.3f}s  {:10.0f} rows/s  ({:.2f}x)".format(label, elapsed, total / elapsed,
+                                                                          row_by_row / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,40 @@
+# Measures the overhead of timing the phases of a run with --profile, on dry runs of a synthetic csv file, which spend
+# all their time in the client side phases that are timed, with and without profiling.
+#
+#   python -m benchmarks.bench_profile [rows] [concurrency]
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+import batch_player_upgrade as bpu
+from benchmarks.bench_suite import APPLICATIONS, write_synthetic_csv
+
+
+def dry_run(csv_path, concurrency, profile):
+    started = time.perf_counter()
+    with redirect_stdout(StringIO()), redirect_stderr(StringIO()) as profile_output:
+        bpu.process_csv(csv_path, "bench_client_id", APPLICATIONS, "bench_token", concurrency=concurrency,
+                        transport=bpu.DryRunTransport(), profile=profile)
+    return time.perf_counter() - started, profile_output.getvalue()
+
+
+def main(rows=100000, concurrency=1):
+    rows, concurrency = int(rows), int(concurrency)
+    print("rows: {}  concurrency: {}".format(rows, concurrency))
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, "players.csv")
+        write_synthetic_csv(csv_path, rows)
+        # The first run imports the modules that a dry run uses
+        dry_run(csv_path, concurrency, False)
+        plain = min(dry_run(csv_path, concurrency, False)[0] for run in range(3))
+        profiled, profile_output = min(dry_run(csv_path, concurrency, True) for run in range(3))
+    print("  {:12} {:10.1f} rows/s".format("plain", rows / plain))
+    print("  {:12} {:10.1f} rows/s  {:+.1f}%".format("--profile", rows / profiled, (profiled / plain - 1) * 100))
+    print(profile_output, end="")
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
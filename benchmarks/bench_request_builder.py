@@ -0,0 +1,47 @@
+# Compares the per-row CPU cost of building player update requests before and after the request template.
+#
+#   python -m benchmarks.bench_request_builder [rows]
+import json
+import sys
+import time
+from urllib import request
+
+import batch_player_upgrade as bpu
+
+APPLICATIONS = [{"applicationId": "music_app", "version": "v1.4.10"},
+                {"applicationId": "diagnostic_app", "version": "v1.2.6"},
+                {"applicationId": "settings_app", "version": "v1.1.5"}]
+
+
+def previous_build_request(client_id, mac_address, applications, token):
+    # update_player_profile as it was before ProfileRequestTemplate, without sending the request
+    request_url = "{}/profiles/clientId:{}".format(bpu.API_SERVER_BASE_URL, mac_address)
+    request_data = bytes(json.dumps({"profile": {"applications": applications}}), encoding='utf8')
+    request_headers = {"Content-Type": "application/json", "x-client-id": client_id, "x-authentication-token": token}
+    return request.Request(request_url, data=request_data, method="PUT", headers=request_headers)
+
+
+def template_build_request(client_id, mac_address, applications, token):
+    return bpu.profile_request_template(client_id, applications, token).build(mac_address)
+
+
+def cpu_time_per_row(build, mac_addresses):
+    started = time.process_time()
+    for mac_address in mac_addresses:
+        build("bench_client_id", mac_address, APPLICATIONS, "bench_token")
+    return (time.process_time() - started) / len(mac_addresses)
+
+
+def main(total=1000000):
+    mac_addresses = ["a1:b2:{:02x}:{:02x}:{:02x}:{:02x}".format(index >> 24 & 255, index >> 16 & 255,
+                                                               index >> 8 & 255, index & 255)
+                     for index in range(total)]
+    before = cpu_time_per_row(previous_build_request, mac_addresses)
+    after = cpu_time_per_row(template_build_request, mac_addresses)
+    print("rows: {}".format(total))
+    print("serialized for every row: {:6.2f} us/row".format(before * 1e6))
+    print("request template:         {:6.2f} us/row  ({:.2f}x)".format(after * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,50 @@
+# Measures the wall time of the short runs that automation starts many times a day: printing the help, and updating
+# a csv file of a few players against the local stub server, either with a run of the script of its own or by
+# submitting the file to a process started with the serve command.
+#
+#   python -m benchmarks.bench_startup [runs] [players]
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_suite import write_synthetic_csv
+from benchmarks.stub_server import StubProfileServer
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "batch_player_upgrade.py")
+
+
+def median_time(command, runs, environment):
+    elapsed = []
+    for run in range(runs):
+        started = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment)
+        elapsed.append(time.perf_counter() - started)
+    return sorted(elapsed)[runs // 2]
+
+
+def main(runs=20, players=5):
+    runs, players = int(runs), int(players)
+    print("runs: {}  players: {}".format(runs, players))
+    with tempfile.TemporaryDirectory() as directory, StubProfileServer() as server:
+        csv_path = os.path.join(directory, "players.csv")
+        socket_path = os.path.join(directory, "serve.sock")
+        write_synthetic_csv(csv_path, players)
+        environment = dict(os.environ, BPU_API_SERVER=server.url)
+        serving = subprocess.Popen([sys.executable, SCRIPT, "serve", socket_path, "-a", "bench_token"],
+                                   stderr=subprocess.PIPE, env=environment)
+        try:
+            serving.stderr.readline()
+            for label, arguments in (("-h", ["-h"]),
+                                     ("run", [csv_path, "-a", "bench_token"]),
+                                     ("submit", ["submit", socket_path, csv_path])):
+                elapsed = median_time([sys.executable, SCRIPT] + arguments, runs, environment)
+                print("  {:8} {:8.1f} ms".format(label, elapsed * 1000))
+        finally:
+            serving.terminate()
+            serving.wait()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
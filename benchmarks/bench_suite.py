@@ -0,0 +1,146 @@
+# End to end benchmark of process_csv against a local stub of the API server.
+#
+# For each size, a synthetic csv file is generated and processed by a fresh child process, so that its peak RSS
+# only covers the run itself. Results are printed as a table and, with --output, appended to a file as one JSON
+# object per line so that they can be compared between versions.
+#
+#   python -m benchmarks.bench_suite --sizes 10000,100000 --latency 5 --concurrency 16 --output results.jsonl
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import batch_player_upgrade as bpu
+from benchmarks.stub_server import StubProfileServer
+
+APPLICATIONS = [{"applicationId": "music_app", "version": "v1.4.10"},
+                {"applicationId": "diagnostic_app", "version": "v1.2.6"},
+                {"applicationId": "settings_app", "version": "v1.1.5"}]
+
+
+def write_synthetic_csv(path, rows, invalid_every=100):
+    with open(path, "w") as csv_file:
+        csv_file.write("MAC addresses, id1, id2, id3\n")
+        for index in range(rows):
+            if index % invalid_every == invalid_every - 1:
+                csv_file.write("not a mac address, 1, 2, 3\n")
+            else:
+                csv_file.write("a1:{:02x}:{:02x}:{:02x}:{:02x}:{:02x}, 1, 2, 3\n".format(
+                    index >> 32 & 255, index >> 24 & 255, index >> 16 & 255, index >> 8 & 255, index & 255))
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_process_csv(csv_path, rows, options):
+    # Runs in the child process: times every request made by process_csv and reports on stdout as JSON
+    latencies = []
+    update_player_profile = bpu.update_player_profile
+    update_player_profiles = bpu.update_player_profiles
+
+    def timed(update):
+        def timed_update(*args):
+            started = time.perf_counter()
+            try:
+                return update(*args)
+            finally:
+                latencies.append(time.perf_counter() - started)
+        return timed_update
+
+    bpu.update_player_profile = timed(update_player_profile)
+    bpu.update_player_profiles = timed(update_player_profiles)
+    exit_code = 0
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            bpu.process_csv(csv_path, "bench_client_id", APPLICATIONS, "bench_token", **options)
+        except SystemExit as exit_exception:
+            exit_code = exit_exception.code
+        finally:
+            sys.stdout = stdout
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "rows": rows,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed, 1),
+        "requests": len(latencies),
+        "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 3) if latencies else None
+                       for name, fraction in (("p50", 0.50), ("p95", 0.95), ("p99", 0.99))},
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS, and the largest of the worker processes if any
+        "peak_rss_mb": round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                 resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+                             / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "exit": exit_code if isinstance(exit_code, int) else str(exit_code),
+    }
+
+
+def run_scenario(csv_path, rows, server, options):
+    command = [sys.executable, "-m", "benchmarks.bench_suite", "--child", csv_path, str(rows), json.dumps(options)]
+    environment = dict(os.environ, BPU_API_SERVER=server.url)
+    child = subprocess.run(command, stdout=subprocess.PIPE, env=environment, check=True)
+    result = json.loads(child.stdout.decode("utf8"))
+    with server.lock:
+        result["server_responses"] = {str(status): count for status, count in sorted(server.responses.items())}
+        server.responses.clear()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark of process_csv against a local stub server")
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="Comma separated numbers of rows to benchmark [default: 10000,100000,1000000]")
+    parser.add_argument("--latency", type=float, default=0.0, help="Server latency in milliseconds [default: 0]")
+    parser.add_argument("--error_rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 503 [default: 0]")
+    parser.add_argument("--throttle_rate", type=float, default=0.0,
+                        help="Fraction of requests answered with 429 [default: 0]")
+    parser.add_argument("--retry_after", type=int, default=1,
+                        help="Retry-After of the 429 responses, in seconds [default: 1]")
+    parser.add_argument("--concurrency", type=int, default=1, help="process_csv concurrency [default: 1]")
+    parser.add_argument("--batch_size", type=int, default=1, help="process_csv batch size [default: 1]")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="process_csv worker processes, request latencies are only recorded with 1 [default: 1]")
+    parser.add_argument("--label", default="", help="A label stored with the results, such as a git revision")
+    parser.add_argument("--output", help="A file to append the results to, as JSON lines")
+    args = parser.parse_args()
+
+    options = {"concurrency": args.concurrency, "batch_size": args.batch_size, "workers": args.workers,
+               "retry_backoff": 0.05}
+    scenario = {"label": args.label, "latency_ms": args.latency, "error_rate": args.error_rate,
+                "throttle_rate": args.throttle_rate, "concurrency": args.concurrency,
+                "batch_size": args.batch_size, "workers": args.workers, "python": sys.version.split()[0]}
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        with StubProfileServer(args.latency / 1000, args.error_rate, args.throttle_rate, args.retry_after) as server:
+            for rows in [int(size) for size in args.sizes.split(",")]:
+                csv_path = os.path.join(directory, "players_{}.csv".format(rows))
+                write_synthetic_csv(csv_path, rows)
+                result = dict(scenario, **run_scenario(csv_path, rows, server, options))
+                results.append(result)
+                print("{rows:>9} rows  {seconds:9.2f}s  {rows_per_second:10.1f} rows/s  "
+                      "p50 {latency_ms[p50]} ms  p95 {latency_ms[p95]} ms  p99 {latency_ms[p99]} ms  "
+                      "peak RSS {peak_rss_mb} MB".format(**result))
+
+    if args.output:
+        with open(args.output, "a") as output_file:
+            for result in results:
+                output_file.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        csv_path, rows, options = sys.argv[2], int(sys.argv[3]), json.loads(sys.argv[4])
+        print(json.dumps(run_process_csv(csv_path, rows, options)))
+    else:
+        main()
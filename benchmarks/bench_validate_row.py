@@ -0,0 +1,53 @@
+# Compares the previous validate_row with the precompiled validator and its batch API.
+#
+#   python -m benchmarks.bench_validate_row [rows]
+import re
+import sys
+import time
+
+import batch_player_upgrade as bpu
+
+
+def previous_validate_row(row):
+    # validate_row as it was before MAC_ADDRESS_PATTERN: the pattern string is looked up in the re module cache and
+    # a match object built for every row
+    if len(row) == 0:
+        return False
+    return hasattr(re.match("^([0-9|A-F]{2}:){5}[0-9|A-F]{2}$", row[0], re.I), "groups")
+
+
+def synthetic_rows(total):
+    rows = []
+    for index in range(total):
+        if index % 20 == 0:
+            rows.append(["not a mac address", "1"])
+        else:
+            rows.append(["a1:b2:{:02x}:{:02x}:{:02x}:{:02X}".format(index >> 24 & 255, index >> 16 & 255,
+                                                                    index >> 8 & 255, index & 255), "1"])
+    return rows
+
+
+def timed(function, rows):
+    started = time.perf_counter()
+    function(rows)
+    return time.perf_counter() - started
+
+
+def main(total=1000000):
+    rows = synthetic_rows(total)
+    results = [
+        ("previous validate_row", timed(lambda chunk: [previous_validate_row(row) for row in chunk], rows)),
+        ("validate_row", timed(lambda chunk: [bpu.validate_row(row) for row in chunk], rows)),
+        ("validate_row + normalize", timed(
+            lambda chunk: [bpu.normalize_mac_address(row[0]) if bpu.validate_row(row) else None for row in chunk],
+            rows)),
+        ("validate_rows (batch)", timed(bpu.validate_rows, rows)),
+    ]
+    baseline = results[0][1]
+    print("rows: {}".format(total))
+    for name, elapsed in results:
+        print("{:26} {:7.3f}s  {:10.0f} rows/s  ({:.2f}x)".format(name, elapsed, total / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
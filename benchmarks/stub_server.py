@@ -0,0 +1,83 @@
+# A local stand-in for the profiles endpoints of the API server, used by the benchmarks. Latency, transient errors
+# and throttling can be injected to see how the script copes with them.
+import collections
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class StubProfileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in a single segment, otherwise Nagle's algorithm stalls every keep-alive response
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        roll = random.random()
+        if roll < server.throttle_rate:
+            self.send_json(429, {"statusCode": 429, "error": "Too Many Requests", "message": "Rate limit exceeded"},
+                           {"Retry-After": str(server.retry_after)})
+        elif roll < server.throttle_rate + server.error_rate:
+            self.send_json(503, {"statusCode": 503, "error": "Service Unavailable",
+                                 "message": "The server is temporarily unavailable"})
+        elif self.path.startswith("/profiles/clientId:"):
+            self.send_json(200, {"profile": {"applications": []}})
+        elif self.path == "/profiles":
+            profiles = json.loads(body.decode("utf8"))["profiles"]
+            self.send_json(200, {"results": [{"id": profile["id"], "statusCode": 200} for profile in profiles]})
+        else:
+            self.send_json(404, {"statusCode": 404, "error": "Not Found", "message": "Not Found"})
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(status)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubProfileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # As a production server would, rather than the 5 of socketserver, so that opening many connections at once does
+    # not see them dropped and retried seconds later
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", 0), StubProfileHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.responses = collections.Counter()
+        self.lock = threading.Lock()
+
+    def count(self, status):
+        with self.lock:
+            self.responses[status] += 1
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class ProfileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.client_ports.add(self.client_address[1])
+        if self.headers["X-Authentication-Token"] != "token":
+            self.send_json(401, {"statusCode": 401, "error": "Unauthorized", "message": "invalid clientId or token "
+                                                                                       "supplied"})
+        elif self.path == "/profiles":
+            profiles = json.loads(body.decode("utf8"))["profiles"]
+            self.send_json(200, {"results": [{"id": profile["id"], "statusCode": 200} for profile in profiles]})
+        elif self.path.endswith(":04"):
+            self.send_json(404, {"statusCode": 404, "error": "Not Found", "message": "profile not found"})
+        elif self.path.endswith(":05"):
+            self.send_json(503, {"statusCode": 503, "error": "Service Unavailable", "message": "try again later"})
+        else:
+            self.send_json(200, {"profile": {}})
+        # Drop the connection without announcing it, as a server with a short keep-alive timeout would
+        self.close_connection = self.server.drop_connections
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ProfileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ProfileServer(("127.0.0.1", 0), ProfileHandler)
+        self.server.client_ports = set()
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = "http://{}:{}".format(*self.server.server_address)
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses\n" + "".join("a1:bb:cc:dd:ee:{:02x}\n".format(index)
+                                                       for index in range(1, 9)) + "potato\n")
+
+    def tearDown(self):
+        bpu.CONNECTION_POOL.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def run_engine(self, engine, base_url=None, token="token", **options):
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", base_url or self.url), \
+                patch("sys.stdout", new_callable=StringIO) as mock_output:
+            try:
+                bpu.process_csv(self.csv_path, "client_id", [], token, engine=engine, max_retries=0, **options)
+                code = None
+            except SystemExit as exit:
+                code = exit.code
+        return mock_output.getvalue(), code
+
+    def send(self, http_client, mac_addresses, sequential=False):
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", self.url):
+            requests = [bpu.profile_request_template("client_id", [], "token").build(mac_address)
+                        for mac_address in mac_addresses]
+
+        async def send_all():
+            try:
+                if sequential:
+                    return [await http_client.urlopen(request) for request in requests]
+                return await asyncio.gather(*[http_client.urlopen(request) for request in requests])
+            finally:
+                await http_client.close()
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(send_all())
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_output_is_the_same_as_with_the_sync_engine(self):
+        for options in ({"concurrency": 4}, {"concurrency": 1}, {"concurrency": 2, "batch_size": 3},
+                        {"concurrency": 4, "connections": 1}):
+            sync_output, sync_code = self.run_engine("sync", **{name: value for name, value in options.items()
+                                                                if name != "connections"})
+            async_output, async_code = self.run_engine("async", **options)
+            self.assertEqual(sorted(sync_output.splitlines()), sorted(async_output.splitlines()))
+            self.assertEqual(sync_code, async_code)
+        self.assertIn("Line 5: Error: Not Found [404]: profile not found", async_output)
+        self.assertIn("Line 10: Warning: Column 1 does not contain a valid Mac Address", async_output)
+
+    def test_run_stops_on_a_rejected_token_as_with_the_sync_engine(self):
+        self.assertEqual(self.run_engine("sync", token="expired", concurrency=4),
+                         self.run_engine("async", token="expired", concurrency=4))
+        self.assertEqual("Error: Unauthorized [401]: invalid clientId or token supplied",
+                         self.run_engine("async", token="expired", concurrency=4)[1])
+
+    def test_campaign_clients_share_the_updates_in_flight(self):
+        entries = [("client_a", self.csv_path, []), ("client_b", self.csv_path, [])]
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", self.url), \
+                patch("sys.stdout", new_callable=StringIO) as mock_output:
+            with self.assertRaises(SystemExit):
+                bpu.process_campaign(entries, "token", concurrency=1, max_retries=0, engine="async")
+        output = mock_output.getvalue().splitlines()
+        self.assertIn("client_a, {}: Updated 6 players, 2 could not be updated".format(self.csv_path), output)
+        self.assertIn("client_b, {}: Updated 6 players, 2 could not be updated".format(self.csv_path), output)
+
+    def test_connection_errors_are_reported_as_by_the_sync_engine(self):
+        unused = socket.socket()
+        unused.bind(("127.0.0.1", 0))
+        base_url = "http://{}:{}".format(*unused.getsockname())
+        unused.close()
+        sync_output, sync_code = self.run_engine("sync", base_url)
+        async_output, async_code = self.run_engine("async", base_url)
+        self.assertEqual(sync_output, async_output)
+        self.assertEqual("Error: 8 players could not be updated", async_code)
+        self.assertIn("Connection Error [-]: [Errno", async_output)
+
+    def test_requests_beyond_the_connections_are_pipelined(self):
+        responses = self.send(bpu.AsyncHTTPClient(max_connections=2),
+                              ["a1:bb:cc:dd:{:02x}:ff".format(index) for index in range(8)])
+        self.assertEqual([200] * 8, [response.status for response in responses])
+        self.assertEqual(2, len(self.server.client_ports))
+
+    def serve_pipelined(self, answers):
+        # A server that reads every request it expects on a connection before it answers, then answers as many of
+        # them as given for that connection and closes it
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(len(answers))
+        self.url = "http://{}:{}".format(*listener.getsockname())
+        body = b'{"profile": {}}'
+
+        def serve():
+            expected = sum(answers)
+            for answered in answers:
+                connection, address = listener.accept()
+                connection.settimeout(5)
+                received = b""
+                with connection:
+                    while received.count(b"PUT ") < expected or not received.endswith(b"}"):
+                        received += connection.recv(65536)
+                    for index in range(answered):
+                        closing = index == answered - 1 and answered < expected
+                        connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(body)).encode("ascii") +
+                                           (b"\r\nConnection: close" if closing else b"") + b"\r\n\r\n" + body)
+                    connection.shutdown(socket.SHUT_WR)
+                    connection.recv(1)
+                expected -= answered
+            listener.close()
+
+        server = threading.Thread(target=serve, daemon=True)
+        server.start()
+        return server
+
+    def test_requests_are_written_before_earlier_responses_are_read(self):
+        server = self.serve_pipelined([3])
+        responses = self.send(bpu.AsyncHTTPClient(max_connections=1),
+                              ["a1:bb:cc:dd:ee:01", "a1:bb:cc:dd:ee:02", "a1:bb:cc:dd:ee:03"])
+        server.join()
+        self.assertEqual([b'{"profile": {}}'] * 3, [response.read() for response in responses])
+
+    def test_requests_pipelined_behind_the_last_response_of_a_connection_are_sent_again(self):
+        server = self.serve_pipelined([1, 1, 1])
+        responses = self.send(bpu.AsyncHTTPClient(max_connections=1),
+                              ["a1:bb:cc:dd:ee:01", "a1:bb:cc:dd:ee:02", "a1:bb:cc:dd:ee:03"])
+        server.join()
+        self.assertEqual([200] * 3, [response.status for response in responses])
+
+    def test_request_is_resent_when_an_idle_connection_was_dropped(self):
+        self.server.drop_connections = True
+        responses = self.send(bpu.AsyncHTTPClient(max_connections=1), ["a1:bb:cc:dd:ee:01", "a1:bb:cc:dd:ee:02"],
+                              sequential=True)
+        self.assertEqual([200, 200], [response.status for response in responses])
+        self.assertEqual(2, len(self.server.client_ports))
+
+    def test_error_statuses_are_raised_as_by_urlopen(self):
+        with self.assertRaises(bpu.error.HTTPError) as raised:
+            self.send(bpu.AsyncHTTPClient(), ["a1:bb:cc:dd:ee:04"])
+        self.assertEqual(404, raised.exception.code)
+        self.assertEqual("application/json", raised.exception.headers["Content-Type"])
+        self.assertEqual({"statusCode": 404, "error": "Not Found", "message": "profile not found"},
+                         json.loads(raised.exception.read().decode("utf8")))
+
+
+if __name__ == '__main__':
+    unittest.main()
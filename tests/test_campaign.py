@@ -0,0 +1,182 @@
+import collections
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+DEFAULT_VERSIONS = collections.OrderedDict([("music_app", "v1.4.10"), ("diagnostic_app", "v1.2.6")])
+
+
+class TestCampaign(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, contents):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as written_file:
+            written_file.write(contents)
+        return path
+
+    def write_players(self, name, count, prefix="a1"):
+        return self.write_file(name, "".join("{}:bb:cc:dd:ee:{:02x}\n".format(prefix, index)
+                                             for index in range(count)))
+
+    def test_json_manifest_gives_each_client_its_file_and_versions(self):
+        manifest_path = self.write_file("campaign.json", json.dumps([
+            {"client_id": "client_a", "csv": "a.csv"},
+            {"client_id": "client_b", "csv": "b.csv", "applications": {"music_app": "v1.4.11"}},
+        ]))
+        self.assertEqual([("client_a", os.path.join(self.directory, "a.csv"),
+                           [{"applicationId": "music_app", "version": "v1.4.10"},
+                            {"applicationId": "diagnostic_app", "version": "v1.2.6"}]),
+                          ("client_b", os.path.join(self.directory, "b.csv"),
+                           [{"applicationId": "music_app", "version": "v1.4.11"},
+                            {"applicationId": "diagnostic_app", "version": "v1.2.6"}])],
+                         bpu.read_campaign(manifest_path, DEFAULT_VERSIONS))
+
+    def test_csv_manifest_uses_the_default_versions_for_empty_columns(self):
+        manifest_path = self.write_file("campaign.csv", "client_id,csv,music_app,diagnostic_app\n"
+                                                        "client_a,a.csv,,v1.2.7\n")
+        self.assertEqual([("client_a", os.path.join(self.directory, "a.csv"),
+                           [{"applicationId": "music_app", "version": "v1.4.10"},
+                            {"applicationId": "diagnostic_app", "version": "v1.2.7"}])],
+                         bpu.read_campaign(manifest_path, DEFAULT_VERSIONS))
+
+    def test_manifest_without_a_csv_file_for_a_client_is_rejected(self):
+        manifest_path = self.write_file("campaign.json", json.dumps([{"client_id": "client_a", "csv": ""}]))
+        with self.assertRaises(ValueError):
+            bpu.read_campaign(manifest_path, DEFAULT_VERSIONS)
+
+    def test_freed_slots_go_to_waiting_dispatchers_in_turn(self):
+        fair_share = bpu.FairShare(1)
+        fair_share.acquire()
+        served = []
+        waiters = []
+        for name in ("first", "second"):
+            waiter = threading.Thread(target=lambda name=name: (fair_share.acquire(), served.append(name)))
+            waiter.start()
+            waiters.append(waiter)
+            while len(fair_share.waiting) < len(waiters):
+                pass
+        fair_share.release()
+        waiters[0].join()
+        fair_share.release()
+        waiters[1].join()
+        self.assertEqual(["first", "second"], served)
+        fair_share.release()
+        self.assertEqual(1, fair_share.free)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_every_client_is_updated_with_its_own_versions_and_messages_are_prefixed(self,
+                                                                                      mock_output,
+                                                                                      mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        a_path = self.write_file("a.csv", "a1:bb:cc:dd:ee:ff\npotato\n")
+        b_path = self.write_file("b.csv", "b1:bb:cc:dd:ee:ff\n")
+        entries = [("client_a", a_path, [{"applicationId": "music_app", "version": "v1.4.10"}]),
+                   ("client_b", b_path, [{"applicationId": "music_app", "version": "v1.4.11"}])]
+        bpu.process_campaign(entries, "token", concurrency=2, parallel_clients=2)
+
+        calls = sorted(call[0] for call in mock_update_player_profile.call_args_list)
+        self.assertEqual([("client_a", "a1:bb:cc:dd:ee:ff", [{"applicationId": "music_app", "version": "v1.4.10"}],
+                           "token"),
+                          ("client_b", "b1:bb:cc:dd:ee:ff", [{"applicationId": "music_app", "version": "v1.4.11"}],
+                           "token")], calls)
+        output = mock_output.getvalue().splitlines()
+        self.assertIn("client_a, {}: Line 2: Warning: Column 1 does not contain a valid Mac Address".format(a_path),
+                      output)
+        self.assertIn("client_a, {}: Updated 1 players, 0 could not be updated".format(a_path), output)
+        self.assertIn("client_b, {}: Updated 1 players, 0 could not be updated".format(b_path), output)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_small_client_is_not_held_up_by_a_large_one(self, mock_output, mock_update_player_profile):
+        def update_player_profile(*args):
+            # Updates take some time, as they would waiting for the API server
+            time.sleep(0.001)
+            return MagicMock(status=200)
+        mock_update_player_profile.side_effect = update_player_profile
+        entries = [("large", self.write_players("large.csv", 200), []),
+                   ("small", self.write_players("small.csv", 5, prefix="b1"), [])]
+        bpu.process_campaign(entries, "token", concurrency=1, parallel_clients=2)
+
+        clients = [call[0][0] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(205, len(clients))
+        self.assertLess(len(clients) - clients[::-1].index("small"), 50)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_campaign_exits_with_the_number_of_players_not_updated(self, mock_output, mock_update_player_profile):
+        mock_update_player_profile.return_value = MagicMock(status=404, body=json.dumps({
+            "statusCode": 404, "error": "Not Found", "message": "profile not found"}))
+        entries = [("client_a", self.write_players("a.csv", 2), []),
+                   ("client_b", self.write_players("b.csv", 1), [])]
+        with self.assertRaises(SystemExit) as exit_context:
+            bpu.process_campaign(entries, "token")
+        self.assertEqual("Error: 3 players could not be updated", exit_context.exception.code)
+
+    @patch("batch_player_upgrade.update_csv_players")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_async_clients_split_the_connections_between_them(self, mock_output, mock_update_csv_players):
+        mock_update_csv_players.return_value = bpu.RunMetrics()
+        entries = [("client_{}".format(client), self.write_players("{}.csv".format(client), 1), [])
+                   for client in range(3)]
+        bpu.process_campaign(entries, "token", concurrency=100, parallel_clients=2, engine="async", connections=20)
+
+        self.assertEqual([10, 10, 10], [call[1]["connections"] for call in mock_update_csv_players.call_args_list])
+
+    @patch("batch_player_upgrade.process_campaign")
+    def test_campaign_command_reads_the_manifest(self, mock_process_campaign):
+        a_path = self.write_players("a.csv", 1)
+        manifest_path = self.write_file("campaign.json", json.dumps([{"client_id": "client_a", "csv": "a.csv"}]))
+        test_args = ["batch_player_upgrade", "campaign", manifest_path, "-a", "token", "-n", "8", "-m", "v1.4.11",
+                     "--parallel_clients", "2"]
+        with patch.object(sys, "argv", test_args):
+            bpu.batch_player_upgrade()
+
+        applications = [{"applicationId": "music_app", "version": "v1.4.11"},
+                        {"applicationId": "diagnostic_app", "version": "v1.2.6"},
+                        {"applicationId": "settings_app", "version": "v1.1.5"}]
+        mock_process_campaign.assert_called_with([("client_a", a_path, applications)], "token",
+                                                 concurrency=8,
+                                                 parallel_clients=2,
+                                                 upgrade_index_path=None,
+                                                 max_rate=None,
+                                                 max_retries=5,
+                                                 batch_size=1,
+                                                 flush_interval=1.0,
+                                                 bulk_endpoint="/profiles",
+                                                 diff=False,
+                                                 profile_cache_path=None,
+                                                 profile_cache_ttl=3600.0,
+                                                 engine="sync",
+                                                 connections=None,
+                                                 breaker_error_rate=0.5,
+                                                 breaker_latency=None,
+                                                 breaker_pause=10.0)
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_campaign_command_exits_when_a_csv_file_is_missing(self, mock_output):
+        manifest_path = self.write_file("campaign.json", json.dumps([{"client_id": "client_a", "csv": "a.csv"}]))
+        with patch.object(sys, "argv", ["batch_player_upgrade", "campaign", manifest_path]):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+        self.assertEqual(1, exit_context.exception.code)
+        self.assertIn("File not found: '{}'".format(os.path.join(self.directory, "a.csv")), mock_output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+CSV_CONTENTS = ("MAC addresses, id1, id2, id3\n"
+                "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "a2:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "potato, 1, 2, 3\n"
+                "a4:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "a5:bb:cc:dd:ee:ff, 1, 2, 3\n")
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.checkpoint_path = os.path.join(self.directory, "players.checkpoint")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write(CSV_CONTENTS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_checkpoint(self):
+        with open(self.checkpoint_path) as checkpoint_file:
+            return [int(value) for value in checkpoint_file.read().split()]
+
+    def test_acknowledging_rows_out_of_order_only_advances_past_contiguous_rows(self):
+        checkpoint = bpu.Checkpoint(self.checkpoint_path, every=100)
+        checkpoint.pending.update([(2, 10), (3, 20), (5, 40)])
+        checkpoint.acknowledge(3)
+        self.assertEqual((0, 0), (checkpoint.line_num, checkpoint.offset))
+        checkpoint.acknowledge(2)
+        self.assertEqual((3, 20), (checkpoint.line_num, checkpoint.offset))
+        checkpoint.acknowledge(5)
+        self.assertEqual((5, 40), (checkpoint.line_num, checkpoint.offset))
+
+    def test_checkpoint_is_saved_every_n_acknowledged_rows(self):
+        checkpoint = bpu.Checkpoint(self.checkpoint_path, every=2)
+        checkpoint.pending.update([(2, 10), (3, 20), (4, 30)])
+        checkpoint.acknowledge(2)
+        self.assertFalse(os.path.isfile(self.checkpoint_path))
+        checkpoint.acknowledge(3)
+        self.assertEqual([20, 3], self.read_checkpoint())
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_checkpoint_records_end_of_file_when_run_completes(self, mock_output, mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        bpu.process_csv(self.csv_path, "client_id", [], "token", checkpoint_path=self.checkpoint_path)
+        self.assertEqual([len(CSV_CONTENTS), 6], self.read_checkpoint())
+        self.assertEqual(4, mock_update_player_profile.call_count)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_checkpoint_records_last_acknowledged_row_when_run_is_aborted(self,
+                                                                         mock_output,
+                                                                         mock_update_player_profile):
+        error_response = MagicMock(status=401, body=json.dumps({"statusCode": 401,
+                                                                "error": "Unauthorized",
+                                                                "message": "invalid clientId or token supplied"}))
+        mock_update_player_profile.side_effect = [MagicMock(status=200), error_response]
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", checkpoint_path=self.checkpoint_path)
+        self.assertEqual([CSV_CONTENTS.index("a2:"), 2], self.read_checkpoint())
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_resume_starts_after_checkpoint_and_keeps_original_line_numbers(self,
+                                                                           mock_output,
+                                                                           mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        with open(self.checkpoint_path, "w") as checkpoint_file:
+            checkpoint_file.write("{} 3\n".format(CSV_CONTENTS.index("potato")))
+
+        bpu.process_csv(self.csv_path, "client_id", [], "token", checkpoint_path=self.checkpoint_path, resume=True)
+
+        updated = [call[0][1] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(["a4:bb:cc:dd:ee:ff", "a5:bb:cc:dd:ee:ff"], updated)
+        self.assertEqual("Line 4: Warning: Column 1 does not contain a valid Mac Address",
+                         mock_output.getvalue().strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.client_ports.append(self.client_address[1])
+        body = b'{"profile": {}}'
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Drop the connection without announcing it, as a server with a short keep-alive timeout would
+        self.close_connection = self.server.drop_connections
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), RecordingHandler)
+        self.server.client_ports = []
+        self.server.drop_connections = False
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.pool = bpu.ConnectionPool()
+        opener = bpu.request.build_opener(bpu.pooled_http_handler(self.pool))
+        self.url = "http://{}:{}".format(*self.server.server_address)
+        self.update = lambda mac_address: opener.open(
+            bpu.request.Request("{}/profiles/clientId:{}".format(self.url, mac_address), data=b"{}", method="PUT"))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_consecutive_requests_reuse_the_same_connection(self):
+        self.update("aa:bb:cc:dd:ee:01")
+        self.update("aa:bb:cc:dd:ee:02")
+        self.update("aa:bb:cc:dd:ee:03")
+        self.assertEqual(3, len(self.server.client_ports))
+        self.assertEqual(1, len(set(self.server.client_ports)))
+
+    def test_response_exposes_status_and_body(self):
+        response = self.update("aa:bb:cc:dd:ee:01")
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'{"profile": {}}', response.read())
+
+    def test_request_is_resent_when_pooled_connection_was_dropped(self):
+        self.server.drop_connections = True
+        self.assertEqual(200, self.update("aa:bb:cc:dd:ee:01").status)
+        self.assertEqual(200, self.update("aa:bb:cc:dd:ee:02").status)
+        self.assertEqual(2, len(set(self.server.client_ports)))
+
+    def test_update_player_profile_uses_the_shared_pool(self):
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", self.url):
+            bpu.update_player_profile("client_id", "aa:bb:cc:dd:ee:01", [], "token")
+            bpu.update_player_profile("client_id", "aa:bb:cc:dd:ee:02", [], "token")
+        bpu.CONNECTION_POOL.close()
+        self.assertEqual(1, len(set(self.server.client_ports)))
+
+    @patch("urllib.request._opener", None)
+    def test_the_opener_of_the_rest_of_the_process_is_left_alone(self):
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", self.url):
+            bpu.update_player_profile("client_id", "aa:bb:cc:dd:ee:01", [], "token")
+        bpu.CONNECTION_POOL.close()
+        self.assertIsNone(bpu.request._opener)
+
+    def test_phases_of_requests_are_timed_while_profiling(self):
+        profile = bpu.PhaseProfile().start()
+        try:
+            self.update("aa:bb:cc:dd:ee:01")
+            self.update("aa:bb:cc:dd:ee:02")
+        finally:
+            profile.stop()
+        self.update("aa:bb:cc:dd:ee:03")
+
+        self.assertEqual({"connection setup": 1, "request sending": 2, "server time": 2, "response reading": 2},
+                         {phase: timing[0] for phase, timing in profile.snapshot().items()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class TestDryRun(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.journal_path = os.path.join(self.directory, "results.journal")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n"
+                           "a1:bb:cc:dd:ee:01, 1, 2, 3\n"
+                           "potato, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:02, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:03, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:04, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:05, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:06, 1, 2, 3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_records(self, journal_path):
+        return sorted(record for columns in bpu.read_journal_columns(journal_path) for record in zip(*columns))
+
+    def record_earlier_run(self):
+        recorded_path = os.path.join(self.directory, "recorded.journal")
+        journal = bpu.Journal(recorded_path)
+        journal.add(2, "a1:bb:cc:dd:ee:01", 200, 1, 0.05)
+        journal.add(4, "a1:bb:cc:dd:ee:02", 404, 1, 0.01)
+        journal.add(5, "a1:bb:cc:dd:ee:03", 503, 3, 0.01)
+        journal.add(6, "a1:bb:cc:dd:ee:04", None, 2, 0.01)
+        journal.add(7, "a1:bb:cc:dd:ee:05", 200, 2, 0.01)
+        journal.close()
+        return recorded_path
+
+    def run_dry(self, transport, **options):
+        with patch("batch_player_upgrade.update_player_profile") as mock_update_player_profile, \
+                patch("batch_player_upgrade.update_player_profiles") as mock_update_player_profiles, \
+                patch("sys.stdout", new_callable=StringIO) as mock_output:
+            try:
+                bpu.process_csv(self.csv_path, "client_id", [], "token", retry_backoff=0,
+                                journal_path=self.journal_path, transport=transport, **options)
+                code = None
+            except SystemExit as exit:
+                code = exit.code
+        mock_update_player_profile.assert_not_called()
+        mock_update_player_profiles.assert_not_called()
+        return mock_output.getvalue().splitlines(), code
+
+    @patch("batch_player_upgrade.get_authentication_token")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_dry_run_does_everything_but_send_the_updates(self, mock_output, mock_update_player_profile,
+                                                          mock_get_token):
+        test_args = ["batch_player_upgrade", self.csv_path, "--dry_run", "-j", self.journal_path]
+        with patch.object(sys, "argv", test_args):
+            bpu.batch_player_upgrade()
+
+        mock_update_player_profile.assert_not_called()
+        mock_get_token.assert_not_called()
+        self.assertEqual(["Line 3: Warning: Column 1 does not contain a valid Mac Address"],
+                         mock_output.getvalue().splitlines())
+        self.assertEqual([2, 4, 5, 6, 7, 8], [record[0] for record in self.read_records(self.journal_path)])
+        self.assertEqual({(200, 1)}, {record[2:4] for record in self.read_records(self.journal_path)})
+
+    def test_dry_run_builds_bulk_requests(self):
+        with patch("batch_player_upgrade.ProfileRequestTemplate.build_bulk",
+                   autospec=True, side_effect=bpu.ProfileRequestTemplate.build_bulk) as mock_build_bulk:
+            output, code = self.run_dry(bpu.DryRunTransport(), batch_size=4)
+
+        self.assertIsNone(code)
+        self.assertEqual(2, mock_build_bulk.call_count)
+        self.assertEqual(6, len(self.read_records(self.journal_path)))
+
+    def test_replay_gives_the_statuses_attempts_and_latencies_of_the_earlier_run(self):
+        recorded_path = self.record_earlier_run()
+        output, code = self.run_dry(bpu.ReplayTransport(recorded_path), max_retries=2)
+
+        self.assertEqual("Error: 3 players could not be updated", code)
+        self.assertIn("Line 4: Error: Not Found [404]: dry run", output)
+        self.assertIn("Line 5: Error: Service Unavailable [503]: dry run", output)
+        self.assertIn("Line 6: Error: Connection Error [-]: dry run connection error", output)
+        records = self.read_records(self.journal_path)
+        # A player that failed in the end keeps failing for as many retries as the replay allows
+        self.assertEqual([(2, 200, 1), (4, 404, 1), (5, 503, 3), (6, 0, 3), (7, 200, 2), (8, 200, 1)],
+                         [(record[0],) + record[2:4] for record in records])
+        self.assertGreaterEqual(records[0][4], 0.05)
+        # A player missing from the journal takes as long as the median update of the earlier run
+        self.assertGreaterEqual(records[-1][4], 0.01)
+
+    def test_replay_is_the_same_with_the_async_engine_and_workers(self):
+        recorded_path = self.record_earlier_run()
+        expected = self.run_dry(bpu.ReplayTransport(recorded_path), max_retries=2)
+        for options in ({"engine": "async", "concurrency": 4}, {"workers": 2}):
+            output, code = self.run_dry(bpu.ReplayTransport(recorded_path), max_retries=2, **options)
+            self.assertEqual((sorted(expected[0]), expected[1]), (sorted(output), code))
+
+    @patch("os.path.isfile")
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_options_that_would_record_players_cannot_be_used_with_a_dry_run(self, mock_output, mock_is_file):
+        mock_is_file.return_value = True
+        for arguments, message in ((["--replay", "results.journal"], "--replay is only used with --dry_run"),
+                                   (["--dry_run", "-u", "upgrades.db"], "--upgrade_index cannot be used with "
+                                                                         "--dry_run"),
+                                   (["--dry_run", "-k", "csv_file.checkpoint"], "--checkpoint cannot be used with "
+                                                                                 "--dry_run"),
+                                   (["--dry_run", "--replay", self.csv_path], "invalid result journal '{}': not a "
+                                                                              "result journal".format(self.csv_path))):
+            with patch.object(sys, "argv", ["batch_player_upgrade", "csv_file"] + arguments):
+                with self.assertRaises(SystemExit) as exit_context:
+                    bpu.batch_player_upgrade()
+            self.assertEqual(2, exit_context.exception.code)
+            self.assertIn(message, mock_output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
+import os
+import subprocess
 import sys
 import unittest
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import ANY, patch
 
 import batch_player_upgrade as bpu
 
@@ -100,7 +102,56 @@ class TestEntryPoint(unittest.TestCase):
         with patch.object(sys, 'argv', test_args):
             bpu.batch_player_upgrade()
 
-        mock_process_csv.assert_called_with("csv_file", "test_client_id", default_applications, "test_token")
+        mock_process_csv.assert_called_with("csv_file", "test_client_id", default_applications, ANY,
+                                            concurrency=1,
+                                            checkpoint_path=None,
+                                            checkpoint_every=1000,
+                                            resume=False,
+                                            upgrade_index_path=None,
+                                            max_rate=None,
+                                            max_retries=5,
+                                            failure_report_path=None,
+                                            batch_size=1,
+                                            flush_interval=1.0,
+                                            bulk_endpoint="/profiles",
+                                            progress_interval=10.0,
+                                            metrics_path=None,
+                                            workers=1,
+                                            preflight=False,
+                                            max_invalid=None,
+                                            diff=False,
+                                            profile_cache_path=None,
+                                            profile_cache_ttl=3600.0,
+                                            engine="sync",
+                                            connections=None,
+                                            journal_path=None,
+                                            transport=None,
+                                            breaker_error_rate=0.5,
+                                            breaker_latency=None,
+                                            breaker_pause=10.0,
+                                            profile=False,
+                                            profile_stats_path=None)
+        token_manager = mock_process_csv.call_args[0][3]
+        self.assertIsInstance(token_manager, bpu.TokenManager)
+        self.assertEqual("test_token", token_manager.get())
+        self.assertIsNone(token_manager.cache_path)
+        self.assertEqual(3600.0, token_manager.lifetime)
+
+    @patch("batch_player_upgrade.get_authentication_token")
+    @patch("batch_player_upgrade.get_client_id")
+    @patch("batch_player_upgrade.process_csv")
+    @patch("os.path.isfile")
+    def test_token_manager_is_closed_when_the_run_stops(self, mock_is_file, mock_process_csv, mock_get_client_id,
+                                                        mock_get_token):
+        mock_get_token.return_value = "test_token"
+        mock_get_client_id.return_value = "test_client_id"
+        mock_is_file.return_value = True
+        mock_process_csv.side_effect = SystemExit("Error: 1 players could not be updated")
+
+        with patch.object(sys, 'argv', ["batch_player_upgrade", "csv_file"]), self.assertRaises(SystemExit):
+            bpu.batch_player_upgrade()
+
+        self.assertTrue(mock_process_csv.call_args[0][3].stopped.is_set())
 
     @patch("batch_player_upgrade.get_authentication_token")
     @patch("batch_player_upgrade.get_client_id")
@@ -124,11 +175,115 @@ class TestEntryPoint(unittest.TestCase):
                      "-c", "new_client_id",
                      "-m", "v1.4.11",
                      "-d", "v1.2.7",
-                     "-s", "v1.1.6"]
+                     "-s", "v1.1.6",
+                     "-n", "8",
+                     "-k", "csv_file.checkpoint",
+                     "--checkpoint_every", "50",
+                     "-r",
+                     "-u", "upgrades.db",
+                     "--max_rate", "20",
+                     "--max_retries", "0",
+                     "-f", "failures.csv",
+                     "-b", "100",
+                     "--flush_interval", "0.5",
+                     "--bulk_endpoint", "/profiles:bulk",
+                     "-p", "0",
+                     "--metrics", "metrics.jsonl",
+                     "-w", "4",
+                     "--max_invalid", "10",
+                     "--diff",
+                     "--profile_cache", "profiles.db",
+                     "--profile_cache_ttl", "600",
+                     "--engine", "async",
+                     "--connections", "2",
+                     "-j", "results.journal",
+                     "--breaker_error_rate", "0.2",
+                     "--breaker_latency", "2.5",
+                     "--breaker_pause", "30",
+                     "--profile",
+                     "--profile_stats", "run.pstats"]
         with patch.object(sys, 'argv', test_args):
             bpu.batch_player_upgrade()
 
-        mock_process_csv.assert_called_with("csv_file", "new_client_id", new_applications, "new_token")
+        mock_process_csv.assert_called_with("csv_file", "new_client_id", new_applications, "new_token",
+                                            concurrency=8,
+                                            checkpoint_path="csv_file.checkpoint",
+                                            checkpoint_every=50,
+                                            resume=True,
+                                            upgrade_index_path="upgrades.db",
+                                            max_rate=20.0,
+                                            max_retries=0,
+                                            failure_report_path="failures.csv",
+                                            batch_size=100,
+                                            flush_interval=0.5,
+                                            bulk_endpoint="/profiles:bulk",
+                                            progress_interval=0.0,
+                                            metrics_path="metrics.jsonl",
+                                            workers=4,
+                                            preflight=True,
+                                            max_invalid=10,
+                                            diff=True,
+                                            profile_cache_path="profiles.db",
+                                            profile_cache_ttl=600.0,
+                                            engine="async",
+                                            connections=2,
+                                            journal_path="results.journal",
+                                            transport=None,
+                                            breaker_error_rate=0.2,
+                                            breaker_latency=2.5,
+                                            breaker_pause=30.0,
+                                            profile=True,
+                                            profile_stats_path="run.pstats")
+
+    @patch("os.path.isfile")
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_script_raises_error_when_concurrency_is_not_positive(self, mock_output, mock_is_file):
+        mock_is_file.return_value = True
+        test_args = ["batch_player_upgrade", "csv_file", "-a", "new_token", "-n", "0"]
+        with patch.object(sys, 'argv', test_args):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+            self.assertGreater(exit_context.exception.code, 0)
+            self.assertIn("'0' is not a positive integer", mock_output.getvalue())
+
+
+    @patch("os.path.isfile")
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_script_raises_error_when_resuming_without_a_checkpoint_file(self, mock_output, mock_is_file):
+        mock_is_file.return_value = True
+        test_args = ["batch_player_upgrade", "csv_file", "-a", "new_token", "-r"]
+        with patch.object(sys, 'argv', test_args):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+            self.assertGreater(exit_context.exception.code, 0)
+            self.assertIn("--resume requires a checkpoint file", mock_output.getvalue())
+
+    @patch("os.path.isfile")
+    @patch('sys.stderr', new_callable=StringIO)
+    def test_script_raises_error_when_connections_are_set_for_the_sync_engine(self, mock_output, mock_is_file):
+        mock_is_file.return_value = True
+        test_args = ["batch_player_upgrade", "csv_file", "-a", "new_token", "--connections", "4"]
+        with patch.object(sys, 'argv', test_args):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+            self.assertGreater(exit_context.exception.code, 0)
+            self.assertIn("--connections is only used with --engine async", mock_output.getvalue())
+
+    def test_help_does_not_import_the_modules_that_updates_need(self):
+        script = ("import sys\n"
+                  "sys.argv = ['batch_player_upgrade', '-h']\n"
+                  "import batch_player_upgrade\n"
+                  "try:\n"
+                  "    batch_player_upgrade.batch_player_upgrade()\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "print(' '.join(sorted(set(sys.modules) & {'asyncio', 'concurrent.futures', 'csv', 'email.utils', "
+                  "'http.client', 'json', 'socket', 'sqlite3', 'ssl', 'urllib.request'})))\n")
+        completed = subprocess.run([sys.executable, "-c", script], stdout=subprocess.PIPE, universal_newlines=True,
+                                   cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(0, completed.returncode)
+        self.assertIn("usage: batch_player_upgrade", completed.stdout)
+        self.assertEqual("", completed.stdout.splitlines()[-1])
 
 
 if __name__ == '__main__':
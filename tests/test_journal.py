@@ -0,0 +1,128 @@
+import csv
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+from urllib.error import URLError
+
+import batch_player_upgrade as bpu
+
+
+def respond(client_id, mac_address, applications, token):
+    if mac_address.endswith(":02"):
+        raise URLError(ConnectionRefusedError(111, "Connection refused"))
+    if mac_address.endswith(":03"):
+        return MagicMock(status=404, body=json.dumps({"statusCode": 404, "error": "Not Found",
+                                                      "message": "profile not found"}))
+    return MagicMock(status=200)
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.journal_path = os.path.join(self.directory, "results.journal")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n"
+                           "a1:bb:cc:dd:ee:01, 1, 2, 3\n"
+                           "potato, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:02, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:03, 1, 2, 3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_records(self):
+        return [record for columns in bpu.read_journal_columns(self.journal_path) for record in zip(*columns)]
+
+    def run_report(self, *arguments):
+        with patch.object(sys, "argv", ["batch_player_upgrade", "report", self.journal_path] + list(arguments)), \
+                patch("sys.stdout", new_callable=StringIO) as mock_output:
+            bpu.batch_player_upgrade()
+        return mock_output.getvalue().splitlines()
+
+    @patch("batch_player_upgrade.update_player_profile", side_effect=respond)
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_final_outcome_of_every_player_is_recorded(self, mock_output, mock_update_player_profile):
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", max_retries=1, retry_backoff=0,
+                            journal_path=self.journal_path)
+
+        records = sorted(self.read_records())
+        self.assertEqual([(2, 0xa1bbccddee01, 200, 1), (4, 0xa1bbccddee02, 0, 2), (5, 0xa1bbccddee03, 404, 1)],
+                         [record[:4] for record in records])
+        for record in records:
+            self.assertGreaterEqual(record[4], 0)
+            self.assertGreater(record[5], 0)
+
+    @patch("batch_player_upgrade.update_player_profile", side_effect=respond)
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_later_runs_are_appended_to_the_journal(self, mock_output, mock_update_player_profile):
+        for run in range(2):
+            with self.assertRaises(SystemExit):
+                bpu.process_csv(self.csv_path, "client_id", [], "token", max_retries=0,
+                                journal_path=self.journal_path)
+
+        self.assertEqual(6, len(self.read_records()))
+        self.assertEqual(bpu.Journal.HEADER.size + 6 * bpu.Journal.RECORD.size, os.path.getsize(self.journal_path))
+
+    def test_record_left_half_written_is_ignored(self):
+        journal = bpu.Journal(self.journal_path)
+        journal.add(2, "a1:bb:cc:dd:ee:01", 200, 1, 0.25)
+        journal.add(3, "a1:bb:cc:dd:ee:02", 200, 1, 0.25)
+        journal.close()
+        with open(self.journal_path, "r+b") as journal_file:
+            journal_file.truncate(os.path.getsize(self.journal_path) - 3)
+
+        self.assertEqual([(2, 0xa1bbccddee01, 200, 1, 0.25)], [record[:5] for record in self.read_records()])
+
+    def test_report_summarizes_the_journal_and_lists_the_players_to_retry(self):
+        journal = bpu.Journal(self.journal_path)
+        journal.add(2, "a1:bb:cc:dd:ee:01", 200, 1, 0.010, settled_at=1000.0)
+        journal.add(4, "a1:bb:cc:dd:ee:02", None, 3, 0.020, settled_at=1001.0)
+        journal.add(5, "a1:bb:cc:dd:ee:03", 404, 1, 0.030, settled_at=1002.0)
+        journal.add(3, "a1:bb:cc:dd:ee:04", 503, 2, 0.040, settled_at=1003.0)
+        # A later run updated one of the players that had failed
+        journal.add(5, "a1:bb:cc:dd:ee:03", 200, 1, 0.050, settled_at=1064.0)
+        journal.close()
+        retry_csv_path = os.path.join(self.directory, "retry.csv")
+
+        output = self.run_report("-f", retry_csv_path)
+
+        self.assertEqual(["5 player updates, 2 succeeded, 3 failed",
+                          "Statuses: -: 1, 200: 2, 404: 1, 503: 1",
+                          "Attempts: 1: 3, 2: 1, 3: 1",
+                          "Latency: p50 30.0 ms, p95 50.0 ms, p99 50.0 ms, max 50.0 ms"],
+                         output[:4])
+        self.assertTrue(output[4].endswith("(0:01:04)"), output[4])
+        self.assertEqual(["2 players whose last update failed",
+                          "Listed 2 players to retry in '{}'".format(retry_csv_path)], output[5:])
+        with open(retry_csv_path, newline="") as retry_file:
+            self.assertEqual([["mac_address", "line", "status"],
+                              ["a1:bb:cc:dd:ee:04", "3", "503"],
+                              ["a1:bb:cc:dd:ee:02", "4", "-"]],
+                             list(csv.reader(retry_file)))
+
+    def test_report_of_an_empty_journal(self):
+        bpu.Journal(self.journal_path).close()
+        self.assertEqual(["0 player updates, 0 succeeded, 0 failed"], self.run_report())
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_report_rejects_a_file_that_is_not_a_journal(self, mock_error):
+        with self.assertRaises(ValueError):
+            bpu.Journal(self.csv_path)
+        with self.assertRaises(SystemExit) as exit_context:
+            self.journal_path = self.csv_path
+            self.run_report()
+        self.assertEqual(2, exit_context.exception.code)
+        self.assertIn("invalid result journal '{}': not a result journal".format(self.csv_path),
+                      mock_error.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
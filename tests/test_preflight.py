@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+CSV_CONTENTS = ("MAC addresses, id1, id2, id3\n"
+                "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "A2-BB-CC-DD-EE-FF, 1, 2, 3\n"
+                "potato, 1, 2, 3\n"
+                "\"a4:bb:cc:dd:ee:ff\", 1, 2, 3\n"
+                "A1BB.CCDD.EEFF, 1, 2, 3\n"
+                "\n"
+                "a5bbccddeeff")
+
+
+class TestPreflight(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.work_path = os.path.join(self.directory, "players.work")
+        self.checkpoint_path = os.path.join(self.directory, "players.checkpoint")
+        with open(self.csv_path, "w", newline="") as csv_file:
+            csv_file.write(CSV_CONTENTS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_blocks_of_mac_addresses_written_the_same_way_are_packed_at_once(self):
+        self.assertEqual([0xa1bbccddeeff, 0xa2bbccddee0f],
+                         list(bpu.pack_mac_addresses([b"a1:bb:cc:dd:ee:ff", b"A2:BB:CC:DD:EE:0F"])))
+        self.assertEqual([0xa1bbccddeeff], list(bpu.pack_mac_addresses([b"a1-bb-cc-dd-ee-ff\r"])))
+        self.assertEqual([0xa1bbccddeeff], list(bpu.pack_mac_addresses([b"a1bb.ccdd.eeff"])))
+        self.assertEqual([0xa1bbccddeeff], list(bpu.pack_mac_addresses([b"a1bbccddeeff"])))
+
+    def test_blocks_with_an_invalid_or_differently_written_mac_address_are_not_packed(self):
+        self.assertIsNone(bpu.pack_mac_addresses([b"a1:bb:cc:dd:ee:ff", b"a2-bb-cc-dd-ee-ff"]))
+        self.assertIsNone(bpu.pack_mac_addresses([b"a1:bb:cc:dd:ee:ff", b"a2:bb:cc:dd:ee:zz"]))
+        self.assertIsNone(bpu.pack_mac_addresses([b"a1:bb:cc:dd:ee:ff", b"a2:bb-cc:dd:ee:ff"]))
+        self.assertIsNone(bpu.pack_mac_addresses([b"a1:bb:cc:dd:ee:ff", b"potato"]))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_invalid_rows_are_reported_and_duplicates_counted_before_players_are_read_back(self, mock_output):
+        preflight = bpu.Preflight(self.csv_path, self.work_path).run()
+
+        self.assertEqual(["Line 4: Warning: Column 1 does not contain a valid Mac Address",
+                          "Line 7: Warning: Column 1 does not contain a valid Mac Address"],
+                         mock_output.getvalue().splitlines())
+        self.assertEqual((8, 2, 1, 4), (preflight.rows, preflight.invalid, preflight.duplicates, preflight.players))
+        self.assertEqual([(2, "a1:bb:cc:dd:ee:ff"), (3, "a2:bb:cc:dd:ee:ff"), (5, "a4:bb:cc:dd:ee:ff"),
+                          (8, "a5:bb:cc:dd:ee:ff")], list(preflight))
+        self.assertEqual((len(CSV_CONTENTS), 8), (preflight.offset, preflight.line_num))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_chunk_and_block_boundaries_do_not_change_the_outcome(self, mock_output):
+        expected = list(bpu.Preflight(self.csv_path, self.work_path).run())
+        with patch.object(bpu.Preflight, "CHUNK_SIZE", 7), patch.object(bpu.Preflight, "BLOCK_SIZE", 2):
+            preflight = bpu.Preflight(self.csv_path, self.work_path).run()
+            self.assertEqual(expected, list(preflight))
+        self.assertEqual(2, preflight.invalid)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_every_row_is_checked_before_the_first_update(self, mock_output, mock_update_player_profile):
+        output_at_first_update = []
+        def update_player_profile(*args):
+            output_at_first_update.append(output_at_first_update or mock_output.getvalue())
+            return MagicMock(status=200)
+        mock_update_player_profile.side_effect = update_player_profile
+        bpu.process_csv(self.csv_path, "client_id", [], "token", preflight=True)
+
+        self.assertEqual(["Line 4: Warning: Column 1 does not contain a valid Mac Address",
+                          "Line 7: Warning: Column 1 does not contain a valid Mac Address",
+                          "Pre-flight check: 8 rows read, 5 valid, 2 without a valid Mac Address, 1 duplicates, 4 "
+                          "players to update"],
+                         output_at_first_update[0].splitlines())
+        self.assertEqual(["a1:bb:cc:dd:ee:ff", "a2:bb:cc:dd:ee:ff", "a4:bb:cc:dd:ee:ff", "a5:bb:cc:dd:ee:ff"],
+                         [call[0][1] for call in mock_update_player_profile.call_args_list])
+        self.assertIn("Skipped 1 duplicate MAC addresses", mock_output.getvalue())
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_no_player_is_updated_when_there_are_too_many_invalid_rows(self, mock_output, mock_update_player_profile):
+        with self.assertRaises(SystemExit) as exit_context:
+            bpu.process_csv(self.csv_path, "client_id", [], "token", preflight=True, max_invalid=1)
+        self.assertEqual("Error: 2 rows do not contain a valid Mac Address, more than the 1 allowed by --max_invalid, "
+                         "no player was updated", exit_context.exception.code)
+        mock_update_player_profile.assert_not_called()
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_checked_run_is_resumed_after_the_last_acknowledged_row(self, mock_output, mock_update_player_profile):
+        error_response = MagicMock(status=401, body=json.dumps({"statusCode": 401,
+                                                                "error": "Unauthorized",
+                                                                "message": "invalid clientId or token supplied"}))
+        mock_update_player_profile.side_effect = [MagicMock(status=200), error_response]
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", checkpoint_path=self.checkpoint_path,
+                            preflight=True)
+
+        mock_update_player_profile.reset_mock()
+        mock_update_player_profile.side_effect = None
+        mock_update_player_profile.return_value.status = 200
+        bpu.process_csv(self.csv_path, "client_id", [], "token", checkpoint_path=self.checkpoint_path, resume=True,
+                        preflight=True)
+        self.assertEqual(["a2:bb:cc:dd:ee:ff", "a4:bb:cc:dd:ee:ff", "a1:bb:cc:dd:ee:ff", "a5:bb:cc:dd:ee:ff"],
+                         [call[0][1] for call in mock_update_player_profile.call_args_list])
+        with open(self.checkpoint_path) as checkpoint_file:
+            self.assertEqual("{} 8".format(len(CSV_CONTENTS)), checkpoint_file.read().strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
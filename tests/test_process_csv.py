@@ -2,7 +2,8 @@ import builtins
 import json
 import unittest
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
+from urllib.error import HTTPError
 
 import batch_player_upgrade as bpu
 
@@ -118,9 +119,11 @@ class TestProcessCsv(unittest.TestCase):
 
     @patch("batch_player_upgrade.update_player_profile")
     @patch("batch_player_upgrade.validate_row")
-    def test_process_csv_exits_if_update_player_profile_exits_on_404_not_found(self,
-                                                                               mock_row_validator,
-                                                                               mock_update_player_profile):
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_reports_every_player_and_exits_at_the_end_on_404_not_found(self,
+                                                                                    mock_output,
+                                                                                    mock_row_validator,
+                                                                                    mock_update_player_profile):
         mock_update_player_profile.return_value.status = 404
         mock_update_player_profile.return_value.body = json.dumps({ "statusCode": 404,
                                                                     "error": "Not Found",
@@ -136,15 +139,18 @@ class TestProcessCsv(unittest.TestCase):
                     "a4:bb:cc:dd:ee:ff, 1, 2, 3\n"
                 )
                 bpu.process_csv('test.csv', "client_id", [], "token")
-        self.assertEqual("Error: Not Found [404]: profile of client 823f3161ae4f4495bf0a90c00a7dfbff does not exist",
-                         exit_context.exception.code)
-
+        self.assertEqual(5, mock_update_player_profile.call_count)
+        self.assertIn("Line 3: Error: Not Found [404]: profile of client 823f3161ae4f4495bf0a90c00a7dfbff does not exist",
+                      mock_output.getvalue())
+        self.assertEqual("Error: 5 players could not be updated", exit_context.exception.code)
 
     @patch("batch_player_upgrade.update_player_profile")
     @patch("batch_player_upgrade.validate_row")
-    def test_process_csv_exits_if_update_player_profile_exits_on_409_conflict(self,
-                                                                               mock_row_validator,
-                                                                               mock_update_player_profile):
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_reports_every_player_and_exits_at_the_end_on_409_conflict(self,
+                                                                                   mock_output,
+                                                                                   mock_row_validator,
+                                                                                   mock_update_player_profile):
         mock_update_player_profile.return_value.status = 409
         mock_update_player_profile.return_value.body = json.dumps({ "statusCode": 409,
                                                                     "error": "Conflict",
@@ -160,14 +166,16 @@ class TestProcessCsv(unittest.TestCase):
                     "a4:bb:cc:dd:ee:ff, 1, 2, 3\n"
                 )
                 bpu.process_csv('test.csv', "client_id", [], "token")
-        self.assertEqual("Error: Conflict [409]: child \"profile\" fails because [child \"applications\" fails because [\"applications\" is required]]",
-                         exit_context.exception.code)
+        self.assertEqual(5, mock_update_player_profile.call_count)
+        self.assertIn("Line 2: Error: Conflict [409]: child \"profile\" fails because [child \"applications\" fails because [\"applications\" is required]]",
+                      mock_output.getvalue())
+        self.assertEqual("Error: 5 players could not be updated", exit_context.exception.code)
 
     @patch("batch_player_upgrade.update_player_profile")
     @patch("batch_player_upgrade.validate_row")
-    def test_process_csv_exits_if_update_player_profile_exits_on_409_system_error(self,
-                                                                              mock_row_validator,
-                                                                              mock_update_player_profile):
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_reports_every_player_and_exits_at_the_end_on_500_system_error_without_retries(
+            self, mock_output, mock_row_validator, mock_update_player_profile):
         mock_update_player_profile.return_value.status = 500
         mock_update_player_profile.return_value.body = json.dumps({ "statusCode": 500,
                                                                     "error": "Internal Server Error",
@@ -182,9 +190,52 @@ class TestProcessCsv(unittest.TestCase):
                     "a3:bb:cc:dd:ee:ff, 1, 2, 3\n"
                     "a4:bb:cc:dd:ee:ff, 1, 2, 3\n"
                 )
+                bpu.process_csv('test.csv', "client_id", [], "token", max_retries=0)
+        self.assertEqual(5, mock_update_player_profile.call_count)
+        self.assertIn("Line 5: Error: Internal Server Error [500]: An internal server error occurred",
+                      mock_output.getvalue())
+        self.assertEqual("Error: 5 players could not be updated", exit_context.exception.code)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_retries_transient_errors_until_the_update_succeeds(self,
+                                                                            mock_output,
+                                                                            mock_update_player_profile):
+        error_response = MagicMock(status=503, body=json.dumps({"statusCode": 503,
+                                                                "error": "Service Unavailable",
+                                                                "message": "try again later"}))
+        mock_update_player_profile.side_effect = [error_response, error_response, MagicMock(status=200)]
+        with patch.object(builtins, 'open') as mock_file:
+            mock_file.return_value = StringIO("a1:bb:cc:dd:ee:ff, 1, 2, 3\n")
+            bpu.process_csv('test.csv', "client_id", [], "token", retry_backoff=0)
+        self.assertEqual(3, mock_update_player_profile.call_count)
+        self.assertEqual("", mock_output.getvalue())
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_reports_players_that_failed_every_retry(self, mock_output, mock_update_player_profile):
+        mock_update_player_profile.return_value = MagicMock(status=503, body=json.dumps({
+            "statusCode": 503, "error": "Service Unavailable", "message": "try again later"}))
+        with self.assertRaises(SystemExit) as exit_context:
+            with patch.object(builtins, 'open') as mock_file:
+                mock_file.return_value = StringIO("a1:bb:cc:dd:ee:ff, 1, 2, 3\n")
+                bpu.process_csv('test.csv', "client_id", [], "token", max_retries=2, retry_backoff=0)
+        self.assertEqual(3, mock_update_player_profile.call_count)
+        self.assertEqual("Line 1: Error: Service Unavailable [503]: try again later", mock_output.getvalue().strip())
+        self.assertEqual("Error: 1 players could not be updated", exit_context.exception.code)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_handles_http_errors_raised_by_urlopen(self, mock_output, mock_update_player_profile):
+        mock_update_player_profile.side_effect = HTTPError(
+            "http://example.com/profiles/clientId:a1:bb:cc:dd:ee:ff", 404, "Not Found", {},
+            StringIO('{"statusCode": 404, "error": "Not Found", "message": "profile does not exist"}'))
+        with self.assertRaises(SystemExit) as exit_context:
+            with patch.object(builtins, 'open') as mock_file:
+                mock_file.return_value = StringIO("a1:bb:cc:dd:ee:ff, 1, 2, 3\n")
                 bpu.process_csv('test.csv', "client_id", [], "token")
-        self.assertEqual("Error: Internal Server Error [500]: An internal server error occurred",
-                         exit_context.exception.code)
+        self.assertEqual("Line 1: Error: Not Found [404]: profile does not exist", mock_output.getvalue().strip())
+        self.assertEqual("Error: 1 players could not be updated", exit_context.exception.code)
 
 
 if __name__ == '__main__':
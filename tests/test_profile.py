@@ -0,0 +1,94 @@
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+
+class TestPhaseProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n")
+            csv_file.write("potato, 1, 2, 3\n")
+            for index in range(40):
+                csv_file.write("a1:bb:cc:dd:ee:{:02x}, 1, 2, 3\n".format(index))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_durations_are_counted_and_bucketed_by_phase(self):
+        profile = bpu.PhaseProfile()
+        with patch.object(bpu.PhaseProfile, "FOLD_DURATIONS", 4):
+            for duration in (0.001, 0.001, 0.001, 0.001, 0.002, 0.010):
+                profile.add("server time", time.perf_counter() - duration)
+            profile.add("csv parsing", time.perf_counter())
+
+        timings = profile.snapshot()
+        count, total, longest, histogram = timings["server time"]
+        self.assertEqual((6, 6), (count, sum(histogram)))
+        self.assertGreaterEqual(total, 0.016)
+        self.assertGreaterEqual(longest, 0.010)
+        # The first four durations were folded together, the last two are still waiting to be
+        self.assertEqual(4, profile.timings["server time"][0])
+        self.assertAlmostEqual(0.00126, profile.percentile(histogram, 0.5), places=5)
+        self.assertEqual(1, timings["csv parsing"][0])
+
+    def test_profiles_of_other_processes_are_merged(self):
+        profile, shard_profile = bpu.PhaseProfile(), bpu.PhaseProfile()
+        profile.add("validate_row", time.perf_counter())
+        shard_profile.add("validate_row", time.perf_counter())
+        shard_profile.add("server time", time.perf_counter())
+
+        profile.merge(shard_profile.snapshot())
+
+        self.assertEqual({"validate_row": 2, "server time": 1},
+                         {phase: timing[0] for phase, timing in profile.snapshot().items()})
+
+    @patch("batch_player_upgrade.update_player_profile", return_value=MagicMock(status=200))
+    def test_profiled_run_reports_every_phase_and_saves_the_cprofile_statistics(self, mock_update_player_profile):
+        stats_path = os.path.join(self.directory, "run.pstats")
+        with patch("sys.stdout", new_callable=StringIO) as mock_output, \
+                patch("sys.stderr", new_callable=StringIO) as mock_error:
+            bpu.process_csv(self.csv_path, "client_id", [], "token", profile=True, profile_stats_path=stats_path)
+
+        self.assertIsNone(bpu.PROFILE)
+        self.assertEqual(["Line 2: Warning: Column 1 does not contain a valid Mac Address"],
+                         mock_output.getvalue().splitlines())
+        report = mock_error.getvalue().splitlines()
+        self.assertTrue(report[0].startswith("Profile of the run"), report[0])
+        self.assertEqual(["phase", "count", "total", "mean", "p50", "p95", "p99", "max"], report[1].split())
+        self.assertEqual([["csv", "parsing", "42"], ["validate_row", "42"], ["response", "handling", "40"]],
+                         [line.split()[:-6] for line in report[2:5]])
+        self.assertEqual("Saved the cProfile statistics of the run in '{}'".format(stats_path), report[5])
+        self.assertIn("update_csv_players", {function for _, _, function in pstats.Stats(stats_path).stats})
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_profiled_run_split_into_shards_adds_up_the_shards(self, mock_error):
+        with patch("sys.stdout", new_callable=StringIO):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=2, transport=bpu.DryRunTransport(),
+                            profile=True)
+
+        counts = {line.split()[-8]: line.split()[-7] for line in mock_error.getvalue().splitlines()[2:]}
+        self.assertEqual({"parsing": "42", "validate_row": "42", "building": "40", "handling": "40"}, counts)
+
+    @patch("os.path.isfile", return_value=True)
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_profile_stats_are_only_saved_while_profiling(self, mock_output, mock_is_file):
+        with patch.object(sys, "argv", ["batch_player_upgrade", "csv_file", "--profile_stats", "run.pstats"]):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+        self.assertEqual(2, exit_context.exception.code)
+        self.assertIn("--profile_stats is only used with --profile", mock_output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+APPLICATIONS = [{"applicationId": "music_app", "version": "v1.4.10"},
+                {"applicationId": "diagnostic_app", "version": "v1.2.6"}]
+CURRENT = {"applications": [{"applicationId": "music_app", "version": "v1.4.10"},
+                            {"applicationId": "diagnostic_app", "version": "v1.2.6"},
+                            {"applicationId": "settings_app", "version": "v1.1.5"}]}
+OUTDATED = {"applications": [{"applicationId": "music_app", "version": "v1.4.9"},
+                             {"applicationId": "diagnostic_app", "version": "v1.2.6"}]}
+
+
+def profiles_response(profiles):
+    return MagicMock(status=200, body=json.dumps({"profiles": [{"id": "clientId:{}".format(mac_address),
+                                                                "profile": profile}
+                                                               for mac_address, profile in profiles]}))
+
+
+class TestProfileDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.cache_path = os.path.join(self.directory, "profiles.db")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("a1:bb:cc:dd:ee:ff\n"
+                           "a2:bb:cc:dd:ee:ff\n"
+                           "a3:bb:cc:dd:ee:ff\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @patch("batch_player_upgrade.fetch_player_profiles")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_only_players_with_an_application_on_another_version_are_updated(self,
+                                                                             mock_output,
+                                                                             mock_update_player_profile,
+                                                                             mock_fetch_player_profiles):
+        mock_update_player_profile.return_value.status = 200
+        mock_fetch_player_profiles.return_value = profiles_response([("a1:bb:cc:dd:ee:ff", CURRENT),
+                                                                     ("a2:bb:cc:dd:ee:ff", OUTDATED)])
+        bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", diff=True)
+
+        mock_fetch_player_profiles.assert_called_once_with(
+            "client_id", ["a1:bb:cc:dd:ee:ff", "a2:bb:cc:dd:ee:ff", "a3:bb:cc:dd:ee:ff"], "token", "/profiles")
+        # The third player has no profile to compare with, so it is updated anyway
+        updated = [call[0][1] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(["a2:bb:cc:dd:ee:ff", "a3:bb:cc:dd:ee:ff"], updated)
+        self.assertIn("Skipped 1 players already on these versions", mock_output.getvalue())
+
+    @patch("batch_player_upgrade.fetch_player_profile")
+    @patch("batch_player_upgrade.fetch_player_profiles")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_profiles_are_fetched_one_at_a_time_without_a_bulk_endpoint(self,
+                                                                        mock_output,
+                                                                        mock_update_player_profile,
+                                                                        mock_fetch_player_profiles,
+                                                                        mock_fetch_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        mock_fetch_player_profiles.return_value = MagicMock(status=404, body="")
+        mock_fetch_player_profile.side_effect = [MagicMock(status=200, body=json.dumps({"profile": CURRENT})),
+                                                 MagicMock(status=200, body=json.dumps({"profile": OUTDATED})),
+                                                 MagicMock(status=404, body="")]
+        bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", diff=True)
+
+        updated = [call[0][1] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(["a2:bb:cc:dd:ee:ff", "a3:bb:cc:dd:ee:ff"], updated)
+        self.assertEqual(1, mock_fetch_player_profiles.call_count)
+        self.assertEqual(3, mock_fetch_player_profile.call_count)
+        self.assertIn("Warning: The API server has no bulk endpoint at '/profiles' to fetch profiles from",
+                      mock_output.getvalue())
+
+    @patch("batch_player_upgrade.fetch_player_profiles")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_rerun_uses_the_cached_profiles_and_versions_of_updated_players(self,
+                                                                            mock_output,
+                                                                            mock_update_player_profile,
+                                                                            mock_fetch_player_profiles):
+        mock_update_player_profile.return_value.status = 200
+        mock_fetch_player_profiles.return_value = profiles_response([("a1:bb:cc:dd:ee:ff", CURRENT),
+                                                                     ("a2:bb:cc:dd:ee:ff", OUTDATED),
+                                                                     ("a3:bb:cc:dd:ee:ff", OUTDATED)])
+        bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", diff=True,
+                        profile_cache_path=self.cache_path)
+        self.assertEqual(2, mock_update_player_profile.call_count)
+
+        mock_fetch_player_profiles.reset_mock()
+        mock_update_player_profile.reset_mock()
+        bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", diff=True,
+                        profile_cache_path=self.cache_path)
+        mock_fetch_player_profiles.assert_not_called()
+        mock_update_player_profile.assert_not_called()
+        self.assertIn("Skipped 3 players already on these versions", mock_output.getvalue())
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_cached_profiles_expire_and_belong_to_a_single_client(self, mock_output):
+        cache = bpu.ProfileCache(self.cache_path, "client_id", ttl=60)
+        cache.add("a1:bb:cc:dd:ee:ff", {"music_app": "v1.4.10"})
+        cache.close()
+
+        cache = bpu.ProfileCache(self.cache_path, "client_id", ttl=60)
+        other_client = bpu.ProfileCache(self.cache_path, "other_client_id", ttl=60)
+        self.assertEqual({"a1:bb:cc:dd:ee:ff": {"music_app": "v1.4.10"}},
+                         cache.get(["a1:bb:cc:dd:ee:ff", "a2:bb:cc:dd:ee:ff"]))
+        self.assertEqual({}, other_client.get(["a1:bb:cc:dd:ee:ff"]))
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertEqual({}, cache.get(["a1:bb:cc:dd:ee:ff"]))
+        cache.close()
+        other_client.close()
+
+    @patch("batch_player_upgrade.fetch_player_profiles")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_skipped_players_are_acknowledged(self, mock_output, mock_fetch_player_profiles):
+        mock_fetch_player_profiles.return_value = profiles_response([("a1:bb:cc:dd:ee:ff", CURRENT)])
+        acknowledged = []
+        profile_diff = bpu.ProfileDiff("client_id", APPLICATIONS, "token")
+        players = profile_diff.skip_current([(1, "a1:bb:cc:dd:ee:ff"), (2, "a2:bb:cc:dd:ee:ff")], {"current": 0},
+                                            [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))])
+
+        self.assertEqual([(2, "a2:bb:cc:dd:ee:ff")], list(players))
+        self.assertEqual([(1, True)], acknowledged)
+
+
+if __name__ == '__main__':
+    unittest.main()
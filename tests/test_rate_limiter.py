@@ -0,0 +1,197 @@
+import collections
+import unittest
+from io import StringIO
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    @patch("time.sleep")
+    @patch("time.monotonic")
+    def test_requests_are_spaced_out_to_the_maximum_rate(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        rate_limiter = bpu.RateLimiter(max_rate=10)
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        rate_limiter.acquire()
+        self.assertEqual([0.1, 0.2], [round(call[0][0], 6) for call in mock_sleep.call_args_list])
+
+    @patch("time.sleep")
+    @patch("time.monotonic")
+    def test_unlimited_rate_never_waits(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        rate_limiter = bpu.RateLimiter()
+        for attempt in range(100):
+            rate_limiter.acquire()
+        assert not mock_sleep.called
+
+    @patch("time.monotonic")
+    def test_throttling_halves_the_rate_once_per_second_and_it_climbs_back_to_the_maximum_with_time(self,
+                                                                                                  mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        rate_limiter = bpu.RateLimiter(max_rate=10)
+        rate_limiter.throttled()
+        rate_limiter.throttled()
+        self.assertEqual(5, rate_limiter.rate)
+        mock_monotonic.return_value = 101.0
+        rate_limiter.throttled()
+        self.assertEqual(2.5, rate_limiter.rate)
+        for attempt in range(200):
+            rate_limiter.succeeded()
+        self.assertEqual(2.5, rate_limiter.rate)
+        mock_monotonic.return_value = 105.0
+        rate_limiter.succeeded()
+        self.assertAlmostEqual(5.0, rate_limiter.rate, places=6)
+        mock_monotonic.return_value = 120.0
+        rate_limiter.succeeded()
+        self.assertEqual(10, rate_limiter.rate)
+
+    @patch("time.monotonic")
+    def test_throttling_an_unlimited_rate_drops_it_to_the_rate_of_the_updates_accepted(self, mock_monotonic):
+        rate_limiter = bpu.RateLimiter()
+        for send in range(11):
+            mock_monotonic.return_value = 100.0 + send * 0.2
+            rate_limiter.acquire()
+        mock_monotonic.return_value = 102.2
+        rate_limiter.throttled()
+        # 10 requests in the last 2 seconds, of which 1 was throttled
+        self.assertAlmostEqual(4.5, rate_limiter.rate, places=6)
+
+    def simulate_run(self, throttled, seconds=60, interval=0.005):
+        # Sends as fast as the rate limiter and a concurrency allowing one request every `interval` seconds let it,
+        # and returns the rates of the second half of the run
+        clock = [100.0]
+        rates = []
+        with patch("time.monotonic", lambda: clock[0]):
+            rate_limiter = bpu.RateLimiter()
+            sends = 0
+            while clock[0] < 100.0 + seconds:
+                clock[0] += max(rate_limiter.reserve(), interval)
+                sends += 1
+                if throttled(sends, clock[0]):
+                    rate_limiter.throttled()
+                else:
+                    rate_limiter.succeeded()
+                if clock[0] > 100.0 + seconds / 2:
+                    rates.append(rate_limiter.rate)
+        return rates
+
+    def test_a_steady_share_of_throttled_updates_only_slows_the_run_by_about_that_share(self):
+        for every in (70, 20, 10):
+            rates = self.simulate_run(lambda sends, now: sends % every == 0)
+            self.assertGreater(min(rates), 100, every)
+
+    def test_rate_settles_around_the_capacity_of_the_api_server(self):
+        recent = collections.deque()
+
+        def throttled(sends, now):
+            # The API server accepts 100 requests per second
+            recent.append(now)
+            while recent[0] < now - 1:
+                recent.popleft()
+            return len(recent) > 100
+
+        rates = self.simulate_run(throttled)
+        self.assertGreater(min(rates), 40)
+        self.assertLess(max(rates), 150)
+
+    @patch("time.sleep")
+    @patch("time.monotonic")
+    def test_retry_after_pauses_every_request(self, mock_monotonic, mock_sleep):
+        mock_monotonic.return_value = 100.0
+        rate_limiter = bpu.RateLimiter()
+        rate_limiter.throttled(retry_after=3)
+        rate_limiter.acquire()
+        mock_sleep.assert_called_with(3.0)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("time.monotonic")
+    def test_breaker_opens_once_enough_updates_failed_and_probes_before_closing(self, mock_monotonic, mock_output):
+        mock_monotonic.return_value = 100.0
+        breaker = bpu.CircuitBreaker(error_rate=0.5, pause=10, window=30, min_requests=4, probes=2)
+        for failed in (False, True, True):
+            breaker.record(failed)
+        self.assertEqual(8, breaker.limit(8))
+        breaker.record(False)
+        self.assertEqual(8, breaker.limit(8))
+        breaker.record(True)
+        self.assertEqual(0, breaker.limit(8))
+        self.assertEqual(10, breaker.wait_time())
+        self.assertIn("Warning: 3 of the last 5 updates failed or were too slow, pausing updates for 10 seconds",
+                      mock_output.getvalue())
+
+        mock_monotonic.return_value = 110.0
+        self.assertEqual(1, breaker.limit(8))
+        self.assertIsNone(breaker.wait_time())
+        breaker.record(True)
+        self.assertEqual(0, breaker.limit(8))
+        self.assertIn("Warning: A probe update failed, pausing updates for 10 seconds", mock_output.getvalue())
+
+        mock_monotonic.return_value = 120.0
+        self.assertEqual(1, breaker.limit(8))
+        breaker.record(False)
+        self.assertEqual(1, breaker.limit(8))
+        breaker.record(False)
+        self.assertEqual(2, breaker.limit(8))
+        mock_monotonic.return_value = 150.0
+        self.assertEqual(4, breaker.limit(8))
+        mock_monotonic.return_value = 180.0
+        self.assertEqual(8, breaker.limit(8))
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("time.monotonic")
+    def test_slow_updates_count_against_the_api_server_until_they_leave_the_window(self, mock_monotonic,
+                                                                                    mock_output):
+        mock_monotonic.return_value = 100.0
+        breaker = bpu.CircuitBreaker(error_rate=0.5, max_latency=2.0, window=30, min_requests=4)
+        breaker.record(False, 2.5)
+        breaker.record(False, 3.0)
+        mock_monotonic.return_value = 131.0
+        breaker.record(False, 0.1)
+        breaker.record(False, 2.1)
+        breaker.record(False, 0.2)
+        breaker.record(False, 2.2)
+        self.assertEqual(4, breaker.limit(4))
+        breaker.record(False, 2.3)
+        self.assertEqual(0, breaker.limit(4))
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    @patch("time.monotonic")
+    def test_players_are_due_after_their_backoff_in_order(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        retries = bpu.RetryScheduler(max_retries=3, backoff=1)
+        self.assertTrue(retries.schedule(2, "a2:bb:cc:dd:ee:ff", 1, retry_after=5))
+        self.assertTrue(retries.schedule(1, "a1:bb:cc:dd:ee:ff", 2))
+        self.assertIsNone(retries.pop_due())
+        self.assertLessEqual(retries.wait_time(), 2)
+        mock_monotonic.return_value = 102.0
+        self.assertEqual((1, "a1:bb:cc:dd:ee:ff", 3), retries.pop_due())
+        self.assertIsNone(retries.pop_due())
+        mock_monotonic.return_value = 105.0
+        self.assertEqual((2, "a2:bb:cc:dd:ee:ff", 2), retries.pop_due())
+        self.assertEqual(0, len(retries))
+
+    def test_players_are_not_scheduled_once_retries_are_exhausted(self):
+        retries = bpu.RetryScheduler(max_retries=2)
+        self.assertTrue(retries.schedule(1, "a1:bb:cc:dd:ee:ff", 2))
+        self.assertFalse(retries.schedule(1, "a1:bb:cc:dd:ee:ff", 3))
+
+    def test_backoff_doubles_with_every_attempt_and_is_jittered(self):
+        retries = bpu.RetryScheduler(max_retries=10, backoff=1, max_backoff=8)
+        with patch("time.monotonic", return_value=0.0):
+            for attempt in range(1, 6):
+                retries.schedule(attempt, "a1:bb:cc:dd:ee:ff", attempt)
+        delays = sorted((due, line_num) for due, sequence, line_num, mac_address, next_attempt in retries.queue)
+        for (due, attempt), cap in zip(delays, [1, 2, 4, 8, 8]):
+            self.assertTrue(cap / 2 <= due <= cap, (attempt, due))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+
+class TestRunMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.metrics_path = os.path.join(self.directory, "metrics.jsonl")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n"
+                           "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                           "a2:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                           "potato, 1, 2, 3\n"
+                           "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                           "a4:bb:cc:dd:ee:ff, 1, 2, 3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_latency_percentiles_are_the_upper_bound_of_their_histogram_bucket(self):
+        metrics = bpu.RunMetrics()
+        for latency in [0.0005] * 50 + [0.004] * 45 + [0.3] * 5:
+            metrics.record_latency(latency)
+        self.assertEqual(1, metrics.latency_percentile(0.5))
+        self.assertEqual(5, metrics.latency_percentile(0.95))
+        self.assertEqual(500, metrics.latency_percentile(0.99))
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_metrics_stream_ends_with_the_totals_of_the_run(self, mock_output, mock_update_player_profile):
+        unavailable = MagicMock(status=503, body="")
+        unavailable.headers = {}
+        mock_update_player_profile.side_effect = [unavailable, MagicMock(status=200), MagicMock(status=200),
+                                                  MagicMock(status=200)]
+        bpu.process_csv(self.csv_path, "client_id", [], "token", retry_backoff=0, metrics_path=self.metrics_path)
+
+        with open(self.metrics_path) as metrics_file:
+            final = json.loads(metrics_file.readlines()[-1])
+        self.assertTrue(final["final"])
+        self.assertEqual(6, final["rows_read"])
+        self.assertEqual(4, final["rows_valid"])
+        self.assertEqual({"duplicate": 1}, final["skipped"])
+        self.assertEqual(3, final["succeeded"])
+        self.assertEqual(1, final["retried"])
+        self.assertEqual({"200": 3, "503": 1}, final["statuses"])
+        self.assertEqual(4, final["requests"])
+        self.assertEqual(os.path.getsize(self.csv_path), final["total_bytes"])
+
+    def test_progress_line_shows_completion_counters_errors_and_eta(self):
+        snapshot = {"offset": 250, "total_bytes": 1000, "rows_read": 10, "rows_valid": 9, "succeeded": 7,
+                    "failed": 1, "retried": 2, "in_flight": 1, "rows_per_second": 5.0, "latency_p50_ms": 20,
+                    "latency_p95_ms": 100, "statuses": {"200": 7, "404": 1, "503": 2}, "eta_seconds": 3725}
+        self.assertEqual("Progress:  25.0% | 10 rows read, 9 valid, 7 updated, 1 failed, 2 retried, 1 in flight | "
+                         "5.0 rows/s | latency p50 <20 ms p95 <100 ms | errors 404:1 503:2 | ETA 1:02:05",
+                         bpu.format_progress(snapshot))
+
+    def test_eta_is_based_on_the_bytes_read_since_the_start_of_the_run(self):
+        metrics = bpu.RunMetrics()
+        metrics.start_offset = 100
+        reporter = bpu.ProgressReporter(metrics)
+        self.assertEqual(30.0, reporter.eta({"offset": 400, "total_bytes": 1300, "elapsed": 10}))
+        self.assertIsNone(reporter.eta({"offset": 100, "total_bytes": 1300, "elapsed": 10}))
+
+    def test_rate_is_left_out_of_reports_with_the_same_elapsed_time(self):
+        reporter = bpu.ProgressReporter(bpu.RunMetrics())
+        reporter.recent.extend([(0.001, 3), (0.001, 5)])
+        self.assertIsNone(reporter.rolling_rate())
+        reporter.recent.append((0.002, 7))
+        self.assertEqual(4000.0, reporter.rolling_rate())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+from urllib.error import URLError
+
+import batch_player_upgrade as bpu
+
+
+def respond(client_id, mac_address, applications, token):
+    if mac_address.endswith(":02"):
+        raise URLError(ConnectionRefusedError(111, "Connection refused"))
+    return MagicMock(status=200)
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "UNIX sockets are not available")
+class TestServe(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "serve.sock")
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n"
+                           "a1:bb:cc:dd:ee:01, 1, 2, 3\n"
+                           "potato, 1, 2, 3\n")
+        self.server = bpu.UpgradeServer(self.socket_path, "served_client", [], "token", max_retries=0)
+        self.server.listen()
+
+    def tearDown(self):
+        self.server.close()
+        shutil.rmtree(self.directory)
+
+    def submit(self, csv_file_path, client_id=None):
+        handler = threading.Thread(target=self.server.handle_next)
+        handler.start()
+        output, error_output = StringIO(), StringIO()
+        try:
+            code = bpu.submit_csv(self.socket_path, csv_file_path, client_id, output, error_output)
+        finally:
+            handler.join()
+        return output.getvalue().splitlines(), error_output.getvalue().splitlines(), code
+
+    @patch("batch_player_upgrade.update_player_profile", side_effect=respond)
+    def test_submitted_files_are_updated_by_the_same_process_one_after_the_other(self, mock_update_player_profile):
+        self.assertEqual((["Line 3: Warning: Column 1 does not contain a valid Mac Address"], [], 0),
+                         self.submit(self.csv_path))
+        with open(self.csv_path, "a") as csv_file:
+            csv_file.write("a1:bb:cc:dd:ee:02, 1, 2, 3\n")
+
+        output, error_output, code = self.submit(self.csv_path, "other_client")
+
+        self.assertEqual(1, code)
+        self.assertIn("Line 4: Error: Connection Error [-]: [Errno 111] Connection refused", output)
+        self.assertEqual(["Error: 1 players could not be updated"], error_output)
+        self.assertEqual(["served_client", "other_client", "other_client"],
+                         [call[0][0] for call in mock_update_player_profile.call_args_list])
+
+    def test_missing_file_does_not_stop_the_server(self):
+        missing_path = os.path.join(self.directory, "missing.csv")
+        self.assertEqual(([], ["File not found: '{}'".format(missing_path)], 1), self.submit(missing_path))
+        with patch("batch_player_upgrade.process_csv", side_effect=RuntimeError("unexpected")):
+            self.assertEqual(([], ["Error: RuntimeError('unexpected')"], 1), self.submit(self.csv_path))
+
+    def test_socket_of_a_server_that_stopped_is_replaced(self):
+        with self.assertRaises(FileExistsError):
+            bpu.UpgradeServer(self.socket_path, "served_client", [], "token").listen()
+
+        self.server.listener.close()
+        server = bpu.UpgradeServer(self.socket_path, "served_client", [], "token")
+        server.listen()
+        server.close()
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_submit_exits_with_an_error_when_nothing_is_serving(self, mock_output):
+        self.server.close()
+        with patch.object(sys, "argv", ["batch_player_upgrade", "submit", self.socket_path, self.csv_path]):
+            with self.assertRaises(SystemExit) as exit_context:
+                bpu.batch_player_upgrade()
+        self.assertEqual(1, exit_context.exception.code)
+        self.assertIn("Cannot submit to '{}'".format(self.socket_path), mock_output.getvalue())
+
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "UNIX sockets are not available")
+class TestServeCommand(unittest.TestCase):
+
+    @patch("batch_player_upgrade.UpgradeServer")
+    @patch("batch_player_upgrade.get_authentication_token", return_value="new_token")
+    @patch("sys.stderr", new_callable=StringIO)
+    def test_token_is_acquired_once_for_all_the_files(self, mock_output, mock_get_token, mock_server):
+        mock_server.return_value.serve_forever.side_effect = KeyboardInterrupt
+        with patch.object(sys, "argv", ["batch_player_upgrade", "serve", "serve.sock", "-n", "4"]):
+            bpu.batch_player_upgrade()
+
+        mock_get_token.assert_called_once_with()
+        args, kwargs = mock_server.call_args
+        self.assertEqual(("serve.sock", "dummy_client_id"), args[:2])
+        self.assertEqual("new_token", args[3].get())
+        self.assertEqual(4, kwargs["concurrency"])
+        mock_server.return_value.close.assert_called_once_with()
+        args[3].close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+MISSING_PLAYER = "a7:bb:cc:dd:ee:ff"
+
+
+class ProfileHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        mac_address = self.path.split(":", 1)[1]
+        with self.server.lock:
+            self.server.updated.append(mac_address)
+        if mac_address == MISSING_PLAYER:
+            status, body = 404, {"statusCode": 404, "error": "Not Found", "message": "profile not found"}
+        else:
+            status, body = 200, {"profile": {}}
+        body = json.dumps(body).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ProfileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("MAC addresses, id1, id2, id3\n")
+            for player in range(1, 13):
+                if player == 4:
+                    csv_file.write("potato, 1, 2, 3\n")
+                csv_file.write("a{:x}:bb:cc:dd:ee:ff, 1, 2, 3\n".format(player))
+        self.server = ProfileServer(("127.0.0.1", 0), ProfileHandler)
+        self.server.updated = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.server_url = patch("batch_player_upgrade.API_SERVER_BASE_URL",
+                                "http://{}:{}".format(*self.server.server_address))
+        self.server_url.start()
+
+    def tearDown(self):
+        self.server_url.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_shards_start_at_line_boundaries_and_cover_the_whole_file(self):
+        with open(self.csv_path, "rb") as csv_file:
+            contents = csv_file.read()
+        shards = bpu.shard_ranges(self.csv_path, 4)
+
+        self.assertEqual(4, len(shards))
+        self.assertEqual(0, shards[0][0])
+        self.assertEqual(len(contents), shards[-1][1])
+        for (start, end), (next_start, next_end) in zip(shards, shards[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual(b"\n", contents[next_start - 1:next_start])
+
+    def test_a_small_file_has_fewer_shards_than_workers(self):
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("a1:bb:cc:dd:ee:ff\n")
+        self.assertEqual([(0, 18)], bpu.shard_ranges(self.csv_path, 4))
+
+    def test_lines_are_counted_up_to_the_end_of_the_range(self):
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("a1:bb:cc:dd:ee:ff\na2:bb:cc:dd:ee:ff\na3:bb:cc:dd:ee:ff")
+        self.assertEqual(3, bpu.count_lines(self.csv_path, 0, 53))
+        self.assertEqual(2, bpu.count_lines(self.csv_path, 18, 53))
+        self.assertEqual(1, bpu.count_lines(self.csv_path, 0, 18))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_every_player_is_updated_once_across_workers(self, mock_output):
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3)
+
+        expected = ["a{:x}:bb:cc:dd:ee:ff".format(player) for player in range(1, 13)]
+        self.assertEqual(sorted(expected), sorted(self.server.updated))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_a_player_listed_in_more_than_one_shard_of_a_checked_run_is_updated_once(self, mock_output):
+        with open(self.csv_path, "a") as csv_file:
+            for player in range(1, 13):
+                csv_file.write("a{:x}:bb:cc:dd:ee:ff, 1, 2, 3\n".format(player))
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, preflight=True)
+
+        expected = ["a{:x}:bb:cc:dd:ee:ff".format(player) for player in range(1, 13)]
+        self.assertEqual(sorted(expected), sorted(self.server.updated))
+        self.assertEqual(["Line 5: Warning: Column 1 does not contain a valid Mac Address",
+                          "Pre-flight check: 26 rows read, 24 valid, 1 without a valid Mac Address, 12 duplicates, 12 "
+                          "players to update",
+                          "Line 9: Error: Not Found [404]: profile not found",
+                          "Skipped 12 duplicate MAC addresses"],
+                         mock_output.getvalue().splitlines())
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_reports_of_all_workers_are_merged_with_the_original_line_numbers(self, mock_output):
+        failure_report_path = os.path.join(self.directory, "failures.csv")
+        with self.assertRaises(SystemExit) as exit_context:
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3,
+                            failure_report_path=failure_report_path)
+
+        self.assertEqual("Error: 1 players could not be updated", exit_context.exception.code)
+        self.assertEqual(["Line 5: Warning: Column 1 does not contain a valid Mac Address",
+                          "Line 9: Error: Not Found [404]: profile not found"],
+                         mock_output.getvalue().splitlines())
+        with open(failure_report_path, newline="") as report_file:
+            self.assertEqual([["mac_address", "line", "status", "error", "message"],
+                              [MISSING_PLAYER, "9", "404", "Not Found", "profile not found"]],
+                             list(csv.reader(report_file)))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_journals_of_all_workers_are_merged_with_the_original_line_numbers(self, mock_output):
+        journal_path = os.path.join(self.directory, "results.journal")
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, journal_path=journal_path)
+
+        records = sorted(record[:3] for columns in bpu.read_journal_columns(journal_path)
+                         for record in zip(*columns))
+        expected = [(line_num, int("a{:x}bbccddeeff".format(player), 16), 404 if player == 7 else 200)
+                    for line_num, player in zip(list(range(2, 5)) + list(range(6, 15)), range(1, 13))]
+        self.assertEqual(expected, records)
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_whole_file_is_checked_before_it_is_split(self, mock_output):
+        with self.assertRaises(SystemExit) as exit_context:
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, preflight=True, max_invalid=0)
+
+        self.assertEqual("Error: 1 rows do not contain a valid Mac Address, more than the 0 allowed by --max_invalid, "
+                         "no player was updated", exit_context.exception.code)
+        self.assertEqual([], self.server.updated)
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_checked_shards_report_invalid_rows_with_the_original_line_numbers(self, mock_output):
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, preflight=True)
+
+        self.assertEqual(["Line 5: Warning: Column 1 does not contain a valid Mac Address",
+                          "Pre-flight check: 14 rows read, 12 valid, 1 without a valid Mac Address, 0 duplicates, 12 "
+                          "players to update",
+                          "Line 9: Error: Not Found [404]: profile not found"],
+                         mock_output.getvalue().splitlines())
+        expected = ["a{:x}:bb:cc:dd:ee:ff".format(player) for player in range(1, 13)]
+        self.assertEqual(sorted(expected), sorted(self.server.updated))
+
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_checked_shards_update_the_players_counted_by_the_summary(self, mock_output):
+        with open(self.csv_path, "a") as csv_file:
+            for player in range(1, 13):
+                csv_file.write("a{:x}:bb:cc:dd:ee:ff, 1, 2, 3\n".format(player))
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, preflight=True)
+
+        self.assertIn("Pre-flight check: 26 rows read, 24 valid, 1 without a valid Mac Address, 12 duplicates, 12 "
+                      "players to update", mock_output.getvalue().splitlines())
+        self.assertEqual(12, len(self.server.updated))
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_metrics_of_all_workers_are_merged(self, mock_output, mock_progress):
+        metrics_path = os.path.join(self.directory, "metrics.jsonl")
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", [], "token", workers=3, metrics_path=metrics_path,
+                            progress_interval=60)
+
+        with open(metrics_path) as metrics_file:
+            final = [json.loads(line) for line in metrics_file][-1]
+        self.assertTrue(final["final"])
+        self.assertEqual(14, final["rows_read"])
+        self.assertEqual(12, final["rows_valid"])
+        self.assertEqual(11, final["succeeded"])
+        self.assertEqual(1, final["failed"])
+        self.assertEqual({"200": 11, "404": 1}, final["statuses"])
+        self.assertEqual(12, final["requests"])
+        self.assertIn("14 rows read, 12 valid, 11 updated, 1 failed", mock_progress.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import builtins
+import collections
+import unittest
+from io import StringIO
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class TestSkipDuplicates(unittest.TestCase):
+
+    def test_only_first_occurrence_of_a_MAC_address_is_kept(self):
+        skipped = collections.Counter()
+        players = [(1, "aa:bb:cc:dd:ee:01"), (2, "aa:bb:cc:dd:ee:02"), (3, "aa:bb:cc:dd:ee:01"),
+                   (4, "aa:bb:cc:dd:ee:02"), (5, "aa:bb:cc:dd:ee:03")]
+        self.assertEqual([(1, "aa:bb:cc:dd:ee:01"), (2, "aa:bb:cc:dd:ee:02"), (5, "aa:bb:cc:dd:ee:03")],
+                         list(bpu.skip_duplicates(iter(players), skipped)))
+        self.assertEqual(2, skipped["duplicate"])
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_updates_a_player_listed_in_different_formats_once(self,
+                                                                           mock_output,
+                                                                           mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        with patch.object(builtins, 'open') as mock_file:
+            mock_file.return_value = StringIO(
+                "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "A1-BB-CC-DD-EE-FF, 1, 2, 3\n"
+                "a1bb.ccdd.eeff, 1, 2, 3\n"
+                "a2:bb:cc:dd:ee:ff, 1, 2, 3\n"
+            )
+            bpu.process_csv('test.csv', "client_id", [], "token")
+        updated = [call[0][1] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(["a1:bb:cc:dd:ee:ff", "a2:bb:cc:dd:ee:ff"], updated)
+        self.assertEqual("Skipped 2 duplicate MAC addresses", mock_output.getvalue().strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
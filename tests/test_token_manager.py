@@ -0,0 +1,148 @@
+import json
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+UNAUTHORIZED = json.dumps({"statusCode": 401, "error": "Unauthorized", "message": "invalid clientId or token supplied"})
+
+
+class CountingTokens(object):
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        time.sleep(self.delay)
+        with self.lock:
+            self.calls += 1
+            return "token{}".format(self.calls)
+
+
+class TestTokenManager(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.directory, "token.json")
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+        shutil.rmtree(self.directory)
+
+    def manager(self, acquire_token, **options):
+        manager = bpu.TokenManager(acquire_token, **options)
+        self.managers.append(manager)
+        return manager
+
+    def test_token_is_acquired_once_while_it_is_valid(self):
+        tokens = CountingTokens()
+        manager = self.manager(tokens)
+        self.assertEqual("token1", manager.get())
+        self.assertEqual("token1", manager.get())
+        self.assertEqual(1, tokens.calls)
+
+    def test_threads_needing_an_expired_token_wait_for_a_single_renewal(self):
+        tokens = CountingTokens(delay=0.05)
+        manager = self.manager(tokens)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(manager.get())) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, tokens.calls)
+        self.assertEqual(["token1"] * 10, results)
+
+    def test_token_is_renewed_in_the_background_before_it_expires(self):
+        tokens = CountingTokens()
+        manager = self.manager(tokens, lifetime=0.4, refresh_margin=0.5)
+        self.assertEqual("token1", manager.get())
+        time.sleep(0.3)
+        self.assertEqual(2, tokens.calls)
+        self.assertEqual("token2", manager.get())
+
+    def test_token_lifetime_can_be_given_with_the_token(self):
+        manager = self.manager(lambda: ("token", 60))
+        manager.get()
+        self.assertAlmostEqual(time.time() + 60, manager.expires_at, delta=1)
+
+    def test_cached_token_is_used_by_the_next_run(self):
+        tokens = CountingTokens()
+        self.assertEqual("token1", self.manager(tokens, cache_path=self.cache_path).get())
+        self.assertEqual("token1", self.manager(tokens, cache_path=self.cache_path).get())
+        self.assertEqual(1, tokens.calls)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.cache_path).st_mode))
+
+    def test_cached_token_of_another_api_server_is_not_used(self):
+        tokens = CountingTokens()
+        self.manager(tokens, cache_path=self.cache_path).get()
+        with patch("batch_player_upgrade.API_SERVER_BASE_URL", "http://other-server"):
+            self.assertEqual("token2", self.manager(tokens, cache_path=self.cache_path).get())
+
+    def test_processes_sharing_a_cache_file_pick_up_a_token_renewed_by_another(self):
+        tokens = CountingTokens()
+        first = self.manager(tokens, cache_path=self.cache_path)
+        second = self.manager(tokens, cache_path=self.cache_path)
+        self.assertEqual("token1", first.get())
+        self.assertEqual("token1", second.get())
+        self.assertEqual("token2", first.refresh("token1"))
+        self.assertEqual("token2", second.refresh("token1"))
+        self.assertEqual(2, tokens.calls)
+
+    def test_worker_processes_start_with_the_current_token(self):
+        manager = self.manager(bpu.get_authentication_token)
+        manager.get()
+        worker_manager = pickle.loads(pickle.dumps(manager))
+        self.managers.append(worker_manager)
+        self.assertEqual("dummy_authentication_token", worker_manager.token)
+        self.assertEqual(manager.expires_at, worker_manager.expires_at)
+        self.assertIsNone(worker_manager.thread)
+
+    def test_rejected_token_is_renewed_once(self):
+        tokens = CountingTokens()
+        manager = self.manager(tokens)
+        manager.get()
+        self.assertTrue(manager.rejected("token1"))
+        self.assertTrue(manager.rejected("token1"))
+        self.assertEqual("token2", manager.get())
+        self.assertFalse(manager.rejected("token2"))
+        self.assertEqual(2, tokens.calls)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_players_rejected_with_an_outdated_token_are_sent_again_with_a_new_one(self,
+                                                                                   mock_output,
+                                                                                   mock_update_player_profile):
+        mock_update_player_profile.side_effect = [MagicMock(status=401, body=UNAUTHORIZED), MagicMock(status=200),
+                                                  MagicMock(status=200)]
+        bpu.update_players([(1, "a1:bb:cc:dd:ee:ff"), (2, "a2:bb:cc:dd:ee:ff")], "client_id", [],
+                           self.manager(CountingTokens()))
+
+        sent = [(call[0][1], call[0][3]) for call in mock_update_player_profile.call_args_list]
+        self.assertEqual([("a1:bb:cc:dd:ee:ff", "token1"), ("a1:bb:cc:dd:ee:ff", "token2"),
+                          ("a2:bb:cc:dd:ee:ff", "token2")], sent)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_run_stops_when_a_renewed_token_is_rejected_as_well(self, mock_output, mock_update_player_profile):
+        mock_update_player_profile.return_value = MagicMock(status=401, body=UNAUTHORIZED)
+        with self.assertRaises(SystemExit) as exit_context:
+            bpu.update_players([(1, "a1:bb:cc:dd:ee:ff")], "client_id", [], self.manager(CountingTokens()))
+        self.assertEqual("Error: Unauthorized [401]: invalid clientId or token supplied",
+                         exit_context.exception.code)
+        self.assertEqual(2, mock_update_player_profile.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,10 @@ import batch_player_upgrade as bpu
 
 class TestUpdatePlayerProfile(unittest.TestCase):
 
-    @patch("urllib.request.urlopen")
+    @patch("batch_player_upgrade.OPENER")
     @patch("urllib.request.Request")
     @patch("batch_player_upgrade.API_SERVER_BASE_URL", "http://example.com")
-    def test_update_player_profile_calls_Request(self, mock_request, mock_urlopen):
+    def test_update_player_profile_calls_Request(self, mock_request, mock_opener):
         bpu.update_player_profile("test_client_id", "test_macaddress", [], "test_token")
         assert mock_request.is_called_with("http://example.com/profiles/clientID:test_macaddress",
                                            data=bytes(json.dumps({"profile": {"applications": []}}), encoding='utf8'),
@@ -19,16 +19,16 @@ class TestUpdatePlayerProfile(unittest.TestCase):
                                                     "x-client-id": "test_client_id",
                                                     "x-authentication-token": "test_token"})
 
-    @patch("urllib.request.urlopen")
+    @patch("batch_player_upgrade.OPENER")
     @patch("batch_player_upgrade.API_SERVER_BASE_URL", "http://example.com")
-    def test_update_player_profile_creates_request_with_correct_address(self, mock_urlopen):
+    def test_update_player_profile_creates_request_with_correct_address(self, mock_opener):
         bpu.update_player_profile("test_client_id", "test_macaddress", [], "test_token")
-        assert mock_urlopen.call_args[0][0].full_url == "http://example.com/profiles/clientId:test_macaddress"
+        assert mock_opener.open.call_args[0][0].full_url == "http://example.com/profiles/clientId:test_macaddress"
 
 
-    @patch("urllib.request.urlopen")
+    @patch("batch_player_upgrade.OPENER")
     @patch("batch_player_upgrade.API_SERVER_BASE_URL", "http://example.com")
-    def test_update_player_profile_creates_request_with_correct_body(self, mock_urlopen):
+    def test_update_player_profile_creates_request_with_correct_body(self, mock_opener):
         applications = [{"applicationId": "music_app", "version": "v1.4.10"},
                         {"applicationId": "diagnostic_app", "version": "v1.2.6"},
                         {"applicationId": "settings_app", "version": "v1.1.5"}]
@@ -53,19 +53,57 @@ class TestUpdatePlayerProfile(unittest.TestCase):
             }
 
         bpu.update_player_profile("test_client_id", "test_macaddress", applications, "test_token")
-        assert mock_urlopen.call_args[0][0].data == bytes(json.dumps(expected_body), encoding='utf8')
+        assert mock_opener.open.call_args[0][0].data == bytes(json.dumps(expected_body), encoding='utf8')
 
-    @patch("urllib.request.urlopen")
-    def test_update_player_profile_creates_request_with_correct_headers(self, mock_urlopen):
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profile_creates_request_with_correct_headers(self, mock_opener):
         bpu.update_player_profile("test_client_id", "test_macaddress", [], "test_token")
 
-        assert mock_urlopen.call_args[0][0].get_header("Content-type") == "application/json"
-        assert mock_urlopen.call_args[0][0].get_header("X-client-id") == "test_client_id"
-        assert mock_urlopen.call_args[0][0].get_header("X-authentication-token") == "test_token"
+        assert mock_opener.open.call_args[0][0].get_header("Content-type") == "application/json"
+        assert mock_opener.open.call_args[0][0].get_header("X-client-id") == "test_client_id"
+        assert mock_opener.open.call_args[0][0].get_header("X-authentication-token") == "test_token"
 
-    @patch("urllib.request.urlopen")
-    def test_update_player_profile_returns_response_from_request(self, mock_request):
-        assert bpu.update_player_profile("", "", [], "") == mock_request.return_value
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profile_serializes_the_body_once_for_every_player_of_a_run(self, mock_opener):
+        applications = [{"applicationId": "music_app", "version": "v1.4.10"}]
+        bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:01", applications, "test_token")
+        with patch("json.dumps") as mock_dumps:
+            bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:02", applications, "test_token")
+            bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:03", list(applications), "test_token")
+        assert not mock_dumps.called
+        assert mock_opener.open.call_args[0][0].full_url.endswith("/profiles/clientId:aa:bb:cc:dd:ee:03")
+        assert mock_opener.open.call_args[0][0].data == bytes(json.dumps({"profile": {"applications": applications}}),
+                                                          encoding='utf8')
+
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profile_keeps_the_body_of_every_client_of_a_campaign(self, mock_opener):
+        music = [{"applicationId": "music_app", "version": "v1.4.10"}]
+        diagnostic = [{"applicationId": "diagnostic_app", "version": "1.0.0"}]
+        bpu.update_player_profile("client_a", "aa:bb:cc:dd:ee:01", music, "test_token")
+        bpu.update_player_profile("client_b", "aa:bb:cc:dd:ee:01", diagnostic, "test_token")
+        with patch("json.dumps") as mock_dumps:
+            for player in range(2, 5):
+                bpu.update_player_profile("client_a", "aa:bb:cc:dd:ee:0{}".format(player), music, "test_token")
+                bpu.update_player_profile("client_b", "aa:bb:cc:dd:ee:0{}".format(player), diagnostic, "test_token")
+        assert not mock_dumps.called
+        assert mock_opener.open.call_args[0][0].get_header("X-client-id") == "client_b"
+        assert mock_opener.open.call_args[0][0].data == bytes(json.dumps({"profile": {"applications": diagnostic}}),
+                                                          encoding='utf8')
+
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profile_serializes_the_body_again_when_the_update_changes(self, mock_opener):
+        applications = [{"applicationId": "music_app", "version": "v1.4.10"}]
+        bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:01", applications, "test_token")
+        applications[0]["version"] = "v1.4.11"
+        bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:01", applications, "test_token")
+        assert mock_opener.open.call_args[0][0].data == bytes(json.dumps({"profile": {"applications": applications}}),
+                                                          encoding='utf8')
+        bpu.update_player_profile("test_client_id", "aa:bb:cc:dd:ee:01", applications, "new_token")
+        assert mock_opener.open.call_args[0][0].get_header("X-authentication-token") == "new_token"
+
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profile_returns_response_from_request(self, mock_opener):
+        assert bpu.update_player_profile("", "", [], "") == mock_opener.open.return_value
 
 
 if __name__ == '__main__':
@@ -0,0 +1,36 @@
+import json
+import unittest
+from unittest.mock import patch
+
+import batch_player_upgrade as bpu
+
+
+class TestUpdatePlayerProfiles(unittest.TestCase):
+
+    @patch("batch_player_upgrade.OPENER")
+    @patch("batch_player_upgrade.API_SERVER_BASE_URL", "http://example.com")
+    def test_update_player_profiles_creates_request_with_bulk_endpoint_address(self, mock_opener):
+        bpu.update_player_profiles("test_client_id", ["aa:bb:cc:dd:ee:01"], [], "test_token", "/profiles:bulk")
+        assert mock_opener.open.call_args[0][0].full_url == "http://example.com/profiles:bulk"
+        assert mock_opener.open.call_args[0][0].get_method() == "PUT"
+
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profiles_creates_request_with_one_profile_per_player(self, mock_opener):
+        applications = [{"applicationId": "music_app", "version": "v1.4.10"}]
+        bpu.update_player_profiles("test_client_id", ["aa:bb:cc:dd:ee:01", "aa:bb:cc:dd:ee:02"], applications,
+                                   "test_token")
+        expected_body = {"profiles": [{"id": "clientId:aa:bb:cc:dd:ee:01", "profile": {"applications": applications}},
+                                      {"id": "clientId:aa:bb:cc:dd:ee:02", "profile": {"applications": applications}}]}
+        assert json.loads(mock_opener.open.call_args[0][0].data.decode("utf8")) == expected_body
+
+    @patch("batch_player_upgrade.OPENER")
+    def test_update_player_profiles_creates_request_with_correct_headers(self, mock_opener):
+        bpu.update_player_profiles("test_client_id", ["aa:bb:cc:dd:ee:01"], [], "test_token")
+
+        assert mock_opener.open.call_args[0][0].get_header("Content-type") == "application/json"
+        assert mock_opener.open.call_args[0][0].get_header("X-client-id") == "test_client_id"
+        assert mock_opener.open.call_args[0][0].get_header("X-authentication-token") == "test_token"
+
+
+if __name__ == '__main__':
+    unittest.main()
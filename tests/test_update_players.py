@@ -0,0 +1,284 @@
+import asyncio
+import builtins
+import json
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+
+class TestUpdatePlayers(unittest.TestCase):
+
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_every_player_is_updated_and_acknowledged_against_its_line_number(self, mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        players = [(2, "a1:bb:cc:dd:ee:ff"), (4, "a2:bb:cc:dd:ee:ff"), (5, "a3:bb:cc:dd:ee:ff")]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 2,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))])
+
+        self.assertEqual([(2, True), (4, True), (5, True)], sorted(acknowledged))
+        self.assertEqual(sorted(mac_address for line_num, mac_address in players),
+                         sorted(call[0][1] for call in mock_update_player_profile.call_args_list))
+
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_number_of_updates_in_flight_never_exceeds_concurrency(self, mock_update_player_profile):
+        lock = threading.Lock()
+        counters = {"in_flight": 0, "peak": 0}
+
+        def slow_update(client_id, mac_address, applications, token):
+            with lock:
+                counters["in_flight"] += 1
+                counters["peak"] = max(counters["peak"], counters["in_flight"])
+            time.sleep(0.01)
+            with lock:
+                counters["in_flight"] -= 1
+            return MagicMock(status=200)
+
+        mock_update_player_profile.side_effect = slow_update
+        players = ((line_num, "a1:bb:cc:dd:ee:ff") for line_num in range(2, 22))
+        acknowledged = []
+
+        bpu.update_players(players, "client_id", [], "token", 3,
+                           [lambda line_num, succeeded: acknowledged.append(line_num)])
+
+        self.assertEqual(20, len(acknowledged))
+        self.assertLessEqual(counters["peak"], 3)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_a_retry_due_while_every_slot_is_taken_waits_for_an_update_to_complete(self, mock_update_player_profile):
+        unavailable = MagicMock(status=503, body="")
+        unavailable.headers = {}
+        lock = threading.Lock()
+        sent = []
+
+        def slow_update(client_id, mac_address, applications, token):
+            with lock:
+                sent.append(mac_address)
+                first = len(sent) == 1
+            time.sleep(0.2)
+            return unavailable if first else MagicMock(status=200)
+
+        mock_update_player_profile.side_effect = slow_update
+        players = [(line_num, "a{}:bb:cc:dd:ee:ff".format(line_num)) for line_num in range(1, 7)]
+        wait_time = bpu.UpdateDispatcher.wait_time
+        loops = []
+
+        def counted_wait_time(dispatcher, *args):
+            loops.append(len(loops))
+            return wait_time(dispatcher, *args)
+
+        with patch.object(bpu.UpdateDispatcher, "wait_time", counted_wait_time):
+            bpu.update_players(iter(players), "client_id", [], "token", 2, retries=bpu.RetryScheduler(backoff=0.01))
+
+        self.assertEqual(7, len(sent))
+        # One round of the dispatch loop for each update that completes, rather than as many as fit in the wait
+        self.assertLess(len(loops), 20)
+
+    @patch("batch_player_upgrade.update_player_profile_async")
+    def test_a_retry_due_while_the_async_pipeline_is_full_waits_for_an_update_to_complete(
+            self, mock_update_player_profile_async):
+        unavailable = MagicMock(status=503, body="")
+        unavailable.headers = {}
+        sent = []
+
+        async def slow_update(http_client, client_id, mac_address, applications, token):
+            sent.append(mac_address)
+            first = len(sent) == 1
+            await asyncio.sleep(0.2)
+            return unavailable if first else MagicMock(status=200)
+
+        mock_update_player_profile_async.side_effect = slow_update
+        players = [(line_num, "a{}:bb:cc:dd:ee:ff".format(line_num)) for line_num in range(1, 7)]
+        wait_time = bpu.AsyncUpdateDispatcher.wait_time
+        loops = []
+
+        def counted_wait_time(dispatcher, *args):
+            loops.append(len(loops))
+            return wait_time(dispatcher, *args)
+
+        with patch.object(bpu.AsyncUpdateDispatcher, "wait_time", counted_wait_time):
+            bpu.update_players(iter(players), "client_id", [], "token", 2, retries=bpu.RetryScheduler(backoff=0.01),
+                               engine="async")
+
+        self.assertEqual(7, len(sent))
+        self.assertLess(len(loops), 20)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_waiting_to_retry_a_player_does_not_hold_up_the_others(self, mock_update_player_profile):
+        unavailable = MagicMock(status=503, body=json.dumps({"statusCode": 503, "error": "Service Unavailable",
+                                                             "message": "try again later"}))
+        unavailable.headers = {}
+        responses = {"a1:bb:cc:dd:ee:ff": [unavailable, MagicMock(status=200)]}
+        mock_update_player_profile.side_effect = lambda client_id, mac_address, applications, token: (
+            responses.get(mac_address, [MagicMock(status=200)]).pop(0))
+        players = [(1, "a1:bb:cc:dd:ee:ff"), (2, "a2:bb:cc:dd:ee:ff"), (3, "a3:bb:cc:dd:ee:ff")]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 1,
+                           [lambda line_num, succeeded: acknowledged.append(line_num)],
+                           retries=bpu.RetryScheduler(backoff=0.2))
+
+        self.assertEqual([2, 3, 1], acknowledged)
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_process_csv_reports_warnings_against_the_correct_line_when_concurrent(self,
+                                                                                   mock_output,
+                                                                                   mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 200
+        with patch.object(builtins, 'open') as mock_file:
+            mock_file.return_value = StringIO(
+                "MAC addresses, id1, id2, id3\n"
+                "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "potato, 1, 2, 3\n"
+                "a3:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                "a4:bb:cc:dd:ee:ff, 1, 2, 3\n"
+            )
+            bpu.process_csv('test.csv', "client_id", [], "token", concurrency=4)
+        self.assertEqual(3, mock_update_player_profile.call_count)
+        self.assertEqual("Line 3: Warning: Column 1 does not contain a valid Mac Address",
+                         mock_output.getvalue().strip())
+
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_process_csv_exits_on_error_response_when_concurrent(self, mock_update_player_profile):
+        mock_update_player_profile.return_value.status = 401
+        mock_update_player_profile.return_value.body = json.dumps({"statusCode": 401,
+                                                                   "error": "Unauthorized",
+                                                                   "message": "invalid clientId or token supplied"})
+        with self.assertRaises(SystemExit) as exit_context:
+            with patch.object(builtins, 'open') as mock_file:
+                mock_file.return_value = StringIO(
+                    "a1:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                    "a2:bb:cc:dd:ee:ff, 1, 2, 3\n"
+                )
+                bpu.process_csv('test.csv', "client_id", [], "token", concurrency=2)
+        self.assertEqual("Error: Unauthorized [401]: invalid clientId or token supplied",
+                         exit_context.exception.code)
+
+
+    @patch("batch_player_upgrade.update_player_profiles")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_players_are_batched_and_bulk_results_mapped_back_to_their_lines(self,
+                                                                            mock_output,
+                                                                            mock_update_player_profile,
+                                                                            mock_update_player_profiles):
+        def bulk_update(client_id, mac_addresses, applications, token, bulk_endpoint):
+            results = [{"id": "clientId:" + mac_address, "statusCode": 200} for mac_address in mac_addresses]
+            if "a2:bb:cc:dd:ee:ff" in mac_addresses:
+                results[mac_addresses.index("a2:bb:cc:dd:ee:ff")] = {
+                    "id": "clientId:a2:bb:cc:dd:ee:ff", "statusCode": 404, "error": "Not Found",
+                    "message": "profile does not exist"}
+            return MagicMock(status=200, body=json.dumps({"results": results}))
+
+        mock_update_player_profiles.side_effect = bulk_update
+        mock_update_player_profile.return_value.status = 200
+        players = [(line_num, "a{}:bb:cc:dd:ee:ff".format(line_num)) for line_num in range(1, 6)]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 1,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))],
+                           batch_size=2, flush_interval=0.01)
+
+        self.assertEqual([["a1:bb:cc:dd:ee:ff", "a2:bb:cc:dd:ee:ff"], ["a3:bb:cc:dd:ee:ff", "a4:bb:cc:dd:ee:ff"]],
+                         [call[0][1] for call in mock_update_player_profiles.call_args_list])
+        # A batch of one is sent as a plain player update
+        mock_update_player_profile.assert_called_once_with("client_id", "a5:bb:cc:dd:ee:ff", [], "token")
+        self.assertEqual([(1, True), (2, False), (3, True), (4, True), (5, True)], sorted(acknowledged))
+        self.assertEqual("Line 2: Error: Not Found [404]: profile does not exist", mock_output.getvalue().strip())
+
+    @patch("batch_player_upgrade.update_player_profiles")
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_players_are_updated_one_at_a_time_when_there_is_no_bulk_endpoint(self,
+                                                                              mock_output,
+                                                                              mock_update_player_profile,
+                                                                              mock_update_player_profiles):
+        mock_update_player_profiles.return_value = MagicMock(status=404, body="Not Found")
+        mock_update_player_profile.return_value.status = 200
+        players = [(line_num, "a{}:bb:cc:dd:ee:ff".format(line_num)) for line_num in range(1, 6)]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 1,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))],
+                           batch_size=3)
+
+        self.assertEqual(1, mock_update_player_profiles.call_count)
+        self.assertEqual(5, mock_update_player_profile.call_count)
+        self.assertEqual([(line_num, True) for line_num in range(1, 6)], sorted(acknowledged))
+        self.assertIn("Warning: The API server has no bulk endpoint at '/profiles'", mock_output.getvalue())
+
+    @patch("batch_player_upgrade.update_player_profiles")
+    def test_every_player_of_a_failed_bulk_request_is_retried(self, mock_update_player_profiles):
+        unavailable = MagicMock(status=503, body="")
+        unavailable.headers = {}
+        succeeded = MagicMock(status=200, body=json.dumps({"results": [
+            {"id": "clientId:a1:bb:cc:dd:ee:ff", "statusCode": 200},
+            {"id": "clientId:a2:bb:cc:dd:ee:ff", "statusCode": 200}]}))
+        mock_update_player_profiles.side_effect = [unavailable, succeeded]
+        players = [(1, "a1:bb:cc:dd:ee:ff"), (2, "a2:bb:cc:dd:ee:ff")]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 1,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))],
+                           retries=bpu.RetryScheduler(backoff=0), batch_size=2, flush_interval=0.01)
+
+        self.assertEqual(2, mock_update_player_profiles.call_count)
+        self.assertEqual([(1, True), (2, True)], sorted(acknowledged))
+
+    @patch("batch_player_upgrade.update_player_profiles")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_players_without_a_result_in_a_bulk_response_are_retried_and_never_acknowledged(
+            self, mock_output, mock_update_player_profiles):
+        maintenance = MagicMock(status=200, body="<html><body>Down for maintenance</body></html>")
+        partial = MagicMock(status=200, body=json.dumps({"results": [
+            {"id": "clientId:a1:bb:cc:dd:ee:ff", "statusCode": 200}]}))
+        mock_update_player_profiles.side_effect = [maintenance, partial]
+        players = [(1, "a1:bb:cc:dd:ee:ff"), (2, "a2:bb:cc:dd:ee:ff")]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 1,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))],
+                           retries=bpu.RetryScheduler(max_retries=1, backoff=0), batch_size=2, flush_interval=0.01)
+
+        self.assertEqual(2, mock_update_player_profiles.call_count)
+        self.assertEqual([(1, True), (2, False)], sorted(acknowledged))
+        self.assertEqual("Line 2: Error: Invalid Response [-]: No result for this player in the bulk response [200]",
+                         mock_output.getvalue().strip())
+
+
+    @patch("sys.stderr", new_callable=StringIO)
+    @patch("batch_player_upgrade.update_player_profile")
+    def test_updates_stop_while_the_api_server_is_failing_and_resume_once_it_answers(self, mock_update_player_profile,
+                                                                                     mock_output):
+        unavailable = MagicMock(status=503, body="")
+        unavailable.headers = {}
+        sent_at = []
+        lock = threading.Lock()
+
+        def update(client_id, mac_address, applications, token):
+            with lock:
+                sent_at.append(time.monotonic())
+                return unavailable if len(sent_at) <= 8 else MagicMock(status=200)
+
+        mock_update_player_profile.side_effect = update
+        players = [(line_num, "a{:x}:bb:cc:dd:ee:ff".format(line_num)) for line_num in range(1, 31)]
+        acknowledged = []
+
+        bpu.update_players(iter(players), "client_id", [], "token", 4,
+                           [lambda line_num, succeeded: acknowledged.append((line_num, succeeded))],
+                           retries=bpu.RetryScheduler(max_retries=10, backoff=0),
+                           breaker=bpu.CircuitBreaker(pause=0.2, min_requests=4, probes=2))
+
+        self.assertEqual([(line_num, True) for line_num in range(1, 31)], sorted(acknowledged))
+        self.assertGreaterEqual(max(later - earlier for earlier, later in zip(sent_at, sent_at[1:])), 0.2)
+        self.assertIn("pausing updates for 0.2 seconds", mock_output.getvalue())
+        self.assertIn("Resuming updates after 2 healthy probe updates", mock_output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
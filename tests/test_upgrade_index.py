@@ -0,0 +1,68 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+import batch_player_upgrade as bpu
+
+APPLICATIONS = [{"applicationId": "music_app", "version": "v1.4.10"}]
+
+
+class TestUpgradeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.directory, "players.csv")
+        self.index_path = os.path.join(self.directory, "upgrades.db")
+        with open(self.csv_path, "w") as csv_file:
+            csv_file.write("a1:bb:cc:dd:ee:ff\n"
+                           "a2:bb:cc:dd:ee:ff\n"
+                           "a3:bb:cc:dd:ee:ff\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_acknowledged_players_are_upgraded_for_the_same_client_and_versions_only(self):
+        upgrade_index = bpu.UpgradeIndex(self.index_path, "client_id", APPLICATIONS)
+        list(upgrade_index.skip_upgraded([(1, "a1:bb:cc:dd:ee:ff")], {}))
+        upgrade_index.acknowledge(1)
+        upgrade_index.close()
+
+        same_upgrade = bpu.UpgradeIndex(self.index_path, "client_id", APPLICATIONS)
+        other_client = bpu.UpgradeIndex(self.index_path, "other_client_id", APPLICATIONS)
+        other_versions = bpu.UpgradeIndex(self.index_path, "client_id", [{"applicationId": "music_app",
+                                                                          "version": "v1.4.11"}])
+        self.assertTrue(same_upgrade.is_upgraded("a1:bb:cc:dd:ee:ff"))
+        self.assertFalse(same_upgrade.is_upgraded("a2:bb:cc:dd:ee:ff"))
+        self.assertFalse(other_client.is_upgraded("a1:bb:cc:dd:ee:ff"))
+        self.assertFalse(other_versions.is_upgraded("a1:bb:cc:dd:ee:ff"))
+        for upgrade_index in (same_upgrade, other_client, other_versions):
+            upgrade_index.close()
+
+    @patch("batch_player_upgrade.update_player_profile")
+    @patch("sys.stdout", new_callable=StringIO)
+    def test_rerunning_process_csv_skips_players_upgraded_by_the_previous_run(self,
+                                                                              mock_output,
+                                                                              mock_update_player_profile):
+        error_response = MagicMock(status=401, body=json.dumps({"statusCode": 401,
+                                                                "error": "Unauthorized",
+                                                                "message": "invalid clientId or token supplied"}))
+        mock_update_player_profile.side_effect = [MagicMock(status=200), error_response]
+        with self.assertRaises(SystemExit):
+            bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", upgrade_index_path=self.index_path)
+
+        mock_update_player_profile.reset_mock()
+        mock_update_player_profile.side_effect = None
+        mock_update_player_profile.return_value.status = 200
+        bpu.process_csv(self.csv_path, "client_id", APPLICATIONS, "token", upgrade_index_path=self.index_path)
+
+        updated = [call[0][1] for call in mock_update_player_profile.call_args_list]
+        self.assertEqual(["a2:bb:cc:dd:ee:ff", "a3:bb:cc:dd:ee:ff"], updated)
+        self.assertIn("Skipped 1 players already upgraded to these versions", mock_output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,6 +20,32 @@ class TestValidateRow(unittest.TestCase):
         assert bpu.validate_row(['aa:bb:cc:dd:ee:ff']) is True
         assert bpu.validate_row(['aa:22:CC:33:ee:00']) is True
 
+    def test_return_false_when_first_column_contains_a_pipe(self):
+        assert bpu.validate_row(['aa:bb:cc:dd:ee:|f']) is False
+        assert bpu.validate_row(['||:bb:cc:dd:ee:ff']) is False
+
+    def test_return_true_for_dash_dotted_and_bare_MAC_addresses(self):
+        assert bpu.validate_row(['aa-bb-cc-dd-ee-ff']) is True
+        assert bpu.validate_row(['aabb.ccdd.eeff']) is True
+        assert bpu.validate_row(['AABBCCDDEEFF']) is True
+
+    def test_return_false_when_separators_are_mixed_or_misplaced(self):
+        assert bpu.validate_row(['aa:bb-cc:dd:ee:ff']) is False
+        assert bpu.validate_row(['aab.bccd.deeff']) is False
+        assert bpu.validate_row(['aabbccddeeff00']) is False
+        assert bpu.validate_row(['aa:bb:cc:dd:ee:ff\n']) is False
+
+    def test_validate_rows_returns_normalized_MAC_address_or_None_for_every_row(self):
+        rows = [['AA:BB:CC:DD:EE:FF', '1'],
+                [],
+                ['aa-bb-cc-dd-ee-0f'],
+                ['potato'],
+                ['AABB.CCDD.EE01'],
+                ['aabbccddee02']]
+        self.assertEqual(['aa:bb:cc:dd:ee:ff', None, 'aa:bb:cc:dd:ee:0f', None, 'aa:bb:cc:dd:ee:01',
+                          'aa:bb:cc:dd:ee:02'],
+                         bpu.validate_rows(rows))
+
 
 if __name__ == '__main__':
     unittest.main()